@@ -1,11 +1,16 @@
-import cohere
-
 from utils.db_client import get_es_client, get_milvus_client
 from utils.get_text_embedding import get_text_embedding_ada_v2 as get_text_embedding
-from utils.chat_wrapper import chat_completion
+from utils.chat_wrapper import chat_completion, chat_completion_stream
+from utils.fan_out import fan_out
+from utils.rerank import get_cohere_rerank_result
+from utils.rank_fusion import fuse_documents
+from utils.bm25_index import get_local_bm25_index
 
 from utils.logger import logger
-from config.config_parser import MILVUS_SIZE, ES_SIZE, MILVUS_THRESHOLD, COHERE_API_KEY, RERANK_TOP_N
+from config.config_parser import (
+    MILVUS_SIZE, ES_SIZE, MILVUS_THRESHOLD, RERANK_TOP_N,
+    ES_TIMEOUT, VECTOR_TIMEOUT, BM25_BACKEND
+)
 
 
 class DocQA:
@@ -35,6 +40,10 @@ class DocQA:
 
     # get search result form Elasticsearch BM25 keyword-search
     def get_elasticsearch_search_result(self, query):
+        if BM25_BACKEND == 'local':
+            bm25_index = get_local_bm25_index()
+            return [(bm25_index.texts[doc_pos], bm25_index.sources[doc_pos])
+                    for doc_pos, _ in bm25_index.search(query, ES_SIZE)]
         es_client = get_es_client()
         result = []
         dsl = {
@@ -51,34 +60,28 @@ class DocQA:
         return result
 
     def get_context(self, query):
-        contents = []
-        milvus_search_result = self.get_milvus_search_result(query)
-        es_search_result = self.get_elasticsearch_search_result(query)
+        # search Milvus and Elasticsearch concurrently, a failed leg contributes no documents
+        search_result = fan_out({"milvus": lambda: self.get_milvus_search_result(query),
+                                 "es": lambda: self.get_elasticsearch_search_result(query)},
+                                timeout={"milvus": VECTOR_TIMEOUT, "es": ES_TIMEOUT},
+                                default=[])
+        milvus_search_result, es_search_result = search_result["milvus"], search_result["es"]
 
-        # remove duplicate
-        for content_source_tuple in milvus_search_result + es_search_result:
-            content, source = content_source_tuple
-            if [content, source] not in contents:
-                contents.append([content, source])
-        return contents
+        # fuse both legs by RRF on the content digests, which also removes the duplicates
+        return fuse_documents([milvus_search_result, es_search_result])
 
     def rerank(self, query):
         before_rerank_contents = self.get_context(query)
 
-        # rerank using CoHere rerank API
-        cohere_client = cohere.Client(COHERE_API_KEY)
-        docs, sources = [_[0] for _ in before_rerank_contents], [_[1] for _ in before_rerank_contents]
+        # rerank using CoHere rerank API, pairs scored before come from the rerank score cache
+        source_by_text = {}
+        for content, source in before_rerank_contents:
+            source_by_text.setdefault(content, source)
 
-        results = cohere_client.rerank(
-            model="rerank-multilingual-v2.0",
-            query=query,
-            documents=docs,
-            top_n=RERANK_TOP_N
-        )
         after_rerank_contents = []
-        for hit in results:
-            after_rerank_contents.append([hit.document['text'], sources[hit.index]])
-            logger.info(f"Score: {hit.relevance_score}, query: {query}, text: {hit.document['text']}")
+        for text, score in get_cohere_rerank_result(query, list(source_by_text), top_n=RERANK_TOP_N):
+            after_rerank_contents.append([text, source_by_text[text]])
+            logger.info(f"Score: {score}, query: {query}, text: {text}")
 
         return after_rerank_contents
 
@@ -103,6 +106,13 @@ class DocQA:
         message, contexts, sources = self.get_qa_prompt(query=query)
         result = chat_completion(message, self.model_name)
         return result, contexts, sources
+
+    def answer_stream(self, query):
+        """yield the retrieved contexts and sources first, then the answer tokens as they are generated"""
+        message, contexts, sources = self.get_qa_prompt(query)
+        yield {"event": "contexts", "contexts": contexts, "sources": sources}
+        for token in chat_completion_stream(message, self.model_name):
+            yield {"event": "token", "content": token}
     
 
 if __name__ == '__main__':
@@ -89,9 +89,19 @@ if page == "Q&A":
     if st.button('Ask'):
         if query:
             try:
+                answer_stream = DocQA(query).answer_stream(model_name=model)
                 with st.spinner('Querying, Please be patient...'):
-                    reply = DocQA(query).answer(model_name=model)
-                st.write(reply)
+                    # retrieval and rerank, the contexts arrive before the first token
+                    retrieved = next(answer_stream)
+                placeholder = st.empty()
+                reply = ""
+                for event in answer_stream:
+                    reply += event["content"]
+                    placeholder.markdown(reply + "▌")
+                placeholder.markdown(reply)
+                with st.expander("Contexts"):
+                    st.write(retrieved["contexts"])
+                    st.write(retrieved["sources"])
             except Exception as e:
                 st.error(f"An error occurred: {e}")
 
@@ -18,6 +18,16 @@ SERVER_PORT = server_config.get("port", 80)
 log_config = basic_config['log']
 LOG_PATH = log_config.get('save_path', 'logs')
 
+es_config = basic_config["elasticsearch"]
+ES_URL = es_config.get("url", "http://localhost:9200")
+ES_INDEX = es_config.get("index", "docs_qa")
+ES_CONNECTIONS_PER_NODE = es_config.get("connections_per_node", 10)
+
+milvus_config = basic_config["milvus"]
+MILVUS_HOST_LOCAL = milvus_config.get("host_local", "localhost")
+MILVUS_HOST_ONLINE = milvus_config.get("host_online", "localhost")
+MILVUS_PORT = milvus_config.get("port", 19530)
+
 langchain_config = basic_config["langchain"]
 CHUNK_SIZE = langchain_config.get("chunk_size", 100)
 SYSTEM_ROLE = langchain_config.get("system_role", "")
@@ -27,6 +37,93 @@ MILVUS_SIZE = retrieval_config.get("milvus_size", 2)
 MILVUS_THRESHOLD = retrieval_config.get("milvus_threshold", 2)
 ES_SIZE = retrieval_config.get("es_size", 2)
 RERANK_TOP_N = retrieval_config.get("rerank_top_n", 5)
+BM25_BACKEND = retrieval_config.get("bm25_backend", "elasticsearch")
+BM25_INDEX_PATH = os.path.join(PROJECT_DIR, retrieval_config.get("bm25_index_path", "data/bm25_index"))
+ES_TIMEOUT = retrieval_config.get("es_timeout", 2)
+VECTOR_TIMEOUT = retrieval_config.get("vector_timeout", 3)
+MILVUS_EXECUTOR_WORKERS = retrieval_config.get("milvus_executor_workers", 8)
+
+faiss_config = basic_config["faiss"]
+FAISS_INDEX_TYPE = faiss_config.get("index_type", "flat")
+FAISS_INDEX_DIR = os.path.join(PROJECT_DIR, faiss_config.get("index_dir", "data/faiss_index"))
+FAISS_NLIST = faiss_config.get("nlist", 1024)
+FAISS_PQ_M = faiss_config.get("pq_m", 64)
+FAISS_PQ_NBITS = faiss_config.get("pq_nbits", 8)
+FAISS_HNSW_M = faiss_config.get("hnsw_m", 32)
+FAISS_EF_CONSTRUCTION = faiss_config.get("ef_construction", 200)
+FAISS_NPROBE = faiss_config.get("nprobe", 16)
+FAISS_EF_SEARCH = faiss_config.get("ef_search", 64)
+FAISS_QUANTIZATION = faiss_config.get("quantization", "none")
+FAISS_RESCORE_CANDIDATES = faiss_config.get("rescore_candidates", 200)
+
+embedding_config = basic_config["embedding"]
+EMBEDDING_MAX_BATCH_ITEMS = embedding_config.get("max_batch_items", 256)
+EMBEDDING_MAX_BATCH_TOKENS = embedding_config.get("max_batch_tokens", 100000)
+EMBEDDING_CONCURRENCY = embedding_config.get("concurrency", 4)
+BGE_EMBEDDING_API = embedding_config.get("bge_embedding_api", "http://localhost:50072/embedding")
+LOCAL_EMBEDDING_MODEL = embedding_config.get("local_model", "BAAI/bge-large-zh-v1.5")
+EMBEDDING_SERVER_MAX_BATCH_SIZE = embedding_config.get("server_max_batch_size", 32)
+EMBEDDING_SERVER_MAX_WAIT_MS = embedding_config.get("server_max_wait_ms", 10)
+
+embedding_cache_config = basic_config["embedding_cache"]
+EMBEDDING_CACHE_ENABLED = embedding_cache_config.get("enabled", True)
+EMBEDDING_CACHE_MEMORY_BYTES = embedding_cache_config.get("memory_bytes", 64 * 1024 * 1024)
+EMBEDDING_CACHE_DB_PATH = os.path.join(PROJECT_DIR, embedding_cache_config.get("db_path", "data/embedding_cache.sqlite3"))
+
+rerank_config = basic_config["rerank"]
+RERANK_BACKEND = rerank_config.get("backend", "torch")
+RERANK_MODEL = rerank_config.get("model", "BAAI/bge-reranker-large")
+RERANK_USE_FP16 = rerank_config.get("use_fp16", True)
+RERANK_BATCH_SIZE = rerank_config.get("batch_size", 32)
+RERANK_MAX_LENGTH = rerank_config.get("max_length", 512)
+RERANK_MAX_QUEUE_PAIRS = rerank_config.get("max_queue_pairs", 128)
+RERANK_MAX_WAIT_MS = rerank_config.get("max_wait_ms", 5)
+RERANK_ONNX_DIR = os.path.join(PROJECT_DIR, rerank_config.get("onnx_dir", "data/onnx_reranker"))
+RERANK_INTRA_OP_THREADS = rerank_config.get("intra_op_threads", 0)
+
+rerank_cache_config = basic_config["rerank_cache"]
+RERANK_CACHE_ENABLED = rerank_cache_config.get("enabled", True)
+RERANK_CACHE_MAX_ENTRIES = rerank_cache_config.get("max_entries", 100000)
+RERANK_CACHE_TTL_SECONDS = rerank_cache_config.get("ttl_seconds", 86400)
+
+answer_cache_config = basic_config["answer_cache"]
+ANSWER_CACHE_ENABLED = answer_cache_config.get("enabled", True)
+ANSWER_CACHE_EMBEDDING_MODEL = answer_cache_config.get("embedding_model", "text-embedding-3-small")
+ANSWER_CACHE_THRESHOLD = answer_cache_config.get("threshold", 0.95)
+ANSWER_CACHE_MAX_ENTRIES = answer_cache_config.get("max_entries", 10000)
+ANSWER_CACHE_TTL_SECONDS = answer_cache_config.get("ttl_seconds", 86400)
+
+resources_config = basic_config["resources"]
+RESOURCE_HTTP_POOL_SIZE = resources_config.get("http_pool_size", 32)
+RESOURCE_HTTP_KEEPALIVE = resources_config.get("http_keepalive", 16)
+RESOURCE_HTTP_TIMEOUT = resources_config.get("http_timeout", 60)
+RESOURCE_OPENAI_POOL_SIZE = resources_config.get("openai_pool_size", 32)
+RESOURCE_HEALTH_CHECK = resources_config.get("health_check", True)
+
+metrics_config = basic_config["metrics"]
+METRICS_DEBUG = metrics_config.get("debug", False)
+
+deadline_config = basic_config["deadline"]
+DEADLINE_REQUEST_BUDGET = deadline_config.get("request_budget", 0)
+DEADLINE_RERANK_MIN_BUDGET = deadline_config.get("rerank_min_budget", 1.0)
+DEADLINE_LLM_MIN_BUDGET = deadline_config.get("llm_min_budget", 4.0)
+DEADLINE_RERANK_POLICY = deadline_config.get("rerank_policy", "skip")
+DEADLINE_LLM_POLICY = deadline_config.get("llm_policy", "fallback")
+DEADLINE_FALLBACK_MODEL = deadline_config.get("fallback_model", "")
+
+hedge_config = basic_config["hedge"]
+HEDGE_ENABLED = hedge_config.get("enabled", False)
+HEDGE_STAGES = hedge_config.get("stages", ["embedding", "llm"])
+HEDGE_QUANTILE = hedge_config.get("quantile", 0.95)
+HEDGE_MIN_DELAY_MS = hedge_config.get("min_delay_ms", 50)
+HEDGE_WINDOW = hedge_config.get("window", 500)
+HEDGE_MIN_SAMPLES = hedge_config.get("min_samples", 20)
+
+rate_limit_config = basic_config["rate_limit"]
+RATE_LIMIT_MAX_RETRIES = rate_limit_config.get("max_retries", 5)
+RATE_LIMIT_BASE_DELAY = rate_limit_config.get("base_delay", 0.5)
+RATE_LIMIT_MAX_DELAY = rate_limit_config.get("max_delay", 30)
+RATE_LIMIT_PROVIDERS = rate_limit_config.get("providers", {})
 
 # basic config parser
 with open(os.path.join(PROJECT_DIR, 'config/model_config.yml'), encoding="utf-8") as yaml_file:
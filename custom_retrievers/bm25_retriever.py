@@ -1,41 +1,97 @@
 from typing import List
 
-from elasticsearch import Elasticsearch
 from llama_index.schema import TextNode
 from llama_index import QueryBundle
 from llama_index.schema import NodeWithScore
 from llama_index.retrievers import BaseRetriever
 
-from preprocess.get_text_id_mapping import text_node_id_mapping
+from preprocess.chunk_id_index import get_chunk_id_index
+from utils.db_client import get_es_client
+from utils.bm25_index import get_dataset_bm25_index
+from utils.logger import logger
+from utils.metrics import record_count, span
+from config.config_parser import ES_INDEX, BM25_BACKEND
 
 
 class CustomBM25Retriever(BaseRetriever):
-    """Custom retriever for elasticsearch with bm25"""
-    def __init__(self, top_k) -> None:
+    """Custom retriever for elasticsearch with bm25, or the in-process bm25 index with backend='local'"""
+    def __init__(self, top_k, backend=BM25_BACKEND) -> None:
         """Init params."""
         super().__init__()
-        self.es_client = Elasticsearch("http://localhost:9200")
+        self.backend = backend
         self.top_k = top_k
+        if self.backend == 'local':
+            # the evaluation retrievers search the dataset corpus, their node ids come from its chunk id index
+            self.bm25_index = get_dataset_bm25_index()
+        else:
+            # shared, pooled client instead of a new connection per retriever
+            self.es_client = get_es_client()
 
-    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
-        result = []
+    def _get_dsl(self, query_str: str) -> dict:
         # 查询数据(全文搜索)
-        dsl = {
+        return {
             'query': {
                 'match': {
-                    'content': query_bundle.query_str
+                    'content': query_str
                 }
             },
             "size": self.top_k
         }
-        search_result = self.es_client.search(index='docs_qa', body=dsl)
+
+    @staticmethod
+    def _parse_hits(search_result: dict) -> List[NodeWithScore]:
+        result = []
         if search_result['hits']['hits']:
+            chunk_id_index = get_chunk_id_index()
             for record in search_result['hits']['hits']:
                 text = record['_source']['content']
-                node_with_score = NodeWithScore(node=TextNode(text=text, id_=text_node_id_mapping[text]),
+                node_with_score = NodeWithScore(node=TextNode(text=text, id_=chunk_id_index[text]),
                                                 score=record['_score'])
                 result.append(node_with_score)
+        return result
 
+    def _local_retrieve(self, query_str: str) -> List[NodeWithScore]:
+        chunk_id_index = get_chunk_id_index()
+        result = []
+        for doc_pos, score in self.bm25_index.search(query_str, self.top_k):
+            text = self.bm25_index.texts[doc_pos]
+            result.append(NodeWithScore(node=TextNode(text=text, id_=chunk_id_index[text]), score=score))
+        return result
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        with span("bm25_search"):
+            if self.backend == 'local':
+                result = self._local_retrieve(query_bundle.query_str)
+            else:
+                search_result = self.es_client.search(index=ES_INDEX, body=self._get_dsl(query_bundle.query_str))
+                result = self._parse_hits(search_result)
+        record_count("bm25_search", len(result))
+        return result
+
+    def multi_retrieve(self, queries: List[str]) -> List[List[NodeWithScore]]:
+        """
+        Search all query variants with a single _msearch round-trip.
+        Returns one ranked node list per query, in the order of `queries`.
+        """
+        if not queries:
+            return []
+        if self.backend == 'local':
+            with span("bm25_search"):
+                return [self._local_retrieve(query_str) for query_str in queries]
+        searches = []
+        for query_str in queries:
+            searches.append({'index': ES_INDEX})
+            searches.append(self._get_dsl(query_str))
+        with span("bm25_search"):
+            responses = self.es_client.msearch(searches=searches)['responses']
+
+        result = []
+        for query_str, response in zip(queries, responses):
+            if 'error' in response:
+                logger.error(f"bm25 msearch failed for query: {query_str}, error: {response['error']}")
+                result.append([])
+            else:
+                result.append(self._parse_hits(response))
         return result
 
 
@@ -45,3 +101,4 @@ if __name__ == '__main__':
     query = "叙利亚队"
     t_result = custom_bm25_retriever.retrieve(str_or_query_bundle=query)
     pprint(t_result)
+    pprint(custom_bm25_retriever.multi_retrieve([query, "中国队亚洲杯成绩如何"]))
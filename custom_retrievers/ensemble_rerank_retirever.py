@@ -1,54 +1,54 @@
 from typing import List
 
-from llama_index.schema import TextNode, NodeWithScore
+from llama_index.schema import NodeWithScore
 from llama_index.retrievers import BaseRetriever
 from llama_index.indices.query.schema import QueryBundle
 
-from preprocess.get_text_id_mapping import text_node_id_mapping
 from custom_retrievers.bm25_retriever import CustomBM25Retriever
 from custom_retrievers.vector_store_retriever import VectorSearchRetriever
 
-from utils.rerank import get_cohere_rerank_result
+from utils.rerank import get_bge_rerank_result, get_cohere_rerank_result
+from utils.fan_out import fan_out
+from utils.metrics import record_count, span
+from utils.rank_fusion import fuse_node_lists
+from config.config_parser import ES_TIMEOUT, VECTOR_TIMEOUT, BM25_BACKEND
 
 
 class EnsembleRerankRetriever(BaseRetriever):
-    def __init__(self, top_k, faiss_index):
-        self.faiss_index = faiss_index
+    def __init__(self, top_k, bm25_backend=BM25_BACKEND, reranker='cohere'):
         self.top_k = top_k
-        self.vector_store_retriever = VectorSearchRetriever(top_k=self.top_k, faiss_index=self.faiss_index)
-        self.bm25_retriever = CustomBM25Retriever(top_k=self.top_k)
+        self.vector_store_retriever = VectorSearchRetriever(top_k=self.top_k)
+        self.bm25_retriever = CustomBM25Retriever(top_k=self.top_k, backend=bm25_backend)
+        # reranker='bge' uses the local cross-encoder instead of the Cohere rerank API
+        self.get_rerank_result = get_bge_rerank_result if reranker == 'bge' else get_cohere_rerank_result
 
     def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
         print(query_bundle.query_str)
-        bm25_search_nodes = self.bm25_retriever.retrieve(query_bundle)
-        vector_search_nodes = self.vector_store_retriever.retrieve(query_bundle)
-
-        bm25_docs = [node.text for node in bm25_search_nodes]
-        vector_docs = [node.text for node in vector_search_nodes]
-        # remove duplicate document
-        all_documents = set()
-        for doc_list in [bm25_docs, vector_docs]:
-            for doc in doc_list:
-                all_documents.add(doc)
-        doc_lists = list(all_documents)
+        # query both legs concurrently, a failed leg contributes no documents
+        search_nodes = fan_out({"bm25": lambda: self.bm25_retriever.retrieve(query_bundle),
+                                "vector": lambda: self.vector_store_retriever.retrieve(query_bundle)},
+                               timeout={"bm25": ES_TIMEOUT, "vector": VECTOR_TIMEOUT},
+                               default=[])
+        bm25_search_nodes, vector_search_nodes = search_nodes["bm25"], search_nodes["vector"]
+
+        # remove duplicate document by node id, candidates keep their fused order
+        with span("fusion"):
+            candidate_nodes = fuse_node_lists([bm25_search_nodes, vector_search_nodes])
+            node_by_text = {node.text: node.node for node in candidate_nodes}
+        record_count("fusion", len(node_by_text))
         # rerank using query and docs
-        rerank_doc_lists = get_cohere_rerank_result(query_bundle.query_str, doc_lists, top_n=self.top_k)
+        with span("rerank"):
+            rerank_doc_lists = self.get_rerank_result(query_bundle.query_str, list(node_by_text), top_n=self.top_k)
+        record_count("rerank", len(rerank_doc_lists))
         result = []
         for sorted_doc in rerank_doc_lists:
             text, score = sorted_doc
-            node_with_score = NodeWithScore(node=TextNode(text=text,
-                                                          id_=text_node_id_mapping[text]),
-                                            score=score)
-            result.append(node_with_score)
+            result.append(NodeWithScore(node=node_by_text[text], score=score))
 
         return result
 
 
 if __name__ == '__main__':
-    from faiss import IndexFlatIP
-
-    faiss_index = IndexFlatIP(1536)
-    ensemble_rerank_retriever = EnsembleRerankRetriever(top_k=2, faiss_index=faiss_index)
+    ensemble_rerank_retriever = EnsembleRerankRetriever(top_k=2)
     t_result = ensemble_rerank_retriever.retrieve(str_or_query_bundle="中国队亚洲杯成绩如何")
     print(t_result)
-    faiss_index.reset()
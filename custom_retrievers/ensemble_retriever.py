@@ -1,65 +1,43 @@
 from typing import List
-from operator import itemgetter
 
-from llama_index.schema import TextNode, NodeWithScore
+from llama_index.schema import NodeWithScore
 from llama_index.retrievers import BaseRetriever
 from llama_index.indices.query.schema import QueryType
 
-from preprocess.get_text_id_mapping import text_node_id_mapping
 from custom_retrievers.bm25_retriever import CustomBM25Retriever
 from custom_retrievers.vector_store_retriever import VectorSearchRetriever
+from utils.fan_out import fan_out
+from utils.metrics import record_count, span
+from utils.rank_fusion import fuse_node_lists
+from config.config_parser import ES_TIMEOUT, VECTOR_TIMEOUT, BM25_BACKEND
 
 
 class EnsembleRetriever(BaseRetriever):
-    def __init__(self, top_k, faiss_index, weights):
+    def __init__(self, top_k, weights, bm25_backend=BM25_BACKEND):
         self.weights = weights
         self.c: int = 60
-        self.faiss_index = faiss_index
         self.top_k = top_k
-        self.vector_store_retriever = VectorSearchRetriever(top_k=self.top_k, faiss_index=self.faiss_index)
-        self.bm25_retriever = CustomBM25Retriever(top_k=self.top_k)
+        self.vector_store_retriever = VectorSearchRetriever(top_k=self.top_k)
+        self.bm25_retriever = CustomBM25Retriever(top_k=self.top_k, backend=bm25_backend)
 
     def _retrieve(self, query_bundle: QueryType) -> List[NodeWithScore]:
-        bm25_search_nodes = self.bm25_retriever.retrieve(query_bundle)
-        vector_search_nodes = self.vector_store_retriever.retrieve(query_bundle)
+        # query both legs concurrently, a failed leg contributes no documents
+        search_nodes = fan_out({"bm25": lambda: self.bm25_retriever.retrieve(query_bundle),
+                                "vector": lambda: self.vector_store_retriever.retrieve(query_bundle)},
+                               timeout={"bm25": ES_TIMEOUT, "vector": VECTOR_TIMEOUT},
+                               default=[])
+        bm25_search_nodes, vector_search_nodes = search_nodes["bm25"], search_nodes["vector"]
 
-        bm25_docs = [node.text for node in bm25_search_nodes]
-        vector_docs = [node.text for node in vector_search_nodes]
-        doc_lists = [bm25_docs, vector_docs]
-
-        # remove duplicates
-        all_documents = set()
-        for doc_list in doc_lists:
-            for doc in doc_list:
-                all_documents.add(doc)
-
-        # Calculate RRF score for each document
-        rrf_score_dict = {doc: 0.0 for doc in all_documents}
-
-        for doc_list, weight in zip(doc_lists, self.weights):
-            for rank, doc in enumerate(doc_list, start=1):
-                rrf_score = weight * (1 / (rank + self.c))
-                rrf_score_dict[doc] += rrf_score
-
-        # sort documents by their RRF score in desc
-        sorted_documents = sorted(rrf_score_dict.items(), key=itemgetter(1), reverse=True)
-        result = []
-        for sorted_doc in sorted_documents[:self.top_k]:
-            text, score = sorted_doc
-            node_with_score = NodeWithScore(node=TextNode(text=text,
-                                                          id_=text_node_id_mapping[text]),
-                                            score=score)
-            result.append(node_with_score)
-
-        return result
+        # calculate RRF score for each document and sort them in desc
+        with span("fusion"):
+            fused_nodes = fuse_node_lists([bm25_search_nodes, vector_search_nodes],
+                                          weights=self.weights, c=self.c, top_k=self.top_k)
+        record_count("fusion", len(fused_nodes))
+        return fused_nodes
 
 
 if __name__ == '__main__':
-    from faiss import IndexFlatIP
-
-    faiss_index = IndexFlatIP(1536)
     query = "中国队亚洲杯成绩如何"
-    ensemble_retriever = EnsembleRetriever(top_k=3, faiss_index=faiss_index, weights=[0.5, 0.5])
+    ensemble_retriever = EnsembleRetriever(top_k=3, weights=[0.5, 0.5])
     t_result = ensemble_retriever.retrieve(str_or_query_bundle=query)
     print(t_result)
-    faiss_index.reset()
@@ -1,77 +1,53 @@
-import json
 from typing import List
-from operator import itemgetter
 
-from llama_index.schema import TextNode
 from llama_index.schema import NodeWithScore
 from llama_index.retrievers import BaseRetriever
 from llama_index.indices.query.schema import QueryType
 
-from preprocess.get_text_id_mapping import text_node_id_mapping
 from custom_retrievers.bm25_retriever import CustomBM25Retriever
 from custom_retrievers.vector_store_retriever import VectorSearchRetriever
+from utils.metrics import record_count, span
+from utils.rank_fusion import fuse_node_lists
+from config.config_parser import BM25_BACKEND
 
 
 class QueryRewriteEnsembleRetriever(BaseRetriever):
-    def __init__(self, top_k, faiss_index):
+    def __init__(self, top_k, bm25_backend=BM25_BACKEND):
         super().__init__()
         self.c: int = 60
-        self.faiss_index = faiss_index
         self.top_k = top_k
-        self.embedding_retriever = VectorSearchRetriever(top_k=self.top_k, faiss_index=faiss_index, query_rewrite=True)
-        with open('../data/query_rewrite.json', 'r') as f:
-            self.query_write_dict = json.loads(f.read())
+        self.embedding_retriever = VectorSearchRetriever(top_k=self.top_k, query_rewrite=True)
+        self.bm25_retriever = CustomBM25Retriever(top_k=self.top_k, backend=bm25_backend)
+        self.query_write_dict = self.embedding_retriever.embedding_cache.rewrite_queries
 
     def _retrieve(self, query: QueryType) -> List[NodeWithScore]:
-        doc_lists = []
-        bm25_search_nodes = CustomBM25Retriever(top_k=self.top_k).retrieve(query.query_str)
-        doc_lists.append([node.text for node in bm25_search_nodes])
+        node_lists = []
+        bm25_search_nodes = self.bm25_retriever.retrieve(query.query_str)
+        node_lists.append(bm25_search_nodes)
         embedding_search_nodes = self.embedding_retriever.retrieve(query.query_str)
-        doc_lists.append([node.text for node in embedding_search_nodes])
+        node_lists.append(embedding_search_nodes)
         # check: need query rewrite
         if len(set([_.id_ for _ in bm25_search_nodes]) & set([_.id_ for _ in embedding_search_nodes])) == 0:
             print(query.query_str)
-            for search_query in self.query_write_dict[query.query_str]:
-                bm25_search_nodes = CustomBM25Retriever(top_k=self.top_k).retrieve(search_query)
-                doc_lists.append([node.text for node in bm25_search_nodes])
+            rewrite_queries = self.query_write_dict[query.query_str]
+            # bm25 for all rewrites in one _msearch round-trip
+            rewrite_bm25_nodes = self.bm25_retriever.multi_retrieve(rewrite_queries)
+            for search_query, bm25_search_nodes in zip(rewrite_queries, rewrite_bm25_nodes):
+                node_lists.append(bm25_search_nodes)
                 embedding_search_nodes = self.embedding_retriever.retrieve(search_query)
-                doc_lists.append([node.text for node in embedding_search_nodes])
+                node_lists.append(embedding_search_nodes)
 
-        # Create a union of all unique documents in the input doc_lists
-        all_documents = set()
-        for doc_list in doc_lists:
-            for doc in doc_list:
-                all_documents.add(doc)
-        # print(all_documents)
-
-        # Initialize the RRF score dictionary for each document
-        rrf_score_dic = {doc: 0.0 for doc in all_documents}
-
-        # Calculate RRF scores for each document
-        for doc_list, weight in zip(doc_lists, [1/len(doc_lists)] * len(doc_lists)):
-            for rank, doc in enumerate(doc_list, start=1):
-                rrf_score = weight * (1 / (rank + self.c))
-                rrf_score_dic[doc] += rrf_score
-
-        # Sort documents by their RRF scores in descending order
-        sorted_documents = sorted(rrf_score_dic.items(), key=itemgetter(1), reverse=True)
-        result = []
-        for sorted_doc in sorted_documents[:self.top_k]:
-            text, score = sorted_doc
-            node_with_score = NodeWithScore(node=TextNode(text=text,
-                                                          id_=text_node_id_mapping[text]),
-                                            score=score)
-            result.append(node_with_score)
-
-        return result
+        # every ranked list gets the same weight in RRF
+        with span("fusion"):
+            fused_nodes = fuse_node_lists(node_lists, weights=[1 / len(node_lists)] * len(node_lists),
+                                          c=self.c, top_k=self.top_k)
+        record_count("fusion", len(fused_nodes))
+        return fused_nodes
 
 
 if __name__ == '__main__':
-    from faiss import IndexFlatIP
     from pprint import pprint
-    faiss_index = IndexFlatIP(1536)
-    ensemble_retriever = QueryRewriteEnsembleRetriever(top_k=3, faiss_index=faiss_index)
+    ensemble_retriever = QueryRewriteEnsembleRetriever(top_k=3)
     query = ""
     t_result = ensemble_retriever.retrieve(str_or_query_bundle=query)
     pprint(t_result)
-    faiss_index.reset()
\ No newline at end of file
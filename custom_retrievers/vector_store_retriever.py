@@ -6,49 +6,56 @@ from llama_index.schema import NodeWithScore
 from llama_index.retrievers import BaseRetriever
 from llama_index.indices.query.schema import QueryType
 
-from preprocess.get_text_id_mapping import text_node_id_mapping
-from utils.build_embedding import EmbeddingCache
+from preprocess.chunk_id_index import get_chunk_id_index
+from utils.index_registry import index_registry
 
 from utils.db_client import get_milvus_client
-from utils.get_text_embedding import get_text_embedding_ada_v2
+from utils.embedding_provider import get_embedding_provider
+from utils.metrics import record_count, span
 from config.config_parser import (
     MILVUS_SIZE, MILVUS_THRESHOLD, RERANK_TOP_N
 )
 
 
 class VectorSearchRetriever(BaseRetriever):
-    def __init__(self, top_k, faiss_index, query_rewrite=False) -> None:
-        self.faiss_index = faiss_index
+    def __init__(self, top_k, query_rewrite=False, embedding_model='text-embedding-ada-002') -> None:
         self.top_k = top_k
-        # get query, corpus embedding cache for simulating query VectorStore
-        self.queries_embedding_dict, self.corpus_embedding, self.corpus = EmbeddingCache().load(
-            query_write=query_rewrite)
-        self.faiss_index.add(self.corpus_embedding)
+        self.embedding_model = embedding_model
+        # get query, corpus embedding cache for simulating query VectorStore,
+        # the faiss index is built once per process and shared by all retrievers
+        vector_index = index_registry.get(embedding_model, query_rewrite=query_rewrite)
+        self.faiss_index = vector_index.faiss_index
+        self.embedding_cache = vector_index.embedding_cache
+        self.corpus_embedding, self.corpus = vector_index.corpus_embedding, vector_index.corpus
 
     def _retrieve(self, query_bundle: QueryType) -> List[NodeWithScore]:
         result = []
         # query embedding data
-        if query_bundle.query_str in self.queries_embedding_dict:
-            query_embedding = self.queries_embedding_dict[query_bundle.query_str]
-        else:
-            query_embedding = get_text_embedding_ada_v2(req_text=query_bundle.query_str)
-
-        distances, doc_indices = self.faiss_index.search(np.array([query_embedding]), self.top_k)
-
-        for i, sent_index in enumerate(doc_indices.tolist()[0]):
+        with span("query_embedding"):
+            query_embedding = self.embedding_cache.get_query_embedding(query_bundle.query_str)
+            if query_embedding is None:
+                query_embedding = get_embedding_provider(self.embedding_model).embed([query_bundle.query_str])[0]
+
+        with span("vector_search"):
+            # cached rows are contiguous float32 views, reshaping them does not copy
+            distances, doc_indices = self.faiss_index.search(query_embedding.reshape(1, -1), self.top_k)
+
+        chunk_id_index = get_chunk_id_index()
+        for distance, sent_index in zip(distances[0].tolist(), doc_indices[0].tolist()):
+            if sent_index < 0:  # ANN indexes return -1 when fewer than top_k candidates are probed
+                continue
             text = self.corpus[sent_index]
-            node_with_score = NodeWithScore(node=TextNode(text=text, id_=text_node_id_mapping[text]),
-                                            score=distances.tolist()[0][i])
+            node_with_score = NodeWithScore(node=TextNode(text=text, id_=chunk_id_index[text]),
+                                            score=distance)
             result.append(node_with_score)
 
+        record_count("vector_search", len(result))
         return result
 
 
 if __name__ == '__main__':
     from pprint import pprint
-    from faiss import IndexFlatIP
-    faiss_index = IndexFlatIP(1536)  # ada-002
-    vector_search_retriever = VectorSearchRetriever(top_k=3, faiss_index=faiss_index)
+    vector_search_retriever = VectorSearchRetriever(top_k=3)
     query = "中国队亚洲杯成绩如何"
     t_result = vector_search_retriever.retrieve(str_or_query_bundle=query)
     pprint(t_result)
@@ -1,98 +1,106 @@
-import cohere
+import asyncio
+from typing import Optional
 
-from utils.db_client import get_milvus_client, get_es_client
+from utils.db_client import get_milvus_client, get_es_client, get_async_es_client
+from utils.resources import resource_manager
+from utils.embedding_provider import get_embedding_provider
 from utils.get_text_embedding import get_text_embedding_v3 as get_text_embedding
-from utils.chat_wrapper import chat_completion
+from utils.chat_wrapper import chat_completion, chat_completion_stream, achat_completion, achat_completion_stream
+from utils.fan_out import fan_out, afan_out, retrieval_executor, rerank_executor
+from utils.rerank import get_cohere_rerank_result, aget_cohere_rerank_result
+from utils.rank_fusion import fuse_documents
+from utils.bm25_index import get_local_bm25_index
+from utils.deadline import Deadline, DeadlineExceeded
 from utils.logger import logger
+from utils.metrics import record_count, span
 
 from config.config_parser import (
     MILVUS_SIZE, MILVUS_THRESHOLD, ES_SIZE,
-    EMBEDDING_API, COHERE_API_KEY, RERANK_TOP_N
+    EMBEDDING_API, RERANK_TOP_N,
+    ES_TIMEOUT, VECTOR_TIMEOUT, BM25_BACKEND,
+    DEADLINE_RERANK_MIN_BUDGET, DEADLINE_LLM_MIN_BUDGET, DEADLINE_RERANK_POLICY, DEADLINE_LLM_POLICY,
+    DEADLINE_FALLBACK_MODEL
 )
 
+QUERY_EMBEDDING_MODEL = "text-embedding-3-small"
+
 
 class DocQA:
-    def __init__(self, query):
+    """
+    Hybrid retrieval QA over Milvus and Elasticsearch.
+
+    Every stage runs within the request `deadline`. The retrieval legs only get the budget left after
+    the reserve for rerank and LLM, a leg that overruns it is dropped. When too little is left, the
+    rerank is skipped (fused order) and the LLM switches to `deadline.fallback_model`, or the request
+    fails with DeadlineExceeded if the policy is `fail`. The degradations are listed in `self.degraded`.
+    """
+    def __init__(self, query, deadline: Optional[Deadline] = None):
         self.query = query
+        self.deadline = deadline or Deadline.from_config()
+        self.degraded = []
 
-    # get search result from vector-store Milvus
-    def get_milvus_search_result(self):
+    @staticmethod
+    def search_milvus(vector_to_search, timeout: Optional[float] = None):
         milvus_client = get_milvus_client("docs_qa")
-        # embedding query
-        vector_to_search = [get_text_embedding(self.query)]
         search_params = {
             "metric_type": "IP",  # or COSINE
             "params": {"nprobe": 10},
         }
         result = milvus_client.search(
-            vector_to_search,
+            [vector_to_search],
             "embeddings",  # queried field
             search_params,
             limit=MILVUS_SIZE,
-            output_fields=["text", "source"]
+            output_fields=["text", "source"],
+            timeout=timeout
         )
 
         # filter by similarity score
         return [(_.entity.get('text'), _.entity.get('source'))
                 for _, dist in zip(result[0], result[0].distances) if dist > MILVUS_THRESHOLD]
 
-    # get search result form Elasticsearch BM25 keyword-search
-    def get_elasticsearch_search_result(self):
-        es_client = get_es_client()
-        result = []
-        dsl = {
+    @staticmethod
+    def search_local_bm25(query):
+        bm25_index = get_local_bm25_index()
+        return [(bm25_index.texts[doc_pos], bm25_index.sources[doc_pos])
+                for doc_pos, _ in bm25_index.search(query, ES_SIZE)]
+
+    @staticmethod
+    def get_es_dsl(query):
+        return {
             "query": {
                 "match": {
-                    "content": self.query
+                    "content": query
                 }
             },
             "size": ES_SIZE
         }
-        search_result = es_client.search(index="docs_qa", body=dsl)
-        if search_result['hits']['hits']:
-            result = [(_['_source']['content'], _['_source']['source']) for _ in search_result['hits']['hits']]
-        return result
-
-    def get_context(self):
-        contents = []
-        milvus_search_result = self.get_milvus_search_result()
-        es_search_result = self.get_elasticsearch_search_result()
-
-        # remove duplicate
-        for content_source_tuple in milvus_search_result + es_search_result:
-            content, source = content_source_tuple
-            if [content, source] not in contents:
-                contents.append([content, source])
-        return contents
 
-    def rerank(self):
-        before_rerank_contents = self.get_context()
+    @staticmethod
+    def parse_es_result(search_result):
+        return [(_['_source']['content'], _['_source']['source']) for _ in search_result['hits']['hits']]
 
-        # rerank using CoHere rerank API
-        cohere_client = cohere.Client(COHERE_API_KEY)
-        docs, sources = [_[0] for _ in before_rerank_contents], [_[1] for _ in before_rerank_contents]
+    @staticmethod
+    def fuse(milvus_search_result, es_search_result):
+        # fuse both legs by RRF on the content digests, which also removes the duplicates
+        return fuse_documents([milvus_search_result, es_search_result])
 
-        results = cohere_client.rerank(
-            model="rerank-multilingual-v2.0",
-            query=self.query,
-            documents=docs,
-            top_n=RERANK_TOP_N
-        )
-        after_rerank_contents = []
-        for hit in results:
-            after_rerank_contents.append([hit.document['text'], sources[hit.index]])
-            logger.info(f"Score: {hit.relevance_score}, query: {self.query}, text: {hit.document['text']}")
+    @staticmethod
+    def dedup_by_text(before_rerank_contents):
+        source_by_text = {}
+        for content, source in before_rerank_contents:
+            source_by_text.setdefault(content, source)
+        return source_by_text
 
-        return after_rerank_contents
-
-    def get_qa_prompt(self):
+    @staticmethod
+    def build_qa_prompt(query, after_rerank_contents):
         # 建立prompt
         prefix = "<文本片段>:\n\n"
-        suffix = f"\n<问题>: {self.query}\n<回答>: "
+        suffix = f"\n<问题>: {query}\n<回答>: "
         prompt = []
         contexts = []
         sources = []
-        for i, text_source_tuple in enumerate(self.rerank()):
+        for i, text_source_tuple in enumerate(after_rerank_contents):
             text, source = text_source_tuple
             prompt.append(f"{i + 1}: {text}\n")
             contexts.append(f"<{i + 1}>: {text}")
@@ -102,11 +110,189 @@ class DocQA:
         logger.info(qa_chain_prompt)
         return qa_chain_prompt, contexts, sources
 
+    def retrieval_timeouts(self):
+        # the retrieval legs leave the minimum budget of rerank and LLM untouched
+        reserve = DEADLINE_RERANK_MIN_BUDGET + DEADLINE_LLM_MIN_BUDGET
+        return {"milvus": self.deadline.timeout(VECTOR_TIMEOUT, reserve=reserve),
+                "es": self.deadline.timeout(ES_TIMEOUT, reserve=reserve)}
+
+    def fuse_legs(self, search_result):
+        # a failed / timed out leg comes back as None and contributes no documents
+        for leg, result in search_result.items():
+            if result is None:
+                self.degraded.append(f"drop_{leg}")
+        with span("fusion"):
+            fused = self.fuse(search_result["milvus"] or [], search_result["es"] or [])
+        record_count("fusion", len(fused))
+        return fused
+
+    def rerank_fits(self) -> bool:
+        return self.deadline.allows(DEADLINE_RERANK_MIN_BUDGET, reserve=DEADLINE_LLM_MIN_BUDGET)
+
+    def skip_rerank(self, source_by_text, reason):
+        """top n of the fused order, or DeadlineExceeded if the rerank policy is `fail`"""
+        if DEADLINE_RERANK_POLICY == 'fail':
+            raise DeadlineExceeded(reason)
+        logger.warning(f"{reason}, skip rerank and keep the fused order")
+        self.degraded.append("skip_rerank")
+        return [[text, source] for text, source in list(source_by_text.items())[:RERANK_TOP_N]]
+
+    def rerank_result(self, source_by_text, rerank_result):
+        record_count("rerank", len(rerank_result))
+        after_rerank_contents = []
+        for text, score in rerank_result:
+            after_rerank_contents.append([text, source_by_text[text]])
+            logger.info(f"Score: {score}, query: {self.query}, text: {text}")
+        return after_rerank_contents
+
+    def choose_model(self, model_name):
+        """`model_name`, or the faster fallback model when less than the LLM minimum budget is left"""
+        self.deadline.check("chat completion")
+        if self.deadline.allows(DEADLINE_LLM_MIN_BUDGET):
+            return model_name
+        if DEADLINE_LLM_POLICY == 'fail':
+            raise DeadlineExceeded(f"{self.deadline.remaining():.2f}s left for chat completion")
+        if DEADLINE_FALLBACK_MODEL and DEADLINE_FALLBACK_MODEL != model_name:
+            logger.warning(f"{self.deadline.remaining():.2f}s left, answer with {DEADLINE_FALLBACK_MODEL} "
+                           f"instead of {model_name}")
+            self.degraded.append(f"fallback_model:{DEADLINE_FALLBACK_MODEL}")
+            return DEADLINE_FALLBACK_MODEL
+        return model_name
+
+    # get search result from vector-store Milvus
+    def get_milvus_search_result(self):
+        # embedding query
+        with span("query_embedding"):
+            vector_to_search = get_text_embedding(self.query)
+        with span("vector_search"):
+            result = self.search_milvus(vector_to_search, self.deadline.timeout(VECTOR_TIMEOUT))
+        record_count("vector_search", len(result))
+        return result
+
+    # get search result form Elasticsearch BM25 keyword-search
+    def get_elasticsearch_search_result(self):
+        with span("bm25_search"):
+            if BM25_BACKEND == 'local':
+                result = self.search_local_bm25(self.query)
+            else:
+                es_client = get_es_client().options(request_timeout=self.deadline.timeout(ES_TIMEOUT))
+                result = self.parse_es_result(es_client.search(index="docs_qa", body=self.get_es_dsl(self.query)))
+        record_count("bm25_search", len(result))
+        return result
+
+    def get_context(self):
+        # search Milvus and Elasticsearch concurrently, a failed or slow leg contributes no documents
+        search_result = fan_out({"milvus": self.get_milvus_search_result,
+                                 "es": self.get_elasticsearch_search_result},
+                                timeout=self.retrieval_timeouts(),
+                                default=None)
+        return self.fuse_legs(search_result)
+
+    def rerank(self):
+        before_rerank_contents = self.get_context()
+
+        # rerank using CoHere rerank API, pairs scored before come from the rerank score cache
+        source_by_text = self.dedup_by_text(before_rerank_contents)
+        if not self.rerank_fits():
+            return self.skip_rerank(source_by_text, f"{self.deadline.remaining():.2f}s left for rerank")
+
+        with span("rerank"):
+            rerank_result = fan_out({"rerank": lambda: get_cohere_rerank_result(self.query, list(source_by_text),
+                                                                                top_n=RERANK_TOP_N)},
+                                    timeout=self.deadline.timeout(reserve=DEADLINE_LLM_MIN_BUDGET),
+                                    executor=rerank_executor)["rerank"]
+        if rerank_result is None:
+            return self.skip_rerank(source_by_text, "rerank failed or did not finish within the deadline")
+        return self.rerank_result(source_by_text, rerank_result)
+
+    def get_qa_prompt(self):
+        after_rerank_contents = self.rerank()
+        with span("prompt_build"):
+            return self.build_qa_prompt(self.query, after_rerank_contents)
+
     def answer(self, model_name):
         message, contexts, sources = self.get_qa_prompt()
-        result = chat_completion(message, model_name)
+        with span("llm"):
+            result = chat_completion(message, self.choose_model(model_name), deadline=self.deadline)
+        return result, contexts, sources
+
+    def answer_stream(self, model_name):
+        """yield the retrieved contexts and sources first, then the answer tokens as they are generated"""
+        message, contexts, sources = self.get_qa_prompt()
+        yield {"event": "contexts", "contexts": contexts, "sources": sources}
+        with span("llm"):
+            for token in chat_completion_stream(message, self.choose_model(model_name), deadline=self.deadline):
+                yield {"event": "token", "content": token}
+
+
+class AsyncDocQA(DocQA):
+    """
+    DocQA for the event loop of the API service.
+
+    Embedding, chat completion, Elasticsearch and Cohere go through async clients, pymilvus (sync only)
+    runs on the bounded resource_manager.milvus_executor and the local BM25 index on the retrieval pool, so one worker
+    serves as many questions at once as their I/O waits allow. The a-prefixed methods mirror DocQA.
+    """
+    async def aget_milvus_search_result(self):
+        with span("query_embedding"):
+            vector_to_search = (await get_embedding_provider(QUERY_EMBEDDING_MODEL).aembed([self.query]))[0].tolist()
+        with span("vector_search"):
+            result = await asyncio.get_running_loop().run_in_executor(resource_manager.milvus_executor,
+                                                                       self.search_milvus, vector_to_search,
+                                                                       self.deadline.timeout(VECTOR_TIMEOUT))
+        record_count("vector_search", len(result))
+        return result
+
+    async def aget_elasticsearch_search_result(self):
+        with span("bm25_search"):
+            if BM25_BACKEND == 'local':
+                result = await asyncio.get_running_loop().run_in_executor(retrieval_executor, self.search_local_bm25,
+                                                                          self.query)
+            else:
+                es_client = get_async_es_client().options(request_timeout=self.deadline.timeout(ES_TIMEOUT))
+                result = self.parse_es_result(await es_client.search(index="docs_qa",
+                                                                     body=self.get_es_dsl(self.query)))
+        record_count("bm25_search", len(result))
+        return result
+
+    async def aget_context(self):
+        search_result = await afan_out({"milvus": self.aget_milvus_search_result,
+                                        "es": self.aget_elasticsearch_search_result},
+                                       timeout=self.retrieval_timeouts(),
+                                       default=None)
+        return self.fuse_legs(search_result)
+
+    async def arerank(self):
+        source_by_text = self.dedup_by_text(await self.aget_context())
+        if not self.rerank_fits():
+            return self.skip_rerank(source_by_text, f"{self.deadline.remaining():.2f}s left for rerank")
+
+        with span("rerank"):
+            rerank_result = (await afan_out({"rerank": lambda: aget_cohere_rerank_result(
+                self.query, list(source_by_text), top_n=RERANK_TOP_N)},
+                timeout=self.deadline.timeout(reserve=DEADLINE_LLM_MIN_BUDGET)))["rerank"]
+        if rerank_result is None:
+            return self.skip_rerank(source_by_text, "rerank failed or did not finish within the deadline")
+        return self.rerank_result(source_by_text, rerank_result)
+
+    async def aget_qa_prompt(self):
+        after_rerank_contents = await self.arerank()
+        with span("prompt_build"):
+            return self.build_qa_prompt(self.query, after_rerank_contents)
+
+    async def aanswer(self, model_name):
+        message, contexts, sources = await self.aget_qa_prompt()
+        with span("llm"):
+            result = await achat_completion(message, self.choose_model(model_name), deadline=self.deadline)
         return result, contexts, sources
 
+    async def aanswer_stream(self, model_name):
+        message, contexts, sources = await self.aget_qa_prompt()
+        yield {"event": "contexts", "contexts": contexts, "sources": sources}
+        with span("llm"):
+            async for token in achat_completion_stream(message, self.choose_model(model_name), deadline=self.deadline):
+                yield {"event": "token", "content": token}
+
 
 if __name__ == '__main__':
     test_model_name = "gpt-3.5-turbo"
@@ -114,3 +300,5 @@ if __name__ == '__main__':
     question = '请简要介绍中国队亚洲杯成绩，100字以内'
     reply = DocQA(question).answer(model_name=test_model_name)
     print(reply)
+    reply = asyncio.run(AsyncDocQA(question).aanswer(model_name=test_model_name))
+    print(reply)
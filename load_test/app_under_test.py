@@ -0,0 +1,67 @@
+"""
+services/api.py wired to the local upstream stand-ins of load_test/fake_upstreams.py.
+
+The config constants are overridden before services.api is imported, so every client the
+resource_manager creates points at LOAD_TEST_UPSTREAM_URL: Elasticsearch via ES_URL, the chat
+completions via CHAT_COMPLETION_API, the openai / cohere SDKs via OPENAI_BASE_URL / CO_API_URL.
+pymilvus talks gRPC, so `DocQA.search_milvus` is replaced by a blocking stand-in that sleeps the
+`milvus` latency of the profile; it still runs on resource_manager.milvus_executor, so the executor
+bound and the thread hops are measured as in production. The local bge models are only loaded with
+LOAD_TEST_LOCAL_MODELS=1.
+
+    LOAD_TEST_UPSTREAM_URL=http://127.0.0.1:9100 uvicorn load_test.app_under_test:app --workers 4
+"""
+import os
+import time
+import random
+from typing import Optional
+
+from pymilvus import MilvusException
+
+import config.config_parser as config_parser
+
+UPSTREAM_URL = os.getenv("LOAD_TEST_UPSTREAM_URL", "http://127.0.0.1:9100").rstrip("/")
+
+os.environ.setdefault("OPENAI_API_KEY", "load-test")
+os.environ.setdefault("COHERE_API_KEY", "load-test")
+os.environ["OPENAI_BASE_URL"] = f"{UPSTREAM_URL}/openai/v1"
+os.environ["CO_API_URL"] = f"{UPSTREAM_URL}/cohere"
+config_parser.OPENAI_API_KEY = config_parser.OPENAI_API_KEY or "load-test"
+config_parser.COHERE_API_KEY = config_parser.COHERE_API_KEY or "load-test"
+config_parser.ES_URL = UPSTREAM_URL
+config_parser.CHAT_COMPLETION_API = f"{UPSTREAM_URL}/openai/v1/chat/completions"
+# the stand-ins have no milvus to check, /health still reports it
+config_parser.RESOURCE_HEALTH_CHECK = False
+
+from doc_qa_rag_hybrid import DocQA  # noqa: E402
+from load_test.fake_upstreams import load_profile, sample_latency, should_fail  # noqa: E402
+from services import api  # noqa: E402
+
+MILVUS_SPEC = load_profile().get("milvus", {})
+
+
+def fake_search_milvus(vector_to_search, timeout: Optional[float] = None):
+    latency = sample_latency(MILVUS_SPEC)
+    if timeout is not None and latency > timeout:
+        time.sleep(timeout)
+        raise MilvusException(message=f"search timed out after {timeout:.3f}s")
+    time.sleep(latency)
+    if should_fail(MILVUS_SPEC):
+        raise MilvusException(message="injected milvus error")
+    hits = min(config_parser.MILVUS_SIZE, MILVUS_SPEC.get("hits", 5))
+    seed = random.randrange(1 << 16)
+    return [(f"milvus 文档 {seed}-{i}", f"load_test_milvus_{i}.txt") for i in range(hits)]
+
+
+DocQA.search_milvus = staticmethod(fake_search_milvus)
+
+if os.getenv("LOAD_TEST_LOCAL_MODELS", "0") != "1":
+    # the bge models would dominate the startup of every worker, /embedding only uses the openai models
+    api.app.router.on_startup.remove(api.load_local_models)
+    api.app.router.on_shutdown.remove(api.close_local_models)
+
+if os.getenv("LOAD_TEST_UPLOAD_DIR"):
+    api.upload_dir = os.getenv("LOAD_TEST_UPLOAD_DIR")
+    os.makedirs(api.upload_dir, exist_ok=True)
+
+app = api.app
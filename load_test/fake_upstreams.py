@@ -0,0 +1,179 @@
+"""
+Local stand-ins for the upstreams of services/api.py, for load testing without external services.
+
+One FastAPI app serves the OpenAI embeddings / chat completions API under /openai, the Cohere rerank
+API under /cohere and the Elasticsearch ping / search API at the root. Every route waits a latency
+drawn from its upstream profile in load_test/upstreams.yml (or LOAD_TEST_UPSTREAMS) and fails with
+the configured error rate, so the tail latency and the error handling of the service can be tested:
+
+    uvicorn load_test.fake_upstreams:app --port 9100
+
+Embeddings are deterministic unit vectors seeded by the text, responses only have the fields the
+openai / cohere / elasticsearch clients read.
+"""
+import os
+import json
+import time
+import asyncio
+import hashlib
+import random
+from typing import Optional
+
+import numpy as np
+import yaml
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+PROFILE_PATH = os.getenv("LOAD_TEST_UPSTREAMS", os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                "upstreams.yml"))
+EMBEDDING_DIMENSIONS = {"text-embedding-ada-002": 1536, "text-embedding-3-small": 1536,
+                        "text-embedding-3-large": 3072}
+# z value of the 99th percentile of the standard normal distribution
+Z_99 = 2.326
+
+
+def load_profile(path: str = PROFILE_PATH) -> dict:
+    with open(path, encoding="utf-8") as f:
+        return yaml.safe_load(f) or {}
+
+
+def sample_latency(spec: dict, rng: random.Random = random) -> float:
+    """seconds, lognormal with the median and p99 of `spec`, constant if they are equal"""
+    median = spec.get("median_ms", 0) / 1000
+    p99 = max(spec.get("p99_ms", 0) / 1000, median)
+    if median <= 0:
+        return 0.0
+    sigma = np.log(p99 / median) / Z_99
+    return median * float(np.exp(sigma * rng.gauss(0, 1)))
+
+
+def should_fail(spec: dict, rng: random.Random = random) -> bool:
+    return rng.random() < spec.get("error_rate", 0.0)
+
+
+profile = load_profile()
+app = FastAPI(title="load test upstream stand-ins")
+
+
+def error_response(spec: dict) -> JSONResponse:
+    status = spec.get("error_status", 500)
+    headers = {"Retry-After": str(spec.get("retry_after", 1))} if status == 429 else None
+    return JSONResponse({"error": {"message": f"injected {status}", "type": "load_test"}}, status_code=status,
+                        headers=headers)
+
+
+async def simulate(name: str) -> Optional[JSONResponse]:
+    """wait the latency of upstream `name`, the error response if this call fails"""
+    spec = profile.get(name, {})
+    await asyncio.sleep(sample_latency(spec))
+    return error_response(spec) if should_fail(spec) else None
+
+
+def fake_embedding(text: str, dimensions: int) -> list:
+    seed = int.from_bytes(hashlib.md5(text.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dimensions)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+@app.middleware("http")
+async def elastic_product_header(request: Request, call_next):
+    # elasticsearch-py 8 refuses responses without this header
+    response = await call_next(request)
+    response.headers["X-Elastic-Product"] = "Elasticsearch"
+    return response
+
+
+################# OpenAI ###############
+@app.post("/openai/v1/embeddings")
+async def embeddings(request: Request):
+    error = await simulate("openai_embedding")
+    if error:
+        return error
+    body = await request.json()
+    texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+    dimensions = body.get("dimensions") or EMBEDDING_DIMENSIONS.get(body.get("model"), 1536)
+    tokens = sum(len(str(text)) for text in texts)
+    return {
+        "object": "list", "model": body.get("model"),
+        "data": [{"object": "embedding", "index": i, "embedding": fake_embedding(str(text), dimensions)}
+                 for i, text in enumerate(texts)],
+        "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+    }
+
+
+@app.post("/openai/v1/chat/completions")
+async def chat_completions(request: Request):
+    error = await simulate("openai_chat")
+    if error:
+        return error
+    body = await request.json()
+    spec = profile.get("openai_chat", {})
+    tokens = spec.get("tokens", 60)
+    prompt_tokens = sum(len(message.get("content") or "") for message in body.get("messages", []))
+    completion_id = f"chatcmpl-{hashlib.md5(str(time.time_ns()).encode()).hexdigest()[:12]}"
+    if not body.get("stream"):
+        return {
+            "id": completion_id, "object": "chat.completion", "created": int(time.time()), "model": body.get("model"),
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": "答案" * tokens}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": tokens,
+                      "total_tokens": prompt_tokens + tokens},
+        }
+
+    async def stream():
+        # the sampled latency above is the time to the first token
+        for i in range(tokens):
+            if i:
+                await asyncio.sleep(spec.get("token_interval_ms", 20) / 1000)
+            chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": body.get("model"),
+                     "choices": [{"index": 0, "delta": {"content": "答案"}, "finish_reason": None}]}
+            yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+
+################# Cohere ###############
+@app.post("/cohere/v1/rerank")
+async def rerank(request: Request):
+    error = await simulate("cohere_rerank")
+    if error:
+        return error
+    body = await request.json()
+    documents = body.get("documents", [])
+    scores = [int(hashlib.md5(f"{body.get('query')}{document}".encode("utf-8")).hexdigest()[:8], 16) / 0xffffffff
+              for document in documents]
+    ranked = sorted(range(len(documents)), key=lambda i: scores[i], reverse=True)[:body.get("top_n") or len(documents)]
+    return {"id": hashlib.md5(str(time.time_ns()).encode()).hexdigest(),
+            "results": [{"index": i, "relevance_score": scores[i]} for i in ranked],
+            "meta": {"api_version": {"version": "1"}}}
+
+
+################# Elasticsearch ###############
+ES_INFO = {"name": "load-test", "cluster_name": "load-test", "tagline": "You Know, for Search",
+           "version": {"number": "8.11.1", "build_flavor": "default"}}
+
+
+@app.head("/")
+async def es_ping():
+    return Response(status_code=200, media_type="application/json")
+
+
+@app.get("/")
+async def es_info():
+    return ES_INFO
+
+
+@app.post("/{index}/_search")
+async def es_search(index: str, request: Request):
+    error = await simulate("elasticsearch")
+    if error:
+        return error
+    body = await request.json()
+    query = json.dumps(body.get("query", {}), ensure_ascii=False)
+    hits = [{"_index": index, "_id": str(i), "_score": 10.0 - i,
+             "_source": {"content": f"{index} 文档 {i}: {query[:64]}", "source": f"load_test_{i}.txt"}}
+            for i in range(min(body.get("size", 10), profile.get("elasticsearch", {}).get("hits", 5)))]
+    return {"took": 1, "timed_out": False, "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+            "hits": {"total": {"value": len(hits), "relation": "eq"}, "max_score": 10.0, "hits": hits}}
@@ -0,0 +1,290 @@
+"""
+Open-loop load test of services/api.py against the local upstream stand-ins.
+
+Starts load_test/fake_upstreams.py, then for every --workers count the API (load_test/app_under_test.py)
+under uvicorn, and drives every --rps rate for --duration seconds. Requests are sent on a fixed
+(or Poisson) schedule whether or not the earlier ones have answered, and latency is measured from
+the scheduled send time, so a saturated service shows up as growing latency instead of a lower
+request rate (no coordinated omission). The traffic mixes /api/doc_qa, /embedding and
+/api/upload-files by --mix weights; a GET / probe alongside measures how long the event loop stalls.
+
+Per worker count and rate the report has p50 / p95 / p99, error rate and achieved rate per endpoint.
+The saturation point is the highest rate still within --slo-p95-ms and --max-error-rate that was
+also sent on time:
+
+    python -m load_test.run_load_test --workers 1 2 4 --rps 5 10 20 40 --duration 30
+    python -m load_test.run_load_test --mix doc_qa=1 --rps 50 --upstreams my_upstreams.yml
+"""
+import os
+import sys
+import csv
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import httpx
+import numpy as np
+
+from config.config_parser import PROJECT_DIR
+from utils.logger import logger
+
+ENDPOINTS = ("doc_qa", "embedding", "upload")
+OUTPUT_PREFIX = os.path.join(PROJECT_DIR, "data/benchmark/load_test_latest")
+PROBE_INTERVAL = 0.1
+
+
+def parse_mix(items: List[str]) -> Dict[str, float]:
+    mix = {}
+    for item in items:
+        name, _, weight = item.partition("=")
+        if name not in ENDPOINTS:
+            raise argparse.ArgumentTypeError(f"unknown endpoint {name}, choose from {ENDPOINTS}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def start_server(target: str, port: int, workers: int, env: dict) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, "-m", "uvicorn", target, "--host", "127.0.0.1", "--port", str(port),
+                             "--workers", str(workers), "--log-level", "warning"], cwd=PROJECT_DIR, env=env)
+
+
+def wait_ready(url: str, process: subprocess.Popen, timeout: float = 120):
+    start = time.monotonic()
+    while time.monotonic() - start < timeout:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with {process.returncode} during startup")
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise TimeoutError(f"{url} not ready after {timeout}s")
+
+
+def stop_server(process: subprocess.Popen):
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+class LoadDriver:
+    """open-loop traffic at one rate against a running service"""
+    def __init__(self, base_url: str, mix: Dict[str, float], prompt_pool: int = 0,
+                 timeout: float = 60, poisson: bool = False, seed: int = 0):
+        self.base_url = base_url
+        self.endpoints, self.weights = list(mix), list(mix.values())
+        self.prompt_pool = prompt_pool
+        self.timeout = timeout
+        self.poisson = poisson
+        self.rng = random.Random(seed)
+        self.sequence = 0
+
+    def next_text(self) -> str:
+        # unique questions by default, so the answer / embedding caches do not hide the upstream calls
+        self.sequence += 1
+        n = self.rng.randrange(self.prompt_pool) if self.prompt_pool else self.sequence
+        return f"压测问题 {n}: 如何配置混合检索的召回数量?"
+
+    async def send(self, client: httpx.AsyncClient, endpoint: str) -> bool:
+        """True if the request succeeded"""
+        text = self.next_text()
+        if endpoint == "doc_qa":
+            response = await client.post("/api/doc_qa", params={"prompt": text})
+            # the QA endpoint answers 200 with status fail on errors
+            return response.status_code == 200 and response.json().get("status") == "success"
+        if endpoint == "embedding":
+            response = await client.post("/embedding", json={"text": text})
+            return response.status_code == 200
+        response = await client.post("/api/upload-files",
+                                     files={"files": (f"load_test_{self.sequence % 100}.txt", text.encode("utf-8") * 64)})
+        return response.status_code == 200
+
+    async def timed(self, client: httpx.AsyncClient, endpoint: str, scheduled: float, results: list):
+        try:
+            ok = await self.send(client, endpoint)
+        except Exception as e:
+            logger.debug(f"{endpoint} request failed: {e!r}")
+            ok = False
+        results.append((endpoint, (time.perf_counter() - scheduled) * 1000, ok))
+
+    async def probe(self, client: httpx.AsyncClient, stop: asyncio.Event, stalls: list):
+        while not stop.is_set():
+            start = time.perf_counter()
+            try:
+                await client.get("/")
+                stalls.append((time.perf_counter() - start) * 1000)
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(PROBE_INTERVAL)
+
+    async def run(self, rps: float, duration: float) -> dict:
+        limits = httpx.Limits(max_connections=None, max_keepalive_connections=256)
+        async with httpx.AsyncClient(base_url=self.base_url, timeout=self.timeout, limits=limits) as client:
+            results, stalls, lags, tasks = [], [], [], []
+            stop = asyncio.Event()
+            probe = asyncio.ensure_future(self.probe(client, stop, stalls))
+            start = time.perf_counter()
+            scheduled = start
+            while scheduled - start < duration:
+                now = time.perf_counter()
+                if scheduled > now:
+                    await asyncio.sleep(scheduled - now)
+                lags.append((time.perf_counter() - scheduled) * 1000)
+                endpoint = self.rng.choices(self.endpoints, self.weights)[0]
+                tasks.append(asyncio.ensure_future(self.timed(client, endpoint, scheduled, results)))
+                scheduled += self.rng.expovariate(rps) if self.poisson else 1 / rps
+            send_s = time.perf_counter() - start
+            await asyncio.gather(*tasks)
+            stop.set()
+            await probe
+        return summarize(results, stalls, lags, rps, send_s, time.perf_counter() - start)
+
+
+def percentiles(latencies: List[float]) -> dict:
+    if not latencies:
+        return {"p50_ms": None, "p95_ms": None, "p99_ms": None, "max_ms": None}
+    values = np.array(latencies)
+    return {"p50_ms": float(np.percentile(values, 50)), "p95_ms": float(np.percentile(values, 95)),
+            "p99_ms": float(np.percentile(values, 99)), "max_ms": float(values.max())}
+
+
+def summarize(results: list, stalls: List[float], lags: List[float], rps: float, send_s: float,
+              wall_s: float) -> dict:
+    by_endpoint = defaultdict(list)
+    for endpoint, latency, ok in results:
+        by_endpoint[endpoint].append((latency, ok))
+    by_endpoint["all"] = [(latency, ok) for _, latency, ok in results]
+
+    summary = {"target_rps": rps, "sent": len(results), "sent_rps": len(results) / send_s,
+               "completed_rps": len(results) / wall_s,
+               "send_lag_p99_ms": float(np.percentile(lags, 99)) if lags else 0.0,
+               "loop_probe": percentiles(stalls), "endpoints": {}}
+    for endpoint, rows in by_endpoint.items():
+        errors = sum(not ok for _, ok in rows)
+        summary["endpoints"][endpoint] = {
+            "requests": len(rows), "errors": errors, "error_rate": errors / len(rows) if rows else 0.0,
+            # failed requests often return early, they are left out of the latency percentiles
+            **percentiles([latency for latency, ok in rows if ok]),
+        }
+    return summary
+
+
+def within_slo(summary: dict, slo_p95_ms: float, max_error_rate: float) -> bool:
+    overall = summary["endpoints"]["all"]
+    return (overall["p95_ms"] is not None and overall["p95_ms"] <= slo_p95_ms
+            and overall["error_rate"] <= max_error_rate
+            # the driver itself fell behind, the rate was not really offered
+            and summary["sent_rps"] >= 0.95 * summary["target_rps"])
+
+
+def saturation_point(runs: List[dict], slo_p95_ms: float, max_error_rate: float) -> Optional[float]:
+    """highest rate within the SLO, below the first rate that breaks it"""
+    best = None
+    for run in sorted(runs, key=lambda run: run["target_rps"]):
+        if not within_slo(run, slo_p95_ms, max_error_rate):
+            break
+        best = run["target_rps"]
+    return best
+
+
+def write_report(report: dict, prefix: str):
+    os.makedirs(os.path.dirname(prefix), exist_ok=True)
+    with open(f"{prefix}.json", "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    fieldnames = ["workers", "target_rps", "sent_rps", "completed_rps", "endpoint", "requests", "errors",
+                  "error_rate", "p50_ms", "p95_ms", "p99_ms", "max_ms", "loop_probe_p99_ms"]
+    with open(f"{prefix}.csv", "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        for workers in report["results"]:
+            for run in workers["runs"]:
+                for endpoint, stats in run["endpoints"].items():
+                    writer.writerow({"workers": workers["workers"], "target_rps": run["target_rps"],
+                                     "sent_rps": run["sent_rps"], "completed_rps": run["completed_rps"],
+                                     "endpoint": endpoint, "loop_probe_p99_ms": run["loop_probe"]["p99_ms"],
+                                     **stats})
+    logger.info(f"load test report written to {prefix}.json / {prefix}.csv")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="open-loop load test of the API service against local upstream stand-ins")
+    parser.add_argument("--workers", nargs="+", type=int, default=[1], help="uvicorn worker counts to test")
+    parser.add_argument("--rps", nargs="+", type=float, default=[5, 10, 20], help="target request rates, ascending")
+    parser.add_argument("--duration", type=float, default=30, help="seconds per rate")
+    parser.add_argument("--mix", nargs="+", default=["doc_qa=8", "embedding=3", "upload=1"],
+                        help="endpoint weights, endpoint=weight")
+    parser.add_argument("--poisson", action="store_true", help="exponential inter-arrival times instead of fixed")
+    parser.add_argument("--prompt-pool", type=int, default=0,
+                        help="draw questions from n distinct ones (cache hits), 0 for all unique")
+    parser.add_argument("--upstreams", default=None, help="upstream latency / error profile, default load_test/upstreams.yml")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--upstream-port", type=int, default=9100)
+    parser.add_argument("--timeout", type=float, default=60, help="client timeout of one request")
+    parser.add_argument("--slo-p95-ms", type=float, default=5000)
+    parser.add_argument("--max-error-rate", type=float, default=0.01)
+    parser.add_argument("--cooldown", type=float, default=2, help="seconds between two rates")
+    parser.add_argument("--output", default=OUTPUT_PREFIX, help="report path without the .json / .csv suffix")
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    upstream_url = f"http://127.0.0.1:{args.upstream_port}"
+    python_path = os.pathsep.join(filter(None, [PROJECT_DIR, os.getenv("PYTHONPATH")]))
+    env = dict(os.environ, PYTHONPATH=python_path, LOAD_TEST_UPSTREAM_URL=upstream_url,
+               LOAD_TEST_UPLOAD_DIR=tempfile.mkdtemp(prefix="load_test_upload_"))
+    if args.upstreams:
+        env["LOAD_TEST_UPSTREAMS"] = os.path.abspath(args.upstreams)
+
+    upstreams = start_server("load_test.fake_upstreams:app", args.upstream_port, 1, env)
+    results = []
+    try:
+        wait_ready(f"{upstream_url}/", upstreams)
+        for workers in args.workers:
+            service = start_server("load_test.app_under_test:app", args.port, workers, env)
+            try:
+                wait_ready(f"http://127.0.0.1:{args.port}/", service)
+                runs = []
+                for rps in args.rps:
+                    logger.info(f"{workers} worker(s), {rps} rps for {args.duration}s")
+                    driver = LoadDriver(f"http://127.0.0.1:{args.port}", mix, args.prompt_pool, args.timeout,
+                                        args.poisson, seed=int(rps * 1000) + workers)
+                    runs.append(asyncio.run(driver.run(rps, args.duration)))
+                    time.sleep(args.cooldown)
+                results.append({"workers": workers, "runs": runs,
+                                "saturation_rps": saturation_point(runs, args.slo_p95_ms, args.max_error_rate)})
+            finally:
+                stop_server(service)
+    finally:
+        stop_server(upstreams)
+
+    report = {
+        "config": {"workers": args.workers, "rps": args.rps, "duration": args.duration, "mix": mix,
+                   "poisson": args.poisson, "prompt_pool": args.prompt_pool, "slo_p95_ms": args.slo_p95_ms,
+                   "max_error_rate": args.max_error_rate, "upstreams": args.upstreams or "load_test/upstreams.yml",
+                   "created_at": time.strftime("%Y-%m-%d %H:%M:%S")},
+        "results": results,
+    }
+    write_report(report, args.output)
+
+    for workers in results:
+        for run in workers["runs"]:
+            for endpoint, stats in run["endpoints"].items():
+                p95 = f"{stats['p95_ms']:8.1f}ms" if stats["p95_ms"] is not None else "       -  "
+                print(f"workers: {workers['workers']:>2}  rps: {run['target_rps']:6.1f} (sent {run['sent_rps']:6.1f})  "
+                      f"{endpoint:>9}  p95: {p95}  errors: {stats['error_rate']:6.1%}")
+        saturation = workers["saturation_rps"]
+        print(f"workers: {workers['workers']:>2}  saturation point: "
+              f"{f'{saturation} rps' if saturation is not None else 'below the lowest rate'}")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,94 @@
+import os
+import json
+import threading
+from hashlib import blake2b
+from typing import Dict, Optional
+
+import numpy as np
+
+from config.config_parser import PROJECT_DIR
+
+
+DATASET_PATH = os.path.join(PROJECT_DIR, 'data/doc_qa_dataset.json')
+INDEX_PATH = os.path.join(PROJECT_DIR, 'data/chunk_id_index.npy')
+
+
+def content_digest(text: str) -> int:
+    """fixed-size (64 bit) digest of a chunk text"""
+    return int.from_bytes(blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class ChunkIdIndex:
+    """
+    Compact chunk text -> node id index.
+
+    Keeps a sorted uint64 array of content digests plus the node ids in the same order,
+    lookups hash the text and binary search the digests, so no chunk text is held in memory.
+    Both arrays are persisted together as one structured .npy file, replaced atomically on save and
+    memory-mapped on load, so a reader never pairs the digests of one build with the node ids of another.
+    """
+    def __init__(self, digests: np.ndarray, node_ids: np.ndarray):
+        self.digests = digests
+        self.node_ids = node_ids
+
+    @classmethod
+    def build(cls, node_id_text_mapping: Dict[str, str]) -> "ChunkIdIndex":
+        digests = np.fromiter((content_digest(text) for text in node_id_text_mapping.values()),
+                              dtype=np.uint64, count=len(node_id_text_mapping))
+        node_ids = np.array([node_id.encode('utf-8') for node_id in node_id_text_mapping], dtype=np.bytes_)
+        order = np.argsort(digests, kind='stable')
+        return cls(digests[order], node_ids[order])
+
+    def save(self, path: str = INDEX_PATH):
+        records = np.empty(len(self.digests), dtype=[('digest', np.uint64), ('node_id', self.node_ids.dtype)])
+        records['digest'], records['node_id'] = self.digests, self.node_ids
+        # write to a temp file first, concurrently starting workers never map a half written index
+        tmp_path = f"{os.path.splitext(path)[0]}.{os.getpid()}.tmp.npy"
+        np.save(tmp_path, records)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str = INDEX_PATH) -> "ChunkIdIndex":
+        records = np.load(path, mmap_mode='r')
+        return cls(records['digest'], records['node_id'])
+
+    def get(self, text: str, default: Optional[str] = None) -> Optional[str]:
+        digest = np.uint64(content_digest(text))
+        pos = int(np.searchsorted(self.digests, digest))
+        if pos < len(self.digests) and self.digests[pos] == digest:
+            return self.node_ids[pos].decode('utf-8')
+        return default
+
+    def __getitem__(self, text: str) -> str:
+        node_id = self.get(text)
+        if node_id is None:
+            raise KeyError(text[:50])
+        return node_id
+
+    def __contains__(self, text: str) -> bool:
+        return self.get(text) is not None
+
+    def __len__(self):
+        return len(self.digests)
+
+
+_chunk_id_index: Optional[ChunkIdIndex] = None
+_lock = threading.Lock()
+
+
+def get_chunk_id_index() -> ChunkIdIndex:
+    """load the index on first use, (re)building it when doc_qa_dataset.json is newer than the persisted one"""
+    global _chunk_id_index
+    if _chunk_id_index is None:
+        with _lock:
+            if _chunk_id_index is None:
+                if not os.path.exists(INDEX_PATH) or os.path.getmtime(INDEX_PATH) < os.path.getmtime(DATASET_PATH):
+                    with open(DATASET_PATH, 'r', encoding="utf-8") as f:
+                        ChunkIdIndex.build(json.loads(f.read())['corpus']).save()
+                _chunk_id_index = ChunkIdIndex.load()
+    return _chunk_id_index
+
+
+if __name__ == '__main__':
+    chunk_id_index = get_chunk_id_index()
+    print(f"{len(chunk_id_index)} chunks indexed")
@@ -4,12 +4,13 @@ from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.text_splitter import SpacyTextSplitter
 
 from utils.db_client import get_milvus_client, get_es_client
-from utils.get_text_embedding import get_text_embedding_ada_v2 as get_text_embedding
+from utils.embedding_provider import get_embedding_provider
 from utils.logger import logger
+from utils.bm25_index import get_local_bm25_index
+from utils.corpus_version import bump_corpus_version
+from config.config_parser import BM25_BACKEND
 from file_parser import FileParser
 
-from retry import retry
-
 
 class DataProcessor(object):
     """
@@ -33,24 +34,15 @@ class DataProcessor(object):
         return texts
 
     @staticmethod
-    @retry(exceptions=Exception, tries=3, max_delay=60)
     def text_embedding(texts):
-        # calc embeddings 
+        # calc embeddings in batched requests
         # return [ids, source_metadata, origin_content, embedding] to store
-        _ids = []
-        sources = []
-        contents = []
-        embeddings = []
-        for i, text in enumerate(texts):
-            source = text.metadata['source']
-            content = text.page_content
-            content = content.replace('\n', '')
-            embedding = get_text_embedding(content)
-            _ids.append(i + 1)
-            sources.append(source)
-            contents.append(content)
-            embeddings.append(embedding)
-            logger.info(f'source: {source}, got text {i} embedding...')
+        _ids = [i + 1 for i in range(len(texts))]
+        sources = [text.metadata['source'] for text in texts]
+        contents = [text.page_content.replace('\n', '') for text in texts]
+        # chunks are not queries, keep them out of the query embedding cache
+        embeddings = get_embedding_provider("text-embedding-ada-002").embed(contents, use_cache=False).tolist()
+        logger.info(f'got {len(embeddings)} text embeddings from sources: {set(sources)}')
         datas = [_ids, sources, contents, embeddings]
         return datas
 
@@ -74,6 +66,14 @@ class DataProcessor(object):
         else:
             logger.info("no insert data!")
 
+    @staticmethod
+    def local_bm25_insert(datas):
+        # append chunks to the in-process bm25 index and persist it
+        bm25_index = get_local_bm25_index()
+        bm25_index.add(datas[2], datas[1])
+        bm25_index.save()
+        logger.info(f"Docs data have inserted into local bm25 index, total chunks: {len(bm25_index)}")
+
     @staticmethod
     def milvus_data_insert(datas):
         milvus_client = get_milvus_client("docs_qa")
@@ -87,8 +87,13 @@ class DataProcessor(object):
         documents, file_type = self.text_loader()
         texts = self.text_spliter(documents)
         datas = self.text_embedding(texts)
-        self.es_data_insert(datas, file_type)
+        if BM25_BACKEND == 'local':
+            self.local_bm25_insert(datas)
+        else:
+            self.es_data_insert(datas, file_type)
         self.milvus_data_insert(datas)
+        # invalidates the cached answers of every process
+        bump_corpus_version()
 
 
 if __name__ == '__main__':
@@ -1,16 +1,29 @@
 import os
 import json
+from functools import lru_cache
 
 current_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
-with open(os.path.join(current_dir, 'data/doc_qa_dataset.json'), 'r', encoding="utf-8") as f:
-    content = json.loads(f.read())
 
-queries = list(content['queries'].values())
-query_relevant_docs = {content['queries'][k]: v for k, v in content['relevant_docs'].items()}
-node_id_text_mapping = content['corpus']
-text_node_id_mapping = {v: k for k, v in node_id_text_mapping.items()}
+@lru_cache(maxsize=1)
+def load_dataset():
+    # parsed lazily on first attribute access instead of at import time
+    with open(os.path.join(current_dir, 'data/doc_qa_dataset.json'), 'r', encoding="utf-8") as f:
+        content = json.loads(f.read())
+
+    return {
+        "queries": list(content['queries'].values()),
+        "query_relevant_docs": {content['queries'][k]: v for k, v in content['relevant_docs'].items()},
+        "node_id_text_mapping": content['corpus'],
+    }
+
+
+def __getattr__(name):
+    # chunk text -> node id lookups go through preprocess.chunk_id_index instead of a text keyed dict
+    if name in ("queries", "query_relevant_docs", "node_id_text_mapping"):
+        return load_dataset()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 if __name__ == '__main__':
-    text_node_id_mapping
\ No newline at end of file
+    print(len(load_dataset()["node_id_text_mapping"]))
@@ -0,0 +1,188 @@
+"""
+Offline retrieval benchmark over doc_qa_dataset.json.
+
+Runs every custom retriever over every dataset query and reports HitRate@k, MRR, p50 / p95 / p99 latency
+and throughput per retriever. No external service is needed: vector search uses the cached .npy
+embeddings (faiss), BM25 the local index built from the dataset corpus instead of Elasticsearch, and
+the rerank retriever the local bge cross-encoder instead of the Cohere API.
+
+The report is written as JSON and CSV, and compared against a stored baseline if one exists:
+
+    python retrieval_benchmark.py --top-k 3
+    python retrieval_benchmark.py --retrievers bm25 vector --limit 100
+    python retrieval_benchmark.py --update-baseline
+"""
+import os
+import csv
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import numpy as np
+
+from config.config_parser import PROJECT_DIR
+from preprocess.get_text_id_mapping import load_dataset
+from utils.logger import logger
+
+RETRIEVERS = ("bm25", "vector", "ensemble", "ensemble_rerank", "query_rewrite_ensemble")
+BENCHMARK_DIR = os.path.join(PROJECT_DIR, "data/benchmark")
+BASELINE_PATH = os.path.join(BENCHMARK_DIR, "retrieval_baseline.json")
+OUTPUT_PREFIX = os.path.join(BENCHMARK_DIR, "retrieval_latest")
+
+
+def build_retriever(name: str, top_k: int):
+    # imported here, every retriever pulls in its own index / model on construction
+    if name == "bm25":
+        from custom_retrievers.bm25_retriever import CustomBM25Retriever
+        return CustomBM25Retriever(top_k=top_k, backend='local')
+    if name == "vector":
+        from custom_retrievers.vector_store_retriever import VectorSearchRetriever
+        return VectorSearchRetriever(top_k=top_k)
+    if name == "ensemble":
+        from custom_retrievers.ensemble_retriever import EnsembleRetriever
+        return EnsembleRetriever(top_k=top_k, weights=[0.5, 0.5], bm25_backend='local')
+    if name == "ensemble_rerank":
+        from custom_retrievers.ensemble_rerank_retirever import EnsembleRerankRetriever
+        return EnsembleRerankRetriever(top_k=top_k, bm25_backend='local', reranker='bge')
+    if name == "query_rewrite_ensemble":
+        from custom_retrievers.query_rewrite_retriever import QueryRewriteEnsembleRetriever
+        return QueryRewriteEnsembleRetriever(top_k=top_k, bm25_backend='local')
+    raise ValueError(f"unknown retriever {name}, choose from {RETRIEVERS}")
+
+
+def retrieve_timed(retriever, query: str, top_k: int):
+    """(latency ms, retrieved node ids, failed)"""
+    t1 = time.perf_counter()
+    try:
+        node_ids, failed = [node.node_id for node in retriever.retrieve(query)][:top_k], False
+    except Exception as e:
+        logger.error(f"retrieval failed for query: {query}, error: {e!r}")
+        node_ids, failed = [], True
+    return (time.perf_counter() - t1) * 1000, node_ids, failed
+
+
+def evaluate_retriever(name: str, queries: List[str], query_relevant_docs: Dict[str, List[str]],
+                       top_k: int, concurrency: int = 1) -> dict:
+    t1 = time.perf_counter()
+    retriever = build_retriever(name, top_k)
+    # the first query loads the lazily built indexes and models, it is not measured
+    retrieve_timed(retriever, queries[0], top_k)
+    setup_s = time.perf_counter() - t1
+
+    t1 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda query: retrieve_timed(retriever, query, top_k), queries))
+    wall_s = time.perf_counter() - t1
+
+    hits, reciprocal_ranks = 0, 0.0
+    for query, (_, node_ids, _) in zip(queries, results):
+        relevant_docs = set(query_relevant_docs[query])
+        for rank, node_id in enumerate(node_ids, 1):
+            if node_id in relevant_docs:
+                hits += 1
+                reciprocal_ranks += 1 / rank
+                break
+
+    latencies = np.array([latency for latency, _, _ in results])
+    return {
+        "retriever": name,
+        "queries": len(queries),
+        "errors": sum(failed for _, _, failed in results),
+        f"hit_rate@{top_k}": hits / len(queries),
+        "mrr": reciprocal_ranks / len(queries),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "mean_ms": float(latencies.mean()),
+        "qps": len(queries) / wall_s,
+        "setup_s": setup_s,
+    }
+
+
+def compare_with_baseline(rows: List[dict], baseline: dict, top_k: int,
+                          quality_tolerance: float, latency_tolerance: float) -> List[str]:
+    """add the deltas against the baseline to `rows`, return the regressions beyond the tolerances"""
+    if baseline["config"]["top_k"] != top_k:
+        logger.warning(f"baseline was measured with top_k={baseline['config']['top_k']}, not compared")
+        return []
+    baseline_rows = {row["retriever"]: row for row in baseline["results"]}
+    hit_rate_key = f"hit_rate@{top_k}"
+    regressions = []
+    for row in rows:
+        base = baseline_rows.get(row["retriever"])
+        if base is None:
+            continue
+        row["hit_rate_delta"] = row[hit_rate_key] - base[hit_rate_key]
+        row["mrr_delta"] = row["mrr"] - base["mrr"]
+        row["p95_change"] = row["p95_ms"] / base["p95_ms"] - 1 if base["p95_ms"] else 0.0
+        row["qps_change"] = row["qps"] / base["qps"] - 1 if base["qps"] else 0.0
+        if row["hit_rate_delta"] < -quality_tolerance or row["mrr_delta"] < -quality_tolerance:
+            regressions.append(f"{row['retriever']}: {hit_rate_key} {row['hit_rate_delta']:+.4f}, "
+                               f"mrr {row['mrr_delta']:+.4f}")
+        if row["p95_change"] > latency_tolerance:
+            regressions.append(f"{row['retriever']}: p95 {base['p95_ms']:.1f}ms -> {row['p95_ms']:.1f}ms "
+                               f"({row['p95_change']:+.0%})")
+    return regressions
+
+
+def write_report(report: dict, prefix: str):
+    os.makedirs(os.path.dirname(prefix), exist_ok=True)
+    with open(f"{prefix}.json", "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    fieldnames = []
+    for row in report["results"]:
+        fieldnames.extend(key for key in row if key not in fieldnames)
+    with open(f"{prefix}.csv", "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(report["results"])
+    logger.info(f"benchmark report written to {prefix}.json / {prefix}.csv")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="offline HitRate / MRR / latency benchmark of the retrievers")
+    parser.add_argument("--retrievers", nargs="+", choices=RETRIEVERS, default=list(RETRIEVERS))
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--limit", type=int, default=0, help="only the first n dataset queries, 0 for all")
+    parser.add_argument("--concurrency", type=int, default=1, help="queries in flight, for throughput")
+    parser.add_argument("--output", default=OUTPUT_PREFIX, help="report path without the .json / .csv suffix")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--update-baseline", action="store_true", help="store this run as the new baseline")
+    parser.add_argument("--quality-tolerance", type=float, default=0.01, help="allowed HitRate / MRR drop")
+    parser.add_argument("--latency-tolerance", type=float, default=0.2, help="allowed relative p95 increase")
+    args = parser.parse_args()
+
+    dataset = load_dataset()
+    queries = dataset["queries"][:args.limit] if args.limit else dataset["queries"]
+    rows = []
+    for name in args.retrievers:
+        logger.info(f"benchmarking {name} over {len(queries)} queries")
+        rows.append(evaluate_retriever(name, queries, dataset["query_relevant_docs"], args.top_k, args.concurrency))
+
+    report = {
+        "config": {"top_k": args.top_k, "queries": len(queries), "concurrency": args.concurrency,
+                   "bm25_backend": "local", "reranker": "bge", "created_at": time.strftime("%Y-%m-%d %H:%M:%S")},
+        "results": rows,
+    }
+    regressions = []
+    if os.path.exists(args.baseline) and not args.update_baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare_with_baseline(rows, json.load(f), args.top_k,
+                                                args.quality_tolerance, args.latency_tolerance)
+    write_report(report, args.output)
+    if args.update_baseline:
+        write_report(report, os.path.splitext(args.baseline)[0])
+
+    for row in rows:
+        print(f"{row['retriever']:>24}  hit_rate@{args.top_k}: {row[f'hit_rate@{args.top_k}']:.4f}  "
+              f"mrr: {row['mrr']:.4f}  p50: {row['p50_ms']:7.1f}ms  p95: {row['p95_ms']:7.1f}ms  "
+              f"p99: {row['p99_ms']:7.1f}ms  qps: {row['qps']:7.1f}  errors: {row['errors']}")
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
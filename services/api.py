@@ -2,21 +2,30 @@ import time
 
 from fastapi import FastAPI, File, UploadFile
 from typing import List
-from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, RedirectResponse, StreamingResponse, Response
+from prometheus_client import CONTENT_TYPE_LATEST
 import os
+import json
 import traceback
 
-from retry import retry
-from openai import OpenAI
-
-from config.config_parser import OPENAI_API_KEY
+from config.config_parser import (
+    LOCAL_EMBEDDING_MODEL, EMBEDDING_SERVER_MAX_BATCH_SIZE, EMBEDDING_SERVER_MAX_WAIT_MS, RESOURCE_HEALTH_CHECK,
+    METRICS_DEBUG
+)
 
 from pathlib import Path
 from sentence_transformers import SentenceTransformer
+from utils.embedding_provider import get_embedding_provider
+from utils.micro_batcher import MicroBatcher
+from utils.rerank import QuerySuite, close_bge_reranker, get_bge_reranker
+from utils.answer_cache import get_answer_cache
+from utils.deadline import Deadline
+from utils.metrics import metrics_payload, record_request, span, start_trace
 from utils.file_utils import size_converter
+from utils.resources import resource_manager
 from utils.logger import logger
 from pydantic import BaseModel
-from doc_qa_rag_hybrid import DocQA
+from doc_qa_rag_hybrid import AsyncDocQA
 
 import uvicorn
 
@@ -28,6 +37,10 @@ class Sentence(BaseModel):
     text: str   
 
 
+class Sentences(BaseModel):
+    texts: List[str]
+
+
 upload_dir = Path(UPLOAD_FILE_PATH)
 
 RESET_HEADERS = {
@@ -69,6 +82,17 @@ def index():
     return 'hello world!'
 
 
+@app.get('/metrics')
+def metrics():
+    return Response(content=metrics_payload(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.get('/health')
+def health():
+    status = resource_manager.health()
+    return JSONResponse(content=status, status_code=200 if all(status.values()) else 503)
+
+
 @app.post("/api/upload-files", tags=['Upload files to directory'])
 async def upload_files(files: List[UploadFile] = File(..., description="Upload files.")):
     """
@@ -115,19 +139,53 @@ async def upload_files(files: List[UploadFile] = File(..., description="Upload f
     })
 
 
+async def lookup_answer_cache(answer_cache, prompt: str):
+    """the cached answer, None on a miss; the cache is optional, so its failures are treated as a miss"""
+    if answer_cache is None:
+        return None
+    try:
+        with span("answer_cache"):
+            return await answer_cache.alookup(prompt)
+    except Exception as e:
+        logger.warning(f"answer cache lookup failed, answering without cache: {e!r}")
+        return None
+
+
+async def store_answer_cache(answer_cache, prompt: str, answer: str, contexts, sources):
+    try:
+        await answer_cache.astore(prompt, answer, contexts, sources)
+    except Exception as e:
+        logger.warning(f"answer cache store failed: {e!r}")
+
+
 @app.post("/api/doc_qa", tags=["Provide query to chat against docs"])
-async def qa_chat(prompt: str):
+async def qa_chat(prompt: str, debug: bool = False):
     chat_history.append({"role": "user", "content": f"{prompt}"})
     model_name = "gpt-3.5-turbo"
     return_data = {
         'question': prompt, 'answer': '',
         'status': 'success', 'error': '',
         'elapse_ms': 0, 'contexts': "",
-        'sources': ""
+        'sources': "", 'cache_hit': False, 'degraded': []
     }
     t1 = time.time()
+    # 请求的时间预算从收到请求开始计算, 传递给检索, rerank和LLM各阶段
+    deadline = Deadline.from_config()
+    trace = start_trace()
     try:
-        answer, contexts, source = DocQA(query=prompt).answer(model_name=model_name)
+        answer_cache = get_answer_cache()
+        cached = await lookup_answer_cache(answer_cache, prompt)
+        if cached:
+            logger.info(f"answer cache hit, similarity: {cached['similarity']:.4f}, cached question: {cached['question']}")
+            answer, contexts, source = cached['answer'], cached['contexts'], cached['sources']
+            return_data['cache_hit'] = True
+        else:
+            doc_qa = AsyncDocQA(query=prompt, deadline=deadline)
+            answer, contexts, source = await doc_qa.aanswer(model_name=model_name)
+            return_data['degraded'] = doc_qa.degraded
+            # 降级的回答(跳过rerank, 备用模型, 丢弃检索分支)不写入缓存, 避免过载结束后仍被命中
+            if answer_cache and not doc_qa.degraded:
+                await store_answer_cache(answer_cache, prompt, answer, contexts, source)
 
         return_data['answer'] = answer
         return_data['contexts'] = contexts
@@ -139,100 +197,126 @@ async def qa_chat(prompt: str):
     
     t2 = time.time()
     return_data["elapse_ms"] = (t2 - t1) * 1000
+    record_request("doc_qa", return_data["status"], t2 - t1, return_data["degraded"])
+    if debug or METRICS_DEBUG:
+        return_data["debug"] = trace.to_dict()
 
     return return_data
 
 
-# text embedding service
-@app.post('/embedding')
-@retry(exceptions=Exception, tries=3, max_delay=60)
-def get_embedding(sentence: Sentence, model_name='text-embedding-ada-002'):
-    input_text = sentence.text.replace("\n", " ")
-    if model_name in ['text-embedding-ada-002', 'text-embedding-3-small']:
-        model = model_name
-
-        client = OpenAI(api_key=OPENAI_API_KEY)
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
 
-        response = client.embeddings.create(
-            model=model,
-            input=input_text,
-            encoding_format="float"
-        )
-        result = {
-            "text": sentence.text,
-            "dimensions": len(response.data[0].embedding),
-            "embedding": response.data[0].embedding
-        }
-    elif model_name in ['bge-large-zh-v1.5']:
-        model = SentenceTransformer('BAAI/bge-large-zh-v1.5')
-        embedding = model.encode(input_text, normalize_embeddings=True).tolist()
-        result = {"text": sentence.text, "dimensions": len(embedding), "embedding": embedding}
-    
-    return result
 
+async def stream_doc_qa(prompt: str, model_name: str):
+    # contexts are sent before the first LLM token
+    t1 = time.time()
+    deadline = Deadline.from_config()
+    degraded = []
+    start_trace()
+    try:
+        answer_cache = get_answer_cache()
+        cached = await lookup_answer_cache(answer_cache, prompt)
+        if cached:
+            yield sse_event("contexts", {"question": prompt, "contexts": cached['contexts'],
+                                         "sources": cached['sources'], "cache_hit": True})
+            yield sse_event("token", {"content": cached['answer']})
+        else:
+            answer_tokens, contexts, sources = [], "", ""
+            doc_qa = AsyncDocQA(query=prompt, deadline=deadline)
+            degraded = doc_qa.degraded
+            async for event in doc_qa.aanswer_stream(model_name=model_name):
+                if event["event"] == "contexts":
+                    contexts, sources = event["contexts"], event["sources"]
+                    yield sse_event("contexts", {"question": prompt, "contexts": contexts,
+                                                 "sources": sources, "cache_hit": False})
+                else:
+                    answer_tokens.append(event["content"])
+                    yield sse_event("token", {"content": event["content"]})
+            if answer_cache and not degraded:
+                await store_answer_cache(answer_cache, prompt, ''.join(answer_tokens), contexts, sources)
+        record_request("doc_qa_stream", "success", time.time() - t1, degraded)
+        yield sse_event("done", {"status": "success", "elapse_ms": (time.time() - t1) * 1000, "degraded": degraded})
+    except Exception:
+        logger.error(traceback.format_exc())
+        record_request("doc_qa_stream", "fail", time.time() - t1, degraded)
+        yield sse_event("error", {"status": "fail", "error": traceback.format_exc(),
+                                  "elapse_ms": (time.time() - t1) * 1000})
 
-################# Rerank module ###############
 
-import os
-import time
-from operator import itemgetter
-from random import randint
-import cohere
-from typing import List, Tuple
+@app.post("/api/doc_qa/stream", tags=["Provide query to chat against docs, answer streamed as server-sent events"])
+async def qa_chat_stream(prompt: str):
+    chat_history.append({"role": "user", "content": f"{prompt}"})
+    model_name = "gpt-3.5-turbo"
+    return StreamingResponse(stream_doc_qa(prompt, model_name), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
-from FlagEmbedding import FlagReranker
 
-from dotenv import load_dotenv
-load_dotenv()
+# text embedding service
+# 本地模型常驻内存, 并发请求由embedding_batcher合批后在单独线程推理
+bge_model = None
+embedding_batcher = None
+
+
+@app.on_event("startup")
+def start_resources():
+    # 后端客户端(ES, Milvus, OpenAI, Cohere, http连接池)在启动时创建, 请求之间复用
+    resource_manager.start(health_check=RESOURCE_HEALTH_CHECK)
+
+
+@app.on_event("startup")
+def load_local_models():
+    global bge_model, embedding_batcher
+    bge_model = SentenceTransformer(LOCAL_EMBEDDING_MODEL)
+    embedding_batcher = MicroBatcher(
+        lambda texts: bge_model.encode(texts, batch_size=len(texts), normalize_embeddings=True).tolist(),
+        max_batch_size=EMBEDDING_SERVER_MAX_BATCH_SIZE,
+        max_wait_ms=EMBEDDING_SERVER_MAX_WAIT_MS,
+        name="embedding_batcher"
+    )
+    logger.info(f"local embedding model {LOCAL_EMBEDDING_MODEL} loaded")
+    get_bge_reranker()
 
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-COHERE_API_KEY = os.getenv("COHERE_API_KEY")
 
-class QuerySuite(BaseModel):
-    query: str
-    passages: List[str]
-    top_k: int = 3
+@app.on_event("shutdown")
+def close_local_models():
+    if embedding_batcher is not None:
+        embedding_batcher.close()
+    close_bge_reranker()
 
 
-# Using Cohere Rerank service
-cohere_client = cohere.Client(api_key=COHERE_API_KEY)
+@app.on_event("shutdown")
+async def close_resources():
+    await resource_manager.aclose()
 
-def get_cohere_rerank_result(query: str, docs: List[str], top_n) -> List[Tuple]:
-    time.sleep(randint(1, 10))
 
-    results = cohere_client.rerank(
-        model="rerank-multilingual-v2.0",
-        query=query,
-        documents=docs,
-        top_n=top_n
-    )
+async def embed_texts(texts: List[str], model_name: str) -> List[List[float]]:
+    texts = [text.replace("\n", " ") for text in texts]
+    if model_name in ['text-embedding-ada-002', 'text-embedding-3-small']:
+        embeddings = await get_embedding_provider(model_name).aembed(texts)
+        return embeddings.tolist()
+    elif model_name in ['bge-large-zh-v1.5']:
+        return await embedding_batcher.asubmit_many(texts)
+    raise ValueError(f"unsupported embedding model: {model_name}")
 
-    # return top_n nodes text with relevence score
-    return [(hit.document['text'], hit.relevance_score) for hit in results]
 
+@app.post('/embedding')
+async def get_embedding(sentence: Sentence, model_name='text-embedding-ada-002'):
+    embedding = (await embed_texts([sentence.text], model_name))[0]
+    return {"text": sentence.text, "dimensions": len(embedding), "embedding": embedding}
 
-def get_bge_rerank_result(query: str, docs: List[str], top_n) -> List[Tuple]:
-    query_suite = QuerySuite(
-        query=query,
-        passages=docs
-    )
 
-    bge_reranker = FlagReranker('BAAI/bge-reranker-large', use_fp16=True) # Setting use_fp16 to True speeds up computation with a slight performance degradation
+@app.post('/embedding/batch')
+async def get_embedding_batch(sentences: Sentences, model_name='text-embedding-ada-002'):
+    embeddings = await embed_texts(sentences.texts, model_name)
+    return {"dimensions": len(embeddings[0]) if embeddings else 0, "embeddings": embeddings}
 
-    scores = bge_reranker.compute_score([[query_suite.query, passage] for passage in query_suite.passages])
 
-    if isinstance(scores, List):
-        similiarity_dict = {passage: scores[i] for i, passage in enumerate(query_suite.passages)}
-    else:
-        similarity_dict = {passage: scores for i, passage in enumerate(query_suite.passages)}
-    
-    sorted_similarity_dict = sorted(similarity_dict.items(), key=itemgetter(1), reverse=True) # sorted by score
-    result = {}
-    for j in range(query_suite.top_k):
-        result[sorted_similarity_dict[j][0]] = sorted_similarity_dict[j][1]
-    
-    # return top_n nodes text with relevence score
-    return [(passage, score) for passage, score in result.items()]
+################# Rerank module ###############
+@app.post('/rerank')
+async def rerank(query_suite: QuerySuite):
+    results = await get_bge_reranker().arerank(query_suite.query, query_suite.passages, top_n=query_suite.top_k)
+    return {"query": query_suite.query, "results": [{"text": text, "score": score} for text, score in results]}
 
 
 if __name__ == "__main__":
@@ -3,7 +3,6 @@ from utils.logger import logger
 import streamlit as st
 from streamlit_pills import pills
 from config.config_parser import SYSTEM_ROLE
-from faiss import IndexFlatIP
 
 from llama_index.query_engine import RetrieverQueryEngine
 from openai import OpenAI
@@ -60,11 +59,6 @@ class StreamlitChat:
             )  # Add response to message history
             # logger.info(f"add prompt from {role} with message: {content}")
 
-        faiss_index = IndexFlatIP(1536)
-        # retriever = EnsembleRerankRetriever(top_k=2, faiss_index=faiss_index)
-        retriever = VectorSearchRetriever(top_k=3, faiss_index=faiss_index)
-        query_engine = RetrieverQueryEngine.from_args(retriever)
-
         # custom_bm25_retriever = CustomBM25Retriever(top_k=3)
         # query = "给你机会你也不中用啊"
         # t_result = custom_bm25_retriever.retrieve(str_or_query_bundle=query)
@@ -81,7 +75,22 @@ class StreamlitChat:
         )
 
         if "chat_engine" not in st.session_state:  # Initialize the query engine
-            st.session_state["chat_engine"] = query_engine
+            # the faiss index behind the retriever is shared process wide, so reruns do not rebuild it
+            # retriever = EnsembleRerankRetriever(top_k=2)
+            retriever = VectorSearchRetriever(top_k=3)
+            st.session_state["chat_engine"] = RetrieverQueryEngine.from_args(retriever, streaming=True)
+
+        def stream_answer(query):
+            # retrieval runs under the spinner, the answer is rendered token by token as it streams in
+            with st.spinner('Query is at work...'):
+                streaming_response = st.session_state["chat_engine"].query(query)
+            placeholder = st.empty()
+            response = ""
+            for token in streaming_response.response_gen:
+                response += token
+                placeholder.markdown(response + "▌")
+            placeholder.markdown(response)
+            return response
 
         for message in st.session_state["messages"]:  # Display the prior chat messages
             with st.chat_message(message["role"]):
@@ -95,11 +104,9 @@ class StreamlitChat:
             with st.chat_message("user"):
                 st.write(selected)
             with st.chat_message("assistant"):
-                with st.spinner('Query is at work...'):
-                    response = st.session_state["chat_engine"].query(selected)
-                    st.markdown(response)
-                    add_to_message_history("user", selected)
-                    add_to_message_history("assistant", response)
+                response = stream_answer(selected)
+                add_to_message_history("user", selected)
+                add_to_message_history("assistant", response)
 
         if prompt := st.chat_input(
                 "Your question"
@@ -111,11 +118,9 @@ class StreamlitChat:
                 st.write(prompt)
 
             with st.chat_message("assistant"):
-                with st.spinner('Query is at work...'):
-                    response = st.session_state["chat_engine"].query(prompt)
-                    logger.info(f"response text is: {response}")
-                    st.markdown(response)
-                    add_to_message_history("assistant", response)
+                response = stream_answer(prompt)
+                logger.info(f"response text is: {response}")
+                add_to_message_history("assistant", response)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,145 @@
+import time
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import faiss
+import numpy as np
+
+from config.config_parser import (
+    ANSWER_CACHE_ENABLED, ANSWER_CACHE_EMBEDDING_MODEL, ANSWER_CACHE_THRESHOLD,
+    ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_TTL_SECONDS
+)
+from utils.corpus_version import read_corpus_version
+from utils.embedding_provider import get_embedding_provider
+from utils.logger import logger
+
+# 查询时检查的近邻数
+SEARCH_NEIGHBOURS = 4
+
+
+class SemanticAnswerCache:
+    """
+    Answer cache for paraphrased questions.
+
+    Question embeddings are L2 normalized and kept in an in-memory faiss IndexFlatIP, a lookup returns
+    the stored answer of the nearest question if the cosine similarity reaches `threshold`. Entries
+    are tagged with the corpus version and dropped once ingestion bumps it, the oldest entries are
+    evicted beyond `max_entries`.
+    """
+    def __init__(self, embedding_model: str = ANSWER_CACHE_EMBEDDING_MODEL, threshold: float = ANSWER_CACHE_THRESHOLD,
+                 max_entries: int = ANSWER_CACHE_MAX_ENTRIES, ttl_seconds: float = ANSWER_CACHE_TTL_SECONDS):
+        self.embedding_model = embedding_model
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.provider = get_embedding_provider(embedding_model)
+        self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(self.provider.dimensions))
+        self.entries: "OrderedDict[int, dict]" = OrderedDict()
+        self.corpus_version = read_corpus_version()
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _normalize(embedding: np.ndarray) -> np.ndarray:
+        embedding = np.array(embedding, dtype=np.float32).reshape(1, -1)
+        faiss.normalize_L2(embedding)
+        return embedding
+
+    def embed(self, question: str) -> np.ndarray:
+        # goes through the query embedding cache, the retrieval of a miss reuses this embedding
+        return self._normalize(self.provider.embed([question])[0])
+
+    async def aembed(self, question: str) -> np.ndarray:
+        return self._normalize((await self.provider.aembed([question]))[0])
+
+    def _check_corpus_version(self):
+        corpus_version = read_corpus_version()
+        if corpus_version != self.corpus_version:
+            logger.info(f"corpus version {self.corpus_version} -> {corpus_version}, "
+                        f"dropping {len(self.entries)} cached answers")
+            self.index.reset()
+            self.entries.clear()
+            self.corpus_version = corpus_version
+
+    def _remove(self, entry_id: int):
+        self.index.remove_ids(np.array([entry_id], dtype=np.int64))
+        self.entries.pop(entry_id, None)
+
+    def _search(self, embedding: np.ndarray) -> Optional[dict]:
+        with self._lock:
+            self._check_corpus_version()
+            if self.index.ntotal:
+                # a few neighbours, so an expired nearest entry does not hide a live one above the threshold
+                scores, ids = self.index.search(embedding, min(self.index.ntotal, SEARCH_NEIGHBOURS))
+                now, hit = time.monotonic(), None
+                for entry_id, similarity in zip(ids[0].tolist(), scores[0].tolist()):
+                    entry = self.entries.get(entry_id)
+                    if entry is None:
+                        continue
+                    if entry["expire_at"] < now:
+                        self._remove(entry_id)
+                    elif hit is None and similarity >= self.threshold:
+                        hit = {**entry["result"], "similarity": similarity}
+                if hit is not None:
+                    self.hits += 1
+                    return hit
+            self.misses += 1
+        return None
+
+    def _add(self, embedding: np.ndarray, question: str, answer: str, contexts: str, sources: str):
+        with self._lock:
+            self._check_corpus_version()
+            entry_id = self._next_id
+            self._next_id += 1
+            self.index.add_with_ids(embedding, np.array([entry_id], dtype=np.int64))
+            self.entries[entry_id] = {
+                "result": {"question": question, "answer": answer, "contexts": contexts, "sources": sources},
+                "expire_at": time.monotonic() + self.ttl_seconds,
+            }
+            # every entry has the same ttl, the expired ones are at the front
+            while self.entries and (len(self.entries) > self.max_entries
+                                    or next(iter(self.entries.values()))["expire_at"] < time.monotonic()):
+                self._remove(next(iter(self.entries)))
+
+    def lookup(self, question: str) -> Optional[dict]:
+        """cached {question, answer, contexts, sources, similarity} of the closest question, None on a miss"""
+        return self._search(self.embed(question))
+
+    def store(self, question: str, answer: str, contexts: str, sources: str):
+        self._add(self.embed(question), question, answer, contexts, sources)
+
+    async def alookup(self, question: str) -> Optional[dict]:
+        return self._search(await self.aembed(question))
+
+    async def astore(self, question: str, answer: str, contexts: str, sources: str):
+        self._add(await self.aembed(question), question, answer, contexts, sources)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses,
+                    "hit_ratio": self.hits / lookups if lookups else 0.0, "entries": len(self.entries)}
+
+
+_answer_cache: Optional[SemanticAnswerCache] = None
+_lock = threading.Lock()
+
+
+def get_answer_cache() -> Optional[SemanticAnswerCache]:
+    """process wide answer cache, None if disabled in the config"""
+    global _answer_cache
+    if not ANSWER_CACHE_ENABLED:
+        return None
+    if _answer_cache is None:
+        with _lock:
+            if _answer_cache is None:
+                _answer_cache = SemanticAnswerCache()
+    return _answer_cache
+
+
+def peek_answer_cache() -> Optional[SemanticAnswerCache]:
+    """the cache if it was already created, never creates one (for stats)"""
+    return _answer_cache
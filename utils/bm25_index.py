@@ -0,0 +1,256 @@
+import os
+import re
+import json
+import time
+import threading
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import jieba
+import numpy as np
+from scipy import sparse
+
+from config.config_parser import PROJECT_DIR, BM25_INDEX_PATH
+from utils.rank_fusion import top_k_indices
+from utils.logger import logger
+
+# 过滤纯标点/空白的分词结果
+WORD_PATTERN = re.compile(r"\w", re.UNICODE)
+
+
+def tokenize(text: str) -> List[str]:
+    """chinese aware tokenizer, close to the ik_smart analyzer used by the ES index"""
+    return [token.lower() for token in jieba.lcut(text) if WORD_PATTERN.search(token)]
+
+
+class _Segment(NamedTuple):
+    offset: int                   # position of the first document of the segment
+    term_doc: sparse.csr_matrix   # term x doc raw term frequencies, rows cover the vocabulary of its time
+
+
+class _IndexState(NamedTuple):
+    vocab: Dict[str, int]
+    texts: List[str]
+    sources: List[str]
+    segments: Tuple[_Segment, ...]
+    df: np.ndarray        # documents containing each term
+    doc_len: np.ndarray   # tokens of each document
+    total_len: float
+
+
+class LocalBM25Index:
+    """
+    In-process BM25 engine, a low latency alternative to the Elasticsearch `docs_qa` index.
+
+    Term frequencies are kept in append-only term x doc CSR segments, together with the document
+    frequency and length statistics. A query only slices the rows of its terms in every segment and
+    weights their postings with the current idf / average length, top-k selection uses argpartition.
+    `add` builds the next state off to the side and publishes it with one reference swap, so a
+    concurrent search always sees a consistent snapshot; it only touches the new documents, small
+    segments are merged like a binary counter so at most log2(n) remain.
+    """
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._state = _IndexState({}, [], [], (), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32),
+                                   0.0)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._state.texts)
+
+    @property
+    def vocab(self) -> Dict[str, int]:
+        return self._state.vocab
+
+    @property
+    def texts(self) -> List[str]:
+        return self._state.texts
+
+    @property
+    def sources(self) -> List[str]:
+        return self._state.sources
+
+    def add(self, texts: List[str], sources: Optional[List[str]] = None):
+        """append chunks, new terms extend the vocabulary"""
+        if not texts:
+            return
+        sources = sources if sources is not None else [""] * len(texts)
+        # only one writer at a time, readers keep using the published state meanwhile
+        with self._lock:
+            state = self._state
+            vocab = dict(state.vocab)
+            indptr, indices, data = [0], [], []
+            for text in texts:
+                term_counts = {}
+                for token in tokenize(text):
+                    term_id = vocab.setdefault(token, len(vocab))
+                    term_counts[term_id] = term_counts.get(term_id, 0) + 1
+                indices.extend(term_counts)
+                data.extend(term_counts.values())
+                indptr.append(len(indices))
+            new_rows = sparse.csr_matrix((np.asarray(data, dtype=np.float32),
+                                          np.asarray(indices, dtype=np.int32),
+                                          np.asarray(indptr, dtype=np.int64)),
+                                         shape=(len(texts), len(vocab)))
+            self._publish(state, vocab, list(texts), list(sources), new_rows)
+
+    def _publish(self, state: _IndexState, vocab: Dict[str, int], texts: List[str], sources: List[str],
+                 doc_term: sparse.csr_matrix):
+        df = np.zeros(len(vocab), dtype=np.int64)
+        df[:len(state.df)] = state.df
+        df += np.bincount(doc_term.indices, minlength=len(vocab))
+        segments = list(state.segments) + [_Segment(len(state.texts), doc_term.T.tocsr())]
+        while len(segments) > 1 and segments[-2].term_doc.shape[1] <= segments[-1].term_doc.shape[1]:
+            last = segments.pop()
+            segments[-1] = self._merge(segments[-1], last)
+        doc_len = np.asarray(doc_term.sum(axis=1), dtype=np.float32).ravel()
+        self._state = _IndexState(vocab, state.texts + texts, state.sources + sources, tuple(segments), df,
+                                  np.concatenate([state.doc_len, doc_len]), state.total_len + float(doc_len.sum()))
+
+    @staticmethod
+    def _merge(first: _Segment, second: _Segment) -> _Segment:
+        n_terms = max(first.term_doc.shape[0], second.term_doc.shape[0])
+        term_docs = []
+        for segment in (first, second):
+            term_doc = segment.term_doc.copy()
+            term_doc.resize((n_terms, term_doc.shape[1]))
+            term_docs.append(term_doc)
+        return _Segment(first.offset, sparse.hstack(term_docs, format="csr"))
+
+    def search(self, query: str, top_k: int) -> List[Tuple[int, float]]:
+        """return [(doc position, bm25 score)] of the matched documents, sorted by score in desc"""
+        state = self._state
+        query_terms = {}
+        for token in tokenize(query):
+            if token in state.vocab:
+                query_terms[state.vocab[token]] = query_terms.get(state.vocab[token], 0) + 1
+        if not query_terms:
+            return []
+        n_docs = len(state.texts)
+        term_ids = np.fromiter(query_terms, dtype=np.int64, count=len(query_terms))
+        counts = np.fromiter(query_terms.values(), dtype=np.float32, count=len(query_terms))
+        df = state.df[term_ids]
+        # same idf as Lucene BM25Similarity
+        query_weights = (np.log1p((n_docs - df + 0.5) / (df + 0.5)) * counts).astype(np.float32)
+        len_scale = np.float32(self.b / max(state.total_len / max(n_docs, 1), 1e-6))
+
+        docs, weights = [], []
+        for segment in state.segments:
+            in_segment = term_ids < segment.term_doc.shape[0]
+            postings = segment.term_doc[term_ids[in_segment]]
+            if not postings.nnz:
+                continue
+            row_of_value = np.repeat(np.flatnonzero(in_segment), np.diff(postings.indptr))
+            segment_docs = segment.offset + postings.indices
+            tf = postings.data
+            norm = np.float32(self.k1) * (np.float32(1 - self.b) + state.doc_len[segment_docs] * len_scale)
+            docs.append(segment_docs)
+            weights.append(query_weights[row_of_value] * tf * np.float32(self.k1 + 1) / (tf + norm))
+        if not docs:
+            return []
+        scores = np.bincount(np.concatenate(docs), weights=np.concatenate(weights), minlength=n_docs)
+        matched = np.flatnonzero(scores > 0)
+        return [(int(matched[i]), float(scores[matched[i]])) for i in top_k_indices(scores[matched], top_k)]
+
+    def doc_term(self) -> sparse.csr_matrix:
+        """doc x term frequencies of the whole index"""
+        state = self._state
+        if not state.segments:
+            return sparse.csr_matrix((0, len(state.vocab)), dtype=np.float32)
+        merged = state.segments[0]
+        for segment in state.segments[1:]:
+            merged = self._merge(merged, segment)
+        doc_term = merged.term_doc.T.tocsr()
+        doc_term.resize((doc_term.shape[0], len(state.vocab)))
+        return doc_term
+
+    def save(self, path: str = BM25_INDEX_PATH):
+        """
+        write the matrix under a new name, then swap meta.json (which references it) in with os.replace,
+        a concurrent `load()` always reads a matching meta / matrix pair
+        """
+        os.makedirs(path, exist_ok=True)
+        state = self._state
+        doc_term_file = f"doc_term.{time.time_ns()}.{os.getpid()}.npz"
+        tmp_path = os.path.join(path, f"{doc_term_file}.tmp.npz")
+        sparse.save_npz(tmp_path, self.doc_term())
+        os.replace(tmp_path, os.path.join(path, doc_term_file))
+        tmp_path = os.path.join(path, f"meta.json.{os.getpid()}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"k1": self.k1, "b": self.b, "doc_term": doc_term_file, "vocab": state.vocab,
+                                "texts": state.texts, "sources": state.sources}, ensure_ascii=False))
+        os.replace(tmp_path, os.path.join(path, "meta.json"))
+        # the previous matrix is kept for readers that have just read the previous meta.json, older ones retry
+        matrices = sorted((name for name in os.listdir(path) if re.fullmatch(r"doc_term\.\d+\.\d+\.npz", name)),
+                          key=lambda name: int(name.split(".")[1]))
+        for name in matrices[:-2]:
+            if name != doc_term_file:
+                os.remove(os.path.join(path, name))
+
+    @classmethod
+    def load(cls, path: str = BM25_INDEX_PATH) -> "LocalBM25Index":
+        for attempt in range(5):
+            with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+                meta = json.loads(f.read())
+            try:
+                # indexes saved before the matrix was versioned use a fixed doc_term.npz
+                doc_term = sparse.load_npz(os.path.join(path, meta.get("doc_term", "doc_term.npz"))).tocsr()
+                break
+            except FileNotFoundError:
+                # removed by a newer save, whose meta.json is already in place
+                if attempt == 4:
+                    raise
+        index = cls(k1=meta["k1"], b=meta["b"])
+        index._publish(index._state, meta["vocab"], meta["texts"], meta["sources"], doc_term)
+        return index
+
+    @classmethod
+    def from_dataset(cls) -> "LocalBM25Index":
+        """build from the corpus of doc_qa_dataset.json, the same chunks the evaluation retrievers use"""
+        with open(os.path.join(PROJECT_DIR, "data/doc_qa_dataset.json"), "r", encoding="utf-8") as f:
+            corpus = list(json.loads(f.read())["corpus"].values())
+        index = cls()
+        index.add(corpus, ["doc_qa_dataset"] * len(corpus))
+        return index
+
+
+DATASET_BM25_INDEX_PATH = os.path.join(BM25_INDEX_PATH, "dataset")
+
+_local_bm25_index: Optional[LocalBM25Index] = None
+_dataset_bm25_index: Optional[LocalBM25Index] = None
+_index_lock = threading.Lock()
+
+
+def get_local_bm25_index() -> LocalBM25Index:
+    """process wide index of the ingested chunks, loaded from disk on first use, empty before the first ingestion"""
+    global _local_bm25_index
+    if _local_bm25_index is None:
+        with _index_lock:
+            if _local_bm25_index is None:
+                if os.path.exists(os.path.join(BM25_INDEX_PATH, "meta.json")):
+                    _local_bm25_index = LocalBM25Index.load()
+                else:
+                    _local_bm25_index = LocalBM25Index()
+                logger.info(f"local bm25 index loaded with {len(_local_bm25_index)} chunks")
+    return _local_bm25_index
+
+
+def get_dataset_bm25_index() -> LocalBM25Index:
+    """index of the doc_qa_dataset.json corpus for the evaluation retrievers, built once and kept apart from the service index"""
+    global _dataset_bm25_index
+    if _dataset_bm25_index is None:
+        with _index_lock:
+            if _dataset_bm25_index is None:
+                if os.path.exists(os.path.join(DATASET_BM25_INDEX_PATH, "meta.json")):
+                    _dataset_bm25_index = LocalBM25Index.load(DATASET_BM25_INDEX_PATH)
+                else:
+                    _dataset_bm25_index = LocalBM25Index.from_dataset()
+                    _dataset_bm25_index.save(DATASET_BM25_INDEX_PATH)
+                logger.info(f"dataset bm25 index loaded with {len(_dataset_bm25_index)} chunks")
+    return _dataset_bm25_index
+
+
+if __name__ == '__main__':
+    bm25_index = get_dataset_bm25_index()
+    for doc_pos, score in bm25_index.search("中国队亚洲杯成绩如何", top_k=3):
+        print(score, bm25_index.texts[doc_pos])
@@ -1,40 +1,87 @@
 import os
 import json
+import threading
+from typing import Optional
+
 import numpy as np
-from tqdm import tqdm
-from utils.get_text_embedding import (
-    get_text_embedding_ada_v2,
-    get_text_embedding_v3,
-    get_bge_embedding
-)
+from utils.embedding_provider import get_embedding_provider
+from config.config_parser import PROJECT_DIR
+
+DATA_DIR = os.path.join(PROJECT_DIR, "data")
 
 
 def build_with_context(embedding_model: str, context_type: str):
-    with open("../data/doc_qa_dataset.json", "r", encoding="utf-8") as f:
+    with open(os.path.join(DATA_DIR, "doc_qa_dataset.json"), "r", encoding="utf-8") as f:
         content = json.loads(f.read())
     queries = list(content[context_type].values())
-    query_num = len(queries)
-    if embedding_model == 'text-embedding-ada-002':
-        embedding_fn, dimensions = get_text_embedding_ada_v2, 1536
-    elif embedding_model == 'text-embedding-3-small':
-        embedding_fn, dimensions = get_text_embedding_v3, 1536
-    elif embedding_model == 'text-embedding-3-large':
-        embedding_fn, dimensions = get_text_embedding_v3, 3072
-    elif embedding_model == 'local_bge_zh-v1.5':
-        embedding_fn, dimensions = get_bge_embedding, 1024
-
-    embedding_data = np.empty(shape=[query_num, dimensions])
-    for i in tqdm(range(query_num), desc="generate embedding"):
-        embedding_data[i] = embedding_fn(queries[i])
-    np.save(f"../data/{context_type}_{embedding_model}.npy", embedding_data)
+    provider_model = 'bge-large-zh-v1.5' if embedding_model == 'local_bge_zh-v1.5' else embedding_model
+
+    # float32 array in input order, built with batched requests
+    embedding_data = get_embedding_provider(provider_model).embed(queries, use_cache=False)
+    np.save(os.path.join(DATA_DIR, f"{context_type}_{embedding_model}.npy"), embedding_data)
+
+
+def load_float32(path: str) -> np.ndarray:
+    """
+    memory-map a cached embedding file as float32,
+    files saved by older versions as float64 are converted once into a `.f32.npy` copy next to it
+    """
+    embedding_data = np.load(path, mmap_mode="r")
+    if embedding_data.dtype == np.float32:
+        return embedding_data
+    float32_path = f"{os.path.splitext(path)[0]}.f32.npy"
+    if not os.path.exists(float32_path) or os.path.getmtime(float32_path) < os.path.getmtime(path):
+        tmp_path = f"{float32_path}.{os.getpid()}.tmp.npy"
+        np.save(tmp_path, embedding_data.astype(np.float32))
+        os.replace(tmp_path, float32_path)
+    return np.load(float32_path, mmap_mode="r")
 
 
 class EmbeddingCache:
     """
-    Generate embedding cache
+    Cached query / corpus embeddings of doc_qa_dataset.json.
+
+    The arrays are memory-mapped float32, queries are resolved through a query text -> row index map
+    and handed out as read-only row views. Nothing is read before the first access, so the cache can be
+    constructed before `build()` has written the files; the query rewrite embeddings are only loaded on request.
     """
-    def __init__(self, embedding_provider="OpenAI"):
+    def __init__(self, embedding_model: str = 'text-embedding-ada-002', embedding_provider="OpenAI"):
         self.embedding_provider = embedding_provider  # default using text-embedding-ada-002 from OpenAI
+        self.embedding_model = embedding_model
+        self._loaded = None
+        self.rewrite_queries = {}
+        self.rewrite_queries_embedding = None
+        self.rewrite_query_rows = {}
+        self._lock = threading.Lock()
+
+    def _load(self) -> tuple:
+        """(queries_embedding, corpus_embedding, query_rows, corpus), read from disk on first use"""
+        if self._loaded is None:
+            with self._lock:
+                if self._loaded is None:
+                    queries_embedding = load_float32(os.path.join(DATA_DIR, f"queries_{self.embedding_model}.npy"))
+                    corpus_embedding = load_float32(os.path.join(DATA_DIR, f"corpus_{self.embedding_model}.npy"))
+                    with open(os.path.join(DATA_DIR, "doc_qa_dataset.json"), "r", encoding="utf-8") as f:
+                        content = json.loads(f.read())
+                    query_rows = {query: i for i, query in enumerate(content["queries"].values())}
+                    self._loaded = (queries_embedding, corpus_embedding, query_rows, list(content["corpus"].values()))
+        return self._loaded
+
+    @property
+    def queries_embedding(self) -> np.ndarray:
+        return self._load()[0]
+
+    @property
+    def corpus_embedding(self) -> np.ndarray:
+        return self._load()[1]
+
+    @property
+    def query_rows(self) -> dict:
+        return self._load()[2]
+
+    @property
+    def corpus(self) -> list:
+        return self._load()[3]
 
     @staticmethod
     def build():
@@ -42,30 +89,38 @@ class EmbeddingCache:
         build_with_context("text-embedding-ada-002", "corpus")
 
     @staticmethod
-    def load(embedding_model: str = 'text-embedding-ada-002', query_write=False):
-        current_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        queries_embedding_data = np.load(os.path.join(current_dir, f"data/queries_{embedding_model}.npy"))
-        corpus_embedding_data = np.load(os.path.join(current_dir, f"data/corpus_{embedding_model}.npy"))
-        query_embedding_dict = {}
-        with open(os.path.join(current_dir, "data/doc_qa_dataset.json"), "r", encoding="utf-8") as f:
-            content = json.loads(f.read())
-        queries = list(content["queries"].values())
-        corpus = list(content["corpus"].values())
-        for i in range(len(queries)):
-            query_embedding_dict[queries[i]] = queries_embedding_data[i].tolist()
-        if query_write:
-            rewrite_queries_embedding_data = np.load(os.path.join(current_dir, "data/query_rewrite_openai_embedding.npy"))
-            with open("../data/query_rewrite.json", "r", encoding="utf-8") as f:
+    def build_index(embedding_model: str = 'text-embedding-ada-002', index_type: str = 'hnsw'):
+        """build the ANN faiss index of the cached corpus embedding once and write it to disk"""
+        from utils.faiss_index import load_or_build_faiss_index
+        from utils.index_registry import get_corpus_version
+
+        corpus_embedding_data = load_float32(os.path.join(DATA_DIR, f"corpus_{embedding_model}.npy"))
+        return load_or_build_faiss_index(embedding_model, get_corpus_version(embedding_model),
+                                         corpus_embedding_data, index_type)
+
+    def load_rewrite_queries(self):
+        """load the query rewrite results and their embeddings, only QueryRewriteEnsembleRetriever needs them"""
+        with self._lock:
+            if self.rewrite_queries_embedding is not None:
+                return
+            with open(os.path.join(DATA_DIR, "query_rewrite.json"), "r", encoding="utf-8") as f:
                 rewrite_content = json.loads(f.read())
+            rewrite_queries_list = [rewrite_query for rewrite_queries in rewrite_content.values()
+                                    for rewrite_query in rewrite_queries]
+            self.rewrite_queries = rewrite_content
+            self.rewrite_query_rows = {query: i for i, query in enumerate(rewrite_queries_list)}
+            self.rewrite_queries_embedding = load_float32(os.path.join(DATA_DIR, "query_rewrite_openai_embedding.npy"))
 
-            rewrite_queries_list = []
-            for original_query, rewrite_queries in rewrite_content.items():
-                rewrite_queries_list.extend(rewrite_queries)
-            for i in range(len(rewrite_queries_list)):
-                query_embedding_dict[rewrite_queries_list[i]] = rewrite_queries_embedding_data[i].tolist()
-        return query_embedding_dict, corpus_embedding_data, corpus
+    def get_query_embedding(self, query: str) -> Optional[np.ndarray]:
+        """read-only float32 view of a cached query embedding, None if the query is not cached"""
+        row = self.query_rows.get(query)
+        if row is not None:
+            return self.queries_embedding[row]
+        row = self.rewrite_query_rows.get(query)
+        if row is not None:
+            return self.rewrite_queries_embedding[row]
+        return None
 
 
 if __name__ == '__main__':
-    EmbeddingCache().build()
-    EmbeddingCache.load("text-embedding-ada-002")
+    EmbeddingCache.build()
@@ -1,13 +1,33 @@
 import json
+from typing import AsyncIterator, Iterator, Optional
 
+import httpx
 import requests
+import tiktoken
 
-from config.config_parser import SYSTEM_ROLE, CHAT_COMPLETION_API, OPENAI_API_KEY
+from config.config_parser import SYSTEM_ROLE, CHAT_COMPLETION_API, OPENAI_API_KEY, RESOURCE_HTTP_TIMEOUT
 
+from utils.deadline import Deadline
+from utils.hedge import ahedged, hedged
 from utils.logger import logger
+from utils.metrics import record_tokens
+from utils.rate_limiter import get_rate_limiter
+from utils.resources import resource_manager
 
+MAX_TOKENS = 1024
 
-def chat_completion(message, model_name):
+
+def post_chat_completion(payload: str, headers: dict, stream: bool = False,
+                         deadline: Optional[Deadline] = None) -> requests.Response:
+    # every attempt only waits for what is left of the request deadline
+    timeout = deadline.timeout(RESOURCE_HTTP_TIMEOUT) if deadline else RESOURCE_HTTP_TIMEOUT
+    response = resource_manager.http_session.post(CHAT_COMPLETION_API, headers=headers, data=payload, stream=stream,
+                                                  timeout=timeout)
+    response.raise_for_status()
+    return response
+
+
+def build_chat_request(message, model_name, stream: bool = False):
     payload = json.dumps({
         "model": model_name,
         "messages": [
@@ -21,22 +41,115 @@ def chat_completion(message, model_name):
             }
         ],
         "temperature": 0.0,
-        "max_tokens": 1024
+        "max_tokens": MAX_TOKENS,
+        "stream": stream
     }
     )
-    chat_completion_api = CHAT_COMPLETION_API
     headers = {"Content-Type": 'application/json', "Authorization": f"Bearer {OPENAI_API_KEY}"}
 
-    response = requests.request(
-        "POST",
-        chat_completion_api,
-        headers=headers,
-        data=payload
-    )
+    # the tokens/min quota counts the prompt plus the completion budget
+    tokens = count_prompt_tokens(message) + MAX_TOKENS
+    return payload, headers, tokens
+
+
+def count_prompt_tokens(message) -> int:
+    return len(tiktoken.get_encoding("cl100k_base").encode(SYSTEM_ROLE + message, disallowed_special=()))
+
+
+def parse_completion(response_json: dict, model_name) -> str:
+    usage = response_json.get('usage') or {}
+    record_tokens(model_name, usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0))
+    return response_json['choices'][0]['message']['content']
+
+
+def request_chat_completion(message, model_name, stream: bool = False,
+                            deadline: Optional[Deadline] = None) -> requests.Response:
+    payload, headers, tokens = build_chat_request(message, model_name, stream)
+    return get_rate_limiter("openai_chat").call(post_chat_completion, payload, headers, stream, deadline,
+                                                tokens=tokens, deadline=deadline)
+
+
+def parse_stream_line(line: str) -> Optional[str]:
+    """content delta of one server-sent event line, "" for lines without content, None at [DONE]"""
+    if not line or not line.startswith("data:"):
+        return ""
+    data = line[len("data:"):].strip()
+    if data == "[DONE]":
+        return None
+    choices = json.loads(data).get("choices")
+    return (choices[0].get("delta", {}).get("content") or "") if choices else ""
+
+
+def chat_completion(message, model_name, deadline: Optional[Deadline] = None):
+    response = hedged("llm", model_name, lambda: request_chat_completion(message, model_name, deadline=deadline),
+                      deadline)
     logger.info(f"Model_Name: {model_name}, response: {response.text}")
-    return response.json()['choices'][0]['message']['content']
+    return parse_completion(response.json(), model_name)
+
+
+def chat_completion_stream(message, model_name, deadline: Optional[Deadline] = None) -> Iterator[str]:
+    """yield the answer token by token as the server-sent events of the completion arrive"""
+    response = request_chat_completion(message, model_name, stream=True, deadline=deadline)
+    # event streams come without a charset, the json chunks are utf-8
+    response.encoding = "utf-8"
+    # streamed chunks carry no usage, each content delta is about one token
+    chunks = 0
+    with response:
+        for line in response.iter_lines(decode_unicode=True):
+            content = parse_stream_line(line)
+            if content is None:
+                break
+            if content:
+                chunks += 1
+                yield content
+    record_tokens(model_name, count_prompt_tokens(message), chunks)
+    logger.info(f"Model_Name: {model_name}, streamed response finished")
+
+
+async def apost_chat_completion(payload: str, headers: dict, stream: bool = False,
+                               deadline: Optional[Deadline] = None) -> httpx.Response:
+    client = resource_manager.async_http
+    timeout = deadline.timeout(RESOURCE_HTTP_TIMEOUT) if deadline else httpx.USE_CLIENT_DEFAULT
+    response = await client.send(client.build_request("POST", CHAT_COMPLETION_API, headers=headers, content=payload,
+                                                      timeout=timeout),
+                                 stream=stream)
+    if response.is_error:
+        await response.aread()
+        await response.aclose()
+    response.raise_for_status()
+    return response
+
+
+async def achat_completion(message, model_name, deadline: Optional[Deadline] = None):
+    payload, headers, tokens = build_chat_request(message, model_name)
+    response = await ahedged("llm", model_name, lambda: get_rate_limiter("openai_chat").acall(
+        apost_chat_completion, payload, headers, False, deadline, tokens=tokens, deadline=deadline), deadline)
+    logger.info(f"Model_Name: {model_name}, response: {response.text}")
+    return parse_completion(response.json(), model_name)
+
+
+async def achat_completion_stream(message, model_name, deadline: Optional[Deadline] = None) -> AsyncIterator[str]:
+    # streams are not hedged, the deadline bounds the wait for the response and for each chunk
+    payload, headers, tokens = build_chat_request(message, model_name, stream=True)
+    response = await get_rate_limiter("openai_chat").acall(apost_chat_completion, payload, headers, True, deadline,
+                                                           tokens=tokens, deadline=deadline)
+    chunks = 0
+    try:
+        async for line in response.aiter_lines():
+            content = parse_stream_line(line)
+            if content is None:
+                break
+            if content:
+                chunks += 1
+                yield content
+    finally:
+        await response.aclose()
+    record_tokens(model_name, tokens - MAX_TOKENS, chunks)
+    logger.info(f"Model_Name: {model_name}, streamed response finished")
 
 
 if __name__ == '__main__':
     completion = chat_completion("你好", "gpt-3.5-turbo")
     print(completion)
+    for token in chat_completion_stream("你好", "gpt-3.5-turbo"):
+        print(token, end="", flush=True)
@@ -0,0 +1,25 @@
+import os
+import time
+
+from config.config_parser import PROJECT_DIR
+
+CORPUS_VERSION_PATH = os.path.join(PROJECT_DIR, "data/corpus_version")
+
+
+def read_corpus_version() -> str:
+    """version of the ingested corpus (Milvus / ES / local BM25), shared by every process through a file"""
+    try:
+        with open(CORPUS_VERSION_PATH, "r", encoding="utf-8") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return "0"
+
+
+def bump_corpus_version() -> str:
+    """called by ingestion, everything derived from the previous corpus is stale afterwards"""
+    version = str(time.time_ns())
+    tmp_path = f"{CORPUS_VERSION_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(version)
+    os.replace(tmp_path, CORPUS_VERSION_PATH)
+    return version
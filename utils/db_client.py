@@ -7,10 +7,10 @@ from pymilvus import (
     Collection,
 )
 from pymilvus import utility
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, AsyncElasticsearch
 
-# 连接Elasticsearch
-es_client = Elasticsearch("http://localhost:9200")
+# ES / Milvus客户端由resource_manager统一创建和复用(连接池, 健康检查, 关闭)
+from utils.resources import resource_manager
 
 
 def initialize_es(index_name):
@@ -44,6 +44,7 @@ def initialize_es(index_name):
         }
     }
 
+    es_client = get_es_client()
     es_client.indices.create(index=index_name, ignore=400)
     result = es_client.indices.put_mapping(index=index_name, body=mapping)
 
@@ -51,7 +52,7 @@ def initialize_es(index_name):
 
 
 def initialize_vector_store_milvus(collection_name):
-    connections.connect("default", host="localhost", port="19530")
+    resource_manager.connect_milvus()
     # Create a collection
     fields = [
         FieldSchema(name="pk", dtype=DataType.INT64, is_primary=True, auto_id=False),
@@ -74,13 +75,17 @@ def initialize_vector_store_milvus(collection_name):
     logger.info(f"Milvus Index {collection_name} created successfully.")
 
 
-def get_es_client():
-    return es_client
+def get_es_client() -> Elasticsearch:
+    return resource_manager.es
 
 
-def get_milvus_client(collection_name):
-    connections.connect("default", host="localhost", port="19530")
-    return Collection(collection_name)
+def get_async_es_client() -> AsyncElasticsearch:
+    return resource_manager.async_es
+
+
+def get_milvus_client(collection_name) -> Collection:
+    # 只在第一次调用时建立连接, 之后复用连接和Collection对象
+    return resource_manager.milvus_collection(collection_name)
 
 
 if __name__ == '__main__':
@@ -88,7 +93,7 @@ if __name__ == '__main__':
     # initialize_es(index_name)
 
     vector_collection = "docs_qa"
-    connections.connect("default", host="localhost", port="19530")
+    resource_manager.connect_milvus()
     # # # drop existing collection
     # # utility.drop_collection(vector_collection)
     #
@@ -0,0 +1,48 @@
+import math
+import time
+from typing import Optional
+
+from config.config_parser import DEADLINE_REQUEST_BUDGET
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class Deadline:
+    """
+    Time budget of one request.
+
+    Created when the request arrives and passed down the pipeline, every stage (embedding, Milvus, ES,
+    rerank, LLM) only waits for what is left of the budget. A budget of None / 0 never expires.
+    """
+    def __init__(self, budget: Optional[float] = None):
+        self.budget = budget or None
+        self.expires_at = time.monotonic() + budget if budget else None
+
+    @classmethod
+    def from_config(cls) -> "Deadline":
+        return cls(DEADLINE_REQUEST_BUDGET)
+
+    def remaining(self) -> float:
+        if self.expires_at is None:
+            return math.inf
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def timeout(self, cap: Optional[float] = None, reserve: float = 0.0) -> Optional[float]:
+        """seconds a stage may take: what is left after `reserve` for the later stages, at most `cap`"""
+        if self.expires_at is None:
+            return cap
+        left = max(0.0, self.remaining() - reserve)
+        return left if cap is None else min(cap, left)
+
+    def allows(self, seconds: float, reserve: float = 0.0) -> bool:
+        return self.remaining() - reserve >= seconds
+
+    def check(self, stage: str):
+        if self.expired:
+            raise DeadlineExceeded(f"request deadline of {self.budget}s exceeded before {stage}")
@@ -0,0 +1,200 @@
+import asyncio
+import threading
+from typing import Dict, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tiktoken
+
+from config.config_parser import (
+    BGE_EMBEDDING_API,
+    EMBEDDING_MAX_BATCH_ITEMS, EMBEDDING_MAX_BATCH_TOKENS, EMBEDDING_CONCURRENCY
+)
+from utils.query_embedding_cache import get_query_embedding_cache
+from utils.hedge import ahedged, hedged
+from utils.rate_limiter import get_rate_limiter
+from utils.resources import resource_manager
+from utils.logger import logger
+
+EMBEDDING_DIMENSIONS = {
+    'text-embedding-ada-002': 1536,
+    'text-embedding-3-small': 1536,
+    'text-embedding-3-large': 3072,
+    'bge-large-zh-v1.5': 1024,
+}
+
+
+class EmbeddingProvider:
+    """
+    Embeds many texts with as few API calls as possible.
+
+    Inputs are grouped into multi-input requests bounded by an item and a token budget, up to
+    `concurrency` requests run at once over a pooled client, results are returned as one float32
+    array in input order. The query embedding cache is consulted first unless `use_cache=False`.
+    Requests go through the rate limiter of `rate_limit_provider`, a single-request call (e.g. a query)
+    is hedged after the p95 latency if the embedding stage is enabled in config `hedge`.
+    """
+    rate_limit_provider = "openai_embedding"
+
+    def __init__(self, model_name: str,
+                 max_batch_items: int = EMBEDDING_MAX_BATCH_ITEMS,
+                 max_batch_tokens: int = EMBEDDING_MAX_BATCH_TOKENS,
+                 concurrency: int = EMBEDDING_CONCURRENCY):
+        self.model_name = model_name
+        self.dimensions = EMBEDDING_DIMENSIONS[model_name]
+        self.max_batch_items = max_batch_items
+        self.max_batch_tokens = max_batch_tokens
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=f"embedding_{model_name}")
+        self.rate_limiter = get_rate_limiter(self.rate_limit_provider)
+
+    def count_tokens(self, text: str) -> int:
+        return len(text)
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        raise NotImplementedError
+
+    def batches(self, texts: List[str]) -> List[List[int]]:
+        """split input positions into batches under the item and token budget"""
+        batches, batch, batch_tokens = [], [], 0
+        for i, text in enumerate(texts):
+            tokens = self.count_tokens(text)
+            if batch and (len(batch) >= self.max_batch_items or batch_tokens + tokens > self.max_batch_tokens):
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(i)
+            batch_tokens += tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def batch_requests(self, texts: List[str], batches: List[List[int]]) -> List[Tuple[List[str], int]]:
+        """(texts, tokens) of each request"""
+        return [([texts[i] for i in batch], sum(self.count_tokens(texts[i]) for i in batch)) for batch in batches]
+
+    def _from_cache(self, texts: List[str], use_cache: bool):
+        texts = [text.replace("\n", " ") for text in texts]
+        result = np.empty((len(texts), self.dimensions), dtype=np.float32)
+        cache = get_query_embedding_cache() if use_cache else None
+
+        missing = []
+        for i, text in enumerate(texts):
+            embedding = cache.get(self.model_name, self.dimensions, text) if cache else None
+            if embedding is None:
+                missing.append(i)
+            else:
+                result[i] = embedding
+        return texts, result, missing, cache
+
+    def _fill(self, result: np.ndarray, missing: List[int], missing_texts: List[str], batch: List[int],
+              embeddings: List[List[float]], cache):
+        for i, embedding in zip(batch, embeddings):
+            result[missing[i]] = embedding
+            if cache:
+                cache.put(self.model_name, self.dimensions, missing_texts[i], result[missing[i]])
+
+    def embed(self, texts: List[str], use_cache: bool = True) -> np.ndarray:
+        texts, result, missing, cache = self._from_cache(texts, use_cache)
+        if not missing:
+            return result
+
+        missing_texts = [texts[i] for i in missing]
+        batches = self.batches(missing_texts)
+        batch_requests = self.batch_requests(missing_texts, batches)
+        if len(batch_requests) == 1:
+            batch_texts, tokens = batch_requests[0]
+            outputs = [hedged("embedding", self.model_name,
+                              lambda: self.rate_limiter.call(self._embed_batch, batch_texts, tokens=tokens))]
+        else:
+            futures = [self.executor.submit(self.rate_limiter.call, self._embed_batch, batch_texts, tokens=tokens)
+                       for batch_texts, tokens in batch_requests]
+            outputs = [future.result() for future in futures]
+        for batch, embeddings in zip(batches, outputs):
+            self._fill(result, missing, missing_texts, batch, embeddings, cache)
+        logger.info(f"{self.model_name} embedded {len(missing)} texts in {len(batches)} requests")
+        return result
+
+    async def _aembed_batch(self, texts: List[str]) -> List[List[float]]:
+        raise NotImplementedError
+
+    async def aembed(self, texts: List[str], use_cache: bool = True) -> np.ndarray:
+        """`embed` for the event loop, the batches are sent concurrently over the async client"""
+        texts, result, missing, cache = self._from_cache(texts, use_cache)
+        if not missing:
+            return result
+
+        missing_texts = [texts[i] for i in missing]
+        batches = self.batches(missing_texts)
+        batch_requests = self.batch_requests(missing_texts, batches)
+        if len(batch_requests) == 1:
+            batch_texts, tokens = batch_requests[0]
+            outputs = [await ahedged("embedding", self.model_name,
+                                     lambda: self.rate_limiter.acall(self._aembed_batch, batch_texts, tokens=tokens))]
+        else:
+            outputs = await asyncio.gather(*[self.rate_limiter.acall(self._aembed_batch, batch_texts, tokens=tokens)
+                                             for batch_texts, tokens in batch_requests])
+        for batch, embeddings in zip(batches, outputs):
+            self._fill(result, missing, missing_texts, batch, embeddings, cache)
+        logger.info(f"{self.model_name} embedded {len(missing)} texts in {len(batches)} async requests")
+        return result
+
+
+class OpenAIEmbeddingProvider(EmbeddingProvider):
+    def __init__(self, model_name: str, **kwargs):
+        super().__init__(model_name, **kwargs)
+        self.encoding = tiktoken.get_encoding("cl100k_base")
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        response = resource_manager.openai.embeddings.create(model=self.model_name, input=texts, encoding_format="float")
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+    async def _aembed_batch(self, texts: List[str]) -> List[List[float]]:
+        response = await resource_manager.async_openai.embeddings.create(model=self.model_name, input=texts,
+                                                                         encoding_format="float")
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+class BgeEmbeddingProvider(EmbeddingProvider):
+    """local bge embedding service of services/api.py, multi-text requests to /embedding/batch over the shared session"""
+    rate_limit_provider = "bge_embedding"
+
+    def __init__(self, model_name: str = 'bge-large-zh-v1.5', **kwargs):
+        super().__init__(model_name, **kwargs)
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        response = resource_manager.http_session.post(f"{BGE_EMBEDDING_API}/batch",
+                                                      params={"model_name": self.model_name}, json={"texts": texts})
+        response.raise_for_status()
+        return response.json()['embeddings']
+
+    async def _aembed_batch(self, texts: List[str]) -> List[List[float]]:
+        response = await resource_manager.async_http.post(f"{BGE_EMBEDDING_API}/batch",
+                                                          params={"model_name": self.model_name}, json={"texts": texts})
+        response.raise_for_status()
+        return response.json()['embeddings']
+
+
+_providers: Dict[str, EmbeddingProvider] = {}
+_lock = threading.Lock()
+
+
+def get_embedding_provider(model_name: str) -> EmbeddingProvider:
+    """process wide provider per embedding model"""
+    provider: Optional[EmbeddingProvider] = _providers.get(model_name)
+    if provider is None:
+        with _lock:
+            provider = _providers.get(model_name)
+            if provider is None:
+                if model_name.startswith('bge'):
+                    provider = BgeEmbeddingProvider(model_name)
+                else:
+                    provider = OpenAIEmbeddingProvider(model_name)
+                _providers[model_name] = provider
+    return provider
+
+
+if __name__ == '__main__':
+    embeddings = get_embedding_provider('text-embedding-3-small').embed(["I live in Beijing.", "你好"])
+    print(embeddings.shape, embeddings.dtype)
@@ -0,0 +1,75 @@
+import os
+
+import faiss
+import numpy as np
+
+from config.config_parser import (
+    FAISS_INDEX_TYPE, FAISS_INDEX_DIR, FAISS_NLIST, FAISS_PQ_M, FAISS_PQ_NBITS,
+    FAISS_HNSW_M, FAISS_EF_CONSTRUCTION, FAISS_NPROBE, FAISS_EF_SEARCH
+)
+from utils.logger import logger
+
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+
+
+def build_faiss_index(embeddings: np.ndarray, index_type: str = FAISS_INDEX_TYPE) -> faiss.Index:
+    """build an inner product index over float32 embeddings"""
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    num, dimensions = embeddings.shape
+    if index_type == "flat":
+        index = faiss.IndexFlatIP(dimensions)
+    elif index_type in ("ivf_flat", "ivf_pq"):
+        # faiss needs at least nlist training points
+        nlist = max(1, min(FAISS_NLIST, num))
+        quantizer = faiss.IndexFlatIP(dimensions)
+        if index_type == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, dimensions, nlist, faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.IndexIVFPQ(quantizer, dimensions, nlist, FAISS_PQ_M, FAISS_PQ_NBITS,
+                                     faiss.METRIC_INNER_PRODUCT)
+        index.train(embeddings)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dimensions, FAISS_HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = FAISS_EF_CONSTRUCTION
+    else:
+        raise ValueError(f"unsupported faiss index type: {index_type}, expect one of {INDEX_TYPES}")
+    index.add(embeddings)
+    return index
+
+
+def set_search_params(index: faiss.Index, nprobe: int = FAISS_NPROBE, ef_search: int = FAISS_EF_SEARCH):
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = ef_search
+    else:
+        try:
+            faiss.extract_index_ivf(index).nprobe = nprobe
+        except RuntimeError:
+            pass  # not an IVF index, nothing to tune
+    return index
+
+
+def faiss_index_path(embedding_model: str, corpus_version: str, index_type: str = FAISS_INDEX_TYPE) -> str:
+    return os.path.join(FAISS_INDEX_DIR, f"{embedding_model}_{corpus_version}_{index_type}.index")
+
+
+def load_or_build_faiss_index(embedding_model: str, corpus_version: str, embeddings: np.ndarray,
+                              index_type: str = FAISS_INDEX_TYPE) -> faiss.Index:
+    """
+    Exact flat indexes are built in memory. ANN indexes are built once, written to `index_dir`
+    and then loaded with IO_FLAG_MMAP, so the inverted lists of IVF indexes are memory-mapped and
+    shared by every worker process on the host.
+    """
+    if index_type == "flat":
+        return build_faiss_index(embeddings, index_type)
+
+    index_path = faiss_index_path(embedding_model, corpus_version, index_type)
+    if not os.path.exists(index_path):
+        os.makedirs(FAISS_INDEX_DIR, exist_ok=True)
+        logger.info(f"building {index_type} faiss index for {embedding_model}, corpus version {corpus_version}")
+        # write to a temp file first, concurrently starting workers never read a half written index
+        tmp_path = f"{index_path}.{os.getpid()}.tmp"
+        faiss.write_index(build_faiss_index(embeddings, index_type), tmp_path)
+        os.replace(tmp_path, index_path)
+    index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    logger.info(f"faiss index {index_path} loaded with {index.ntotal} vectors")
+    return set_search_params(index)
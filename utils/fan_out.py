@@ -0,0 +1,68 @@
+import time
+import asyncio
+import contextvars
+from typing import Any, Awaitable, Callable, Dict, Union
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from utils.logger import logger
+
+
+# 检索分支共用的线程池, 各分支都是网络I/O, 线程数不必与CPU核数挂钩
+retrieval_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="retrieval_leg")
+# rerank单独使用线程池: 超时的rerank调用无法取消, 不能占用检索分支的线程
+rerank_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="rerank")
+
+
+def fan_out(legs: Dict[str, Callable[[], Any]],
+            timeout: Union[float, Dict[str, float], None] = None,
+            default: Any = None,
+            executor: ThreadPoolExecutor = retrieval_executor) -> Dict[str, Any]:
+    """
+    Run several retrieval legs (e.g. ES bm25 and vector search) concurrently.
+
+    All legs are submitted at once, so the latency is that of the slowest leg
+    instead of their sum. A leg that raises or exceeds its timeout is logged
+    and replaced by `default`, the other legs' results are still returned.
+
+    :param legs: leg name -> zero-argument callable
+    :param timeout: seconds, either one value for every leg or a per-leg dict
+    :param default: value returned for a failed / timed out leg
+    :param executor: pool the legs run on, a timed out leg keeps its thread until it returns
+    :return: leg name -> result, in the same order as `legs`
+    """
+    start = time.perf_counter()
+    # each leg runs in a copy of the caller's context, so request scoped state (e.g. the metrics trace) follows it
+    futures = {name: executor.submit(contextvars.copy_context().run, fn) for name, fn in legs.items()}
+
+    results = {}
+    for name, future in futures.items():
+        leg_timeout = timeout.get(name) if isinstance(timeout, dict) else timeout
+        remaining = None if leg_timeout is None else max(0.0, start + leg_timeout - time.perf_counter())
+        try:
+            results[name] = future.result(timeout=remaining)
+        except FutureTimeoutError:
+            future.cancel()
+            logger.warning(f"retrieval leg {name} timed out after {leg_timeout}s, continue without it")
+            results[name] = default
+        except Exception as e:
+            logger.error(f"retrieval leg {name} failed: {e!r}, continue without it")
+            results[name] = default
+    return results
+
+
+async def afan_out(legs: Dict[str, Callable[[], Awaitable[Any]]],
+                   timeout: Union[float, Dict[str, float], None] = None,
+                   default: Any = None) -> Dict[str, Any]:
+    """`fan_out` for coroutine legs, all legs run concurrently on the event loop"""
+    async def run_leg(name, fn):
+        leg_timeout = timeout.get(name) if isinstance(timeout, dict) else timeout
+        try:
+            return await asyncio.wait_for(fn(), leg_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"retrieval leg {name} timed out after {leg_timeout}s, continue without it")
+        except Exception as e:
+            logger.error(f"retrieval leg {name} failed: {e!r}, continue without it")
+        return default
+
+    results = await asyncio.gather(*[run_leg(name, fn) for name, fn in legs.items()])
+    return dict(zip(legs, results))
@@ -0,0 +1,142 @@
+"""
+Hedged requests for the embedding and LLM calls.
+
+Latencies of recent calls are kept per call site (stage + model). Once a call has been running longer
+than their `hedge.quantile` (p95 by default), an identical second request is sent and whichever
+answers first wins, the other one is cancelled (coroutines) or left to finish in the background
+(threads). With a p95 delay at most ~5% of the calls are duplicated, while a single slow upstream
+request no longer sets the tail latency.
+"""
+import time
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+import numpy as np
+
+from config.config_parser import (
+    HEDGE_ENABLED, HEDGE_STAGES, HEDGE_QUANTILE, HEDGE_MIN_DELAY_MS, HEDGE_WINDOW, HEDGE_MIN_SAMPLES
+)
+from utils.deadline import Deadline
+from utils.logger import logger
+
+T = TypeVar("T")
+
+# 同步调用的对冲请求在这个线程池中执行
+hedge_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="hedge")
+
+
+class LatencyTracker:
+    """sliding window of the latencies of one call site"""
+    def __init__(self, window: int = HEDGE_WINDOW, min_samples: int = HEDGE_MIN_SAMPLES):
+        self.latencies = deque(maxlen=window)
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self.latencies.append(seconds)
+
+    def quantile(self, q: float) -> Optional[float]:
+        with self._lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+            return float(np.quantile(self.latencies, q))
+
+
+_trackers: Dict[str, LatencyTracker] = {}
+_lock = threading.Lock()
+
+
+def get_latency_tracker(name: str) -> LatencyTracker:
+    tracker = _trackers.get(name)
+    if tracker is None:
+        with _lock:
+            tracker = _trackers.setdefault(name, LatencyTracker())
+    return tracker
+
+
+def hedge_delay(tracker: LatencyTracker, deadline: Optional[Deadline] = None) -> Optional[float]:
+    """seconds to wait before the hedged request, None if the call is not hedged"""
+    latency = tracker.quantile(HEDGE_QUANTILE)
+    if latency is None:
+        return None
+    delay = max(latency, HEDGE_MIN_DELAY_MS / 1000)
+    # a hedge sent after the deadline could never win
+    if deadline is not None and not deadline.allows(delay):
+        return None
+    return delay
+
+
+def _timed(tracker: LatencyTracker, fn: Callable[[], T]) -> T:
+    start = time.perf_counter()
+    result = fn()
+    tracker.record(time.perf_counter() - start)
+    return result
+
+
+def hedged(stage: str, key: str, fn: Callable[[], T], deadline: Optional[Deadline] = None) -> T:
+    """`fn()`, hedged after the p95 latency of `stage:key` if the stage is listed in hedge.stages"""
+    if not HEDGE_ENABLED or stage not in HEDGE_STAGES:
+        return fn()
+    tracker = get_latency_tracker(f"{stage}:{key}")
+    delay = hedge_delay(tracker, deadline)
+    if delay is None:
+        return _timed(tracker, fn)
+
+    futures = [hedge_executor.submit(_timed, tracker, fn)]
+    done, _ = wait(futures, timeout=delay)
+    if not done:
+        logger.info(f"{stage}:{key} still running after p{HEDGE_QUANTILE * 100:.0f} {delay * 1000:.0f}ms, "
+                    f"sending a hedged request")
+        futures.append(hedge_executor.submit(_timed, tracker, fn))
+
+    # the first successful response wins, an error only counts once every request failed
+    error, pending = None, set(futures)
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            error = future.exception()
+    raise error
+
+
+async def _atimed(tracker: LatencyTracker, fn: Callable[[], Awaitable[T]]) -> T:
+    start = time.perf_counter()
+    result = await fn()
+    tracker.record(time.perf_counter() - start)
+    return result
+
+
+async def ahedged(stage: str, key: str, fn: Callable[[], Awaitable[T]], deadline: Optional[Deadline] = None) -> T:
+    """`hedged` for coroutine functions, the slower request is cancelled"""
+    if not HEDGE_ENABLED or stage not in HEDGE_STAGES:
+        return await fn()
+    tracker = get_latency_tracker(f"{stage}:{key}")
+    delay = hedge_delay(tracker, deadline)
+    if delay is None:
+        return await _atimed(tracker, fn)
+
+    tasks = [asyncio.ensure_future(_atimed(tracker, fn))]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            logger.info(f"{stage}:{key} still running after p{HEDGE_QUANTILE * 100:.0f} {delay * 1000:.0f}ms, "
+                        f"sending a hedged request")
+            tasks.append(asyncio.ensure_future(_atimed(tracker, fn)))
+
+        error, pending = None, set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
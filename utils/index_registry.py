@@ -0,0 +1,93 @@
+import os
+import sys
+import threading
+from typing import Dict, Tuple
+
+import numpy as np
+
+from config.config_parser import PROJECT_DIR, FAISS_INDEX_TYPE, FAISS_QUANTIZATION
+from utils.build_embedding import EmbeddingCache
+from utils.faiss_index import load_or_build_faiss_index
+from utils.quantization import RescoringIndex
+from utils.file_utils import size_converter
+from utils.logger import logger
+
+
+def get_corpus_version(embedding_model: str) -> str:
+    """corpus version derived from the cached corpus embedding file, changes whenever it is rebuilt"""
+    stat = os.stat(os.path.join(PROJECT_DIR, f"data/corpus_{embedding_model}.npy"))
+    return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+
+class VectorIndexEntry:
+    """
+    One faiss index together with the corpus and query embeddings it was built from.
+    Entries are shared by every retriever in the process and must be treated as read-only.
+    """
+    def __init__(self, embedding_model: str, corpus_version: str, index_type: str = FAISS_INDEX_TYPE):
+        self.embedding_model = embedding_model
+        self.corpus_version = corpus_version
+        self.index_type = index_type
+        self.embedding_cache = EmbeddingCache(embedding_model)
+        # read-only float32 memory map, pages are only resident while an index is built or rescored
+        self.corpus_embedding = self.embedding_cache.corpus_embedding
+        self.corpus = tuple(self.embedding_cache.corpus)
+        if index_type == "flat" and FAISS_QUANTIZATION != "none":
+            self.faiss_index = RescoringIndex(self.corpus_embedding, FAISS_QUANTIZATION)
+        else:
+            self.faiss_index = load_or_build_faiss_index(embedding_model, corpus_version,
+                                                         self.corpus_embedding, index_type)
+
+    def footprint(self) -> Dict[str, int]:
+        """approximate bytes held by this entry, memory-mapped ANN index pages are shared between processes"""
+        index_bytes = self.faiss_index.ntotal * getattr(self.faiss_index, "code_size", self.faiss_index.d * 4)
+        return {
+            "corpus_embedding": 0 if isinstance(self.corpus_embedding, np.memmap) else self.corpus_embedding.nbytes,
+            "faiss_index": index_bytes,
+            "corpus": sum(sys.getsizeof(text) for text in self.corpus),
+            "query_rows": sum(sys.getsizeof(query) for query in self.embedding_cache.query_rows)
+            + sum(sys.getsizeof(query) for query in self.embedding_cache.rewrite_query_rows),
+        }
+
+
+class IndexRegistry:
+    """
+    Process wide registry handing out one shared VectorIndexEntry per (embedding model, corpus version),
+    entries are built lazily on first use.
+    """
+    def __init__(self):
+        self._entries: Dict[Tuple[str, str], VectorIndexEntry] = {}
+        self._lock = threading.Lock()
+
+    def get(self, embedding_model: str = 'text-embedding-ada-002', corpus_version: str = None,
+            query_rewrite: bool = False) -> VectorIndexEntry:
+        if corpus_version is None:
+            corpus_version = get_corpus_version(embedding_model)
+        key = (embedding_model, corpus_version)
+        entry = self._entries.get(key)
+        if entry is None:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is None:
+                    entry = VectorIndexEntry(embedding_model, corpus_version)
+                    self._entries[key] = entry
+                    logger.info(f"vector index {key} loaded, "
+                                f"memory footprint: {size_converter(sum(entry.footprint().values()))}")
+        if query_rewrite:
+            entry.embedding_cache.load_rewrite_queries()
+        return entry
+
+    def memory_footprint(self) -> Dict[Tuple[str, str], Dict[str, int]]:
+        return {key: entry.footprint() for key, entry in self._entries.items()}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+index_registry = IndexRegistry()
+
+
+if __name__ == '__main__':
+    index_registry.get("text-embedding-ada-002")
+    print(index_registry.memory_footprint())
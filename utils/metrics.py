@@ -0,0 +1,115 @@
+"""
+Per stage latency metrics of the QA pipeline and the custom retrievers, exported for Prometheus.
+
+`span(stage)` times one stage (query_embedding, vector_search, bm25_search, fusion, rerank,
+prompt_build, llm, ...) into the `qa_stage_seconds` histogram, `record_count` / `record_tokens`
+count the candidates of a stage and the LLM tokens. A request started with `start_trace()` also
+collects its own spans and counts, services/api.py attaches them to the response in debug mode.
+The hit ratios of the embedding / rerank / answer caches are read from their `stats()` on scrape.
+"""
+import time
+import contextvars
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional
+
+from prometheus_client import Counter, Gauge, Histogram, generate_latest
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+STAGE_SECONDS = Histogram("qa_stage_seconds", "latency of one pipeline stage", ["stage"], buckets=LATENCY_BUCKETS)
+STAGE_ERRORS = Counter("qa_stage_errors_total", "pipeline stages that raised", ["stage"])
+STAGE_CANDIDATES = Histogram("qa_stage_candidates", "documents returned by a pipeline stage", ["stage"],
+                             buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500))
+LLM_TOKENS = Counter("qa_llm_tokens_total", "prompt / completion tokens of the chat completions", ["model", "kind"])
+REQUEST_SECONDS = Histogram("qa_request_seconds", "end to end latency of an api request", ["endpoint"],
+                            buckets=LATENCY_BUCKETS)
+REQUESTS = Counter("qa_requests_total", "api requests by status", ["endpoint", "status"])
+DEGRADED = Counter("qa_degraded_total", "degradations taken to meet the request deadline", ["action"])
+CACHE_HIT_RATIO = Gauge("qa_cache_hit_ratio", "hit ratio of a cache since process start", ["cache"])
+CACHE_ENTRIES = Gauge("qa_cache_entries", "entries held by a cache", ["cache"])
+
+
+class RequestTrace:
+    """spans and counts of one request"""
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans: List[dict] = []
+        self.counts: Dict[str, int] = {}
+        self.tokens: Dict[str, int] = {}
+
+    def to_dict(self) -> dict:
+        stage_ms = {}
+        for span_ in self.spans:
+            stage_ms[span_["stage"]] = stage_ms.get(span_["stage"], 0.0) + span_["ms"]
+        return {"stage_ms": stage_ms, "spans": self.spans, "counts": self.counts, "tokens": self.tokens,
+                "caches": cache_stats()}
+
+
+# contextvars follow the request into its asyncio tasks, fan_out copies them into the worker threads
+_current_trace: contextvars.ContextVar[Optional[RequestTrace]] = contextvars.ContextVar("qa_trace", default=None)
+
+
+def start_trace() -> RequestTrace:
+    trace = RequestTrace()
+    _current_trace.set(trace)
+    return trace
+
+
+@contextmanager
+def span(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.labels(stage).inc()
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        STAGE_SECONDS.labels(stage).observe(seconds)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.spans.append({"stage": stage, "start_ms": round((start - trace.start) * 1000, 2),
+                                "ms": round(seconds * 1000, 2)})
+
+
+def record_count(stage: str, value: int):
+    STAGE_CANDIDATES.labels(stage).observe(value)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.counts[stage] = trace.counts.get(stage, 0) + value
+
+
+def record_tokens(model: str, prompt_tokens: int, completion_tokens: int):
+    LLM_TOKENS.labels(model, "prompt").inc(prompt_tokens)
+    LLM_TOKENS.labels(model, "completion").inc(completion_tokens)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.tokens["prompt"] = trace.tokens.get("prompt", 0) + prompt_tokens
+        trace.tokens["completion"] = trace.tokens.get("completion", 0) + completion_tokens
+
+
+def record_request(endpoint: str, status: str, seconds: float, degraded: Iterable[str] = ()):
+    REQUEST_SECONDS.labels(endpoint).observe(seconds)
+    REQUESTS.labels(endpoint, status).inc()
+    for action in degraded:
+        DEGRADED.labels(action.split(":")[0]).inc()
+
+
+def cache_stats() -> Dict[str, dict]:
+    # imported here, so that importing the metrics does not load the caches and their embedding providers;
+    # only the caches already in use are reported, a scrape never creates one
+    from utils.answer_cache import peek_answer_cache
+    from utils.query_embedding_cache import peek_query_embedding_cache
+    from utils.rerank_cache import rerank_score_cache
+
+    caches = {"query_embedding": peek_query_embedding_cache(), "rerank_score": rerank_score_cache,
+              "answer": peek_answer_cache()}
+    return {name: cache.stats() for name, cache in caches.items() if cache is not None}
+
+
+def metrics_payload() -> bytes:
+    """prometheus text exposition of every metric, with the cache gauges refreshed"""
+    for name, stats in cache_stats().items():
+        CACHE_HIT_RATIO.labels(name).set(stats["hit_ratio"])
+        CACHE_ENTRIES.labels(name).set(stats.get("entries", stats.get("memory_entries", 0)))
+    return generate_latest()
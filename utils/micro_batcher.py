@@ -0,0 +1,85 @@
+import time
+import queue
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, List
+
+from utils.logger import logger
+
+_STOP = object()
+
+
+class MicroBatcher:
+    """
+    Dynamic micro-batching for local models.
+
+    Concurrent callers submit single items and get a Future back, a dedicated worker thread drains
+    the queue and runs `process_batch` once `max_batch_size` items are waiting or the oldest item
+    has waited `max_wait_ms`. `process_batch` maps a list of items to a list of results in the same order.
+    """
+    def __init__(self, process_batch: Callable[[List[Any]], List[Any]],
+                 max_batch_size: int = 32, max_wait_ms: float = 10, name: str = "micro_batcher"):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.name = name
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, item: Any) -> Future:
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def submit_many(self, items: List[Any]) -> List[Future]:
+        return [self.submit(item) for item in items]
+
+    async def asubmit(self, item: Any) -> Any:
+        """awaitable submit, the event loop is not blocked while the batch runs"""
+        return await asyncio.wrap_future(self.submit(item))
+
+    async def asubmit_many(self, items: List[Any]) -> List[Any]:
+        return list(await asyncio.gather(*[asyncio.wrap_future(future) for future in self.submit_many(items)]))
+
+    def close(self):
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def _collect(self, first) -> list:
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                entry = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if entry is _STOP:
+                self._queue.put(_STOP)
+                break
+            batch.append(entry)
+        return batch
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is _STOP:
+                break
+            # skip futures the caller has already cancelled
+            batch = [(item, future) for item, future in self._collect(first) if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            items = [item for item, _ in batch]
+            try:
+                results = self.process_batch(items)
+            except Exception as e:
+                logger.error(f"{self.name} failed on a batch of {len(items)}: {e!r}")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
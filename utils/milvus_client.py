@@ -82,7 +82,6 @@ class MilvusClient:
                                          "file_name": cand.entity.get('file_name'),
                                          "chunk_id": cand.entity.get('chunk_id')})
                 new_cands.append(doc)
-            new_cands = self.expand_cand_docs(new_cands)
             new_result.append(new_cands)
         return new_result
 
@@ -119,22 +118,39 @@ class MilvusClient:
         # self.logger.info(milvus_records)
         return self.parse_batch_result(milvus_records)
 
-    def search_emb_async(self, embs, expr='', top_k=None, client_timeout=None):
+    async def search_emb_async(self, embs, expr='', top_k=None, client_timeout=None):
         if not top_k:
             top_k = self.top_k
-        # 将search_emb_sync函数放入线程池中运行
-        future = self.executor.submit(self.__search_emb_sync, embs, expr, top_k, client_timeout)
-        return future.result()
+        if client_timeout is None:
+            client_timeout = self.client_timeout
+        # 将search_emb_sync函数放入线程池中运行, 不阻塞事件循环
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, partial(self.__search_emb_sync, embs, expr, top_k, client_timeout))
 
-    def query_expr_async(self, expr, output_fields=None, client_timeout=None):
+    async def search_emb_batch(self, embs, expr='', top_k=None, client_timeout=None, batch_size=1024):
+        """
+        Search many query vectors with one Milvus `search` per `batch_size` rows (all rows in a single
+        round-trip for typical batches), results are returned in the order of `embs`.
+        """
+        embs = [emb.tolist() if hasattr(emb, 'tolist') else list(emb) for emb in embs]
+        if not embs:
+            return []
+        batches = [embs[start:start + batch_size] for start in range(0, len(embs), batch_size)]
+        batch_results = await asyncio.gather(
+            *[self.search_emb_async(batch, expr=expr, top_k=top_k, client_timeout=client_timeout)
+              for batch in batches])
+        return [result for batch_result in batch_results for result in batch_result]
+
+    async def query_expr_async(self, expr, output_fields=None, client_timeout=None):
         if client_timeout is None:
             client_timeout = self.client_timeout
         if not output_fields:
             output_fields = self.output_fields
-        future = self.executor.submit(
-            partial(self.sess.query, output_fields=output_fields, expr=expr,
-                    timeout=client_timeout))
-        return future.result()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, partial(self.sess.query, output_fields=output_fields, expr=expr,
+                                   timeout=client_timeout))
 
     async def insert_files(self, file_id, file_name, file_path, docs, embs, batch_size=1000):
         self.logger.info(f'now inser_file {file_name}')
@@ -184,8 +200,8 @@ class MilvusClient:
         self.sess.delete(expr=f"file_id in {files_id}")
         self.logger.info('milvus delete files_id: %s', files_id)
 
-    def get_files(self, files_id):
-        res = self.query_expr_async(expr=f"file_id in {files_id}", output_fields=["file_id"])
+    async def get_files(self, files_id):
+        res = await self.query_expr_async(expr=f"file_id in {files_id}", output_fields=["file_id"])
         valid_ids = [result['file_id'] for result in res]
         return valid_ids
 
@@ -0,0 +1,100 @@
+import os
+from typing import Tuple
+
+import faiss
+import numpy as np
+
+from config.config_parser import PROJECT_DIR, FAISS_RESCORE_CANDIDATES
+from utils.build_embedding import load_float32
+from utils.file_utils import size_converter
+from utils.rank_fusion import top_k_indices
+
+QUANTIZATION_MODES = ("float16", "int8", "binary")
+
+
+class RescoringIndex:
+    """
+    Two stage search over quantized corpus embeddings.
+
+    The first pass runs on compact codes kept in memory (float16 / scalar int8 / binary sign codes),
+    the best `rescore_candidates` hits are then rescored exactly against the full precision float32
+    vectors, which stay memory-mapped on disk. Exposes the faiss `search` signature so retrievers
+    can use it in place of a faiss index.
+    """
+    def __init__(self, full_embeddings: np.ndarray, mode: str, rescore_candidates: int = FAISS_RESCORE_CANDIDATES):
+        if mode not in QUANTIZATION_MODES:
+            raise ValueError(f"unsupported quantization mode: {mode}, expect one of {QUANTIZATION_MODES}")
+        self.full_embeddings = full_embeddings
+        self.mode = mode
+        self.rescore_candidates = rescore_candidates
+        self.ntotal, self.d = full_embeddings.shape
+        if mode == "binary":
+            self.code_index = faiss.IndexBinaryFlat(self.d)
+        else:
+            qtype = faiss.ScalarQuantizer.QT_fp16 if mode == "float16" else faiss.ScalarQuantizer.QT_8bit
+            self.code_index = faiss.IndexScalarQuantizer(self.d, qtype, faiss.METRIC_INNER_PRODUCT)
+        # encode in blocks, the full precision matrix is never loaded as a whole
+        for start in range(0, self.ntotal, 65536):
+            block = np.ascontiguousarray(full_embeddings[start:start + 65536], dtype=np.float32)
+            if not self.code_index.is_trained:
+                self.code_index.train(block)
+            self.code_index.add(self._encode(block))
+
+    @property
+    def code_size(self) -> int:
+        return self.code_index.code_size
+
+    def _encode(self, vectors: np.ndarray) -> np.ndarray:
+        if self.mode == "binary":
+            return np.packbits(vectors > 0, axis=1)
+        return vectors
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        num_candidates = min(max(k, self.rescore_candidates), self.ntotal)
+        _, candidates = self.code_index.search(self._encode(queries), num_candidates)
+
+        distances = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        for row, (query, row_candidates) in enumerate(zip(queries, candidates)):
+            row_candidates = row_candidates[row_candidates >= 0]
+            # sorted access keeps reads on the memory-mapped file sequential
+            row_candidates.sort()
+            exact_scores = np.asarray(self.full_embeddings[row_candidates], dtype=np.float32) @ query
+            best = top_k_indices(exact_scores, k)
+            distances[row, :len(best)] = exact_scores[best]
+            indices[row, :len(best)] = row_candidates[best]
+        return distances, indices
+
+
+def evaluate_quantization(embedding_model: str = 'text-embedding-ada-002', top_k: int = 10,
+                          rescore_candidates: int = FAISS_RESCORE_CANDIDATES):
+    """report recall@top_k against exact search and code memory of every mode on the cached query set"""
+    corpus_embedding = load_float32(os.path.join(PROJECT_DIR, f"data/corpus_{embedding_model}.npy"))
+    query_embedding = np.asarray(load_float32(os.path.join(PROJECT_DIR, f"data/queries_{embedding_model}.npy")))
+    exact_index = faiss.IndexFlatIP(corpus_embedding.shape[1])
+    exact_index.add(np.ascontiguousarray(corpus_embedding))
+    k = min(top_k, exact_index.ntotal)
+    _, expected = exact_index.search(query_embedding, k)
+    full_bytes = corpus_embedding.shape[0] * corpus_embedding.shape[1] * 4
+
+    def recall(retrieved: np.ndarray) -> float:
+        return float(np.mean([len(set(e) & set(r)) / k for e, r in zip(expected.tolist(), retrieved.tolist())]))
+
+    report = [{"mode": "float32", "first_pass_recall": 1.0, "recall": 1.0,
+               "memory": size_converter(full_bytes), "compression": 1.0}]
+    for mode in QUANTIZATION_MODES:
+        index = RescoringIndex(corpus_embedding, mode, rescore_candidates)
+        _, first_pass = index.code_index.search(index._encode(query_embedding), k)
+        _, rescored = index.search(query_embedding, k)
+        code_bytes = index.ntotal * index.code_size
+        report.append({"mode": mode, "first_pass_recall": recall(first_pass), "recall": recall(rescored),
+                       "memory": size_converter(code_bytes), "compression": full_bytes / code_bytes})
+    return report
+
+
+if __name__ == '__main__':
+    for row in evaluate_quantization():
+        print(f"{row['mode']:>8}  first pass recall@10: {row['first_pass_recall']:.4f}  "
+              f"rescored recall@10: {row['recall']:.4f}  "
+              f"memory: {row['memory']:>10}  compression: {row['compression']:.1f}x")
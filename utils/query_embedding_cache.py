@@ -0,0 +1,142 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+
+from config.config_parser import (
+    EMBEDDING_CACHE_ENABLED, EMBEDDING_CACHE_MEMORY_BYTES, EMBEDDING_CACHE_DB_PATH
+)
+from utils.logger import logger
+
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """NFKC, collapsed whitespace and lower case, so trivially different inputs share one entry"""
+    return WHITESPACE_PATTERN.sub(" ", unicodedata.normalize("NFKC", text)).strip().lower()
+
+
+class QueryEmbeddingCache:
+    """
+    Two tier embedding cache keyed by (model, dimensions, normalized text).
+
+    Tier one is an in-memory LRU bounded by a byte budget, tier two a SQLite database storing float32
+    blobs, it survives restarts and is shared by all worker processes on the host (WAL mode).
+    """
+    def __init__(self, db_path: str = EMBEDDING_CACHE_DB_PATH, max_memory_bytes: int = EMBEDDING_CACHE_MEMORY_BYTES):
+        self.db_path = db_path
+        self.max_memory_bytes = max_memory_bytes
+        self._memory: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS embeddings ("
+                         "key TEXT PRIMARY KEY, model TEXT, dimensions INTEGER, "
+                         "embedding BLOB, created_at REAL)")
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections must not be shared between threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def make_key(model: str, dimensions: int, text: str) -> str:
+        return hashlib.sha1(f"{model}\x00{dimensions}\x00{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+    def _remember(self, key: str, embedding: np.ndarray):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return
+            self._memory[key] = embedding
+            self._memory_bytes += embedding.nbytes
+            while self._memory_bytes > self.max_memory_bytes and self._memory:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= evicted.nbytes
+
+    def get(self, model: str, dimensions: int, text: str) -> Optional[np.ndarray]:
+        key = self.make_key(model, dimensions, text)
+        with self._lock:
+            embedding = self._memory.get(key)
+            if embedding is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return embedding
+        try:
+            row = self._connection().execute("SELECT embedding FROM embeddings WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"query embedding cache read failed: {e}")
+            row = None
+        if row is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        embedding = np.frombuffer(row[0], dtype=np.float32)
+        self._remember(key, embedding)
+        with self._lock:
+            self.disk_hits += 1
+        return embedding
+
+    def put(self, model: str, dimensions: int, text: str, embedding) -> np.ndarray:
+        key = self.make_key(model, dimensions, text)
+        # own copy: a row view would keep the caller's whole batch alive and share its writable memory
+        embedding = np.array(embedding, dtype=np.float32, copy=True)
+        embedding.setflags(write=False)
+        self._remember(key, embedding)
+        try:
+            with self._connection() as conn:
+                conn.execute("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?)",
+                             (key, model, dimensions, embedding.tobytes(), time.time()))
+        except sqlite3.Error as e:
+            logger.warning(f"query embedding cache write failed: {e}")
+        return embedding
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_ratio": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+            }
+
+
+_query_embedding_cache: Optional[QueryEmbeddingCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_query_embedding_cache() -> Optional[QueryEmbeddingCache]:
+    """process wide embedding cache, the SQLite file is only created on first use; None if disabled in the config"""
+    global _query_embedding_cache
+    if not EMBEDDING_CACHE_ENABLED:
+        return None
+    if _query_embedding_cache is None:
+        with _cache_lock:
+            if _query_embedding_cache is None:
+                _query_embedding_cache = QueryEmbeddingCache()
+    return _query_embedding_cache
+
+
+def peek_query_embedding_cache() -> Optional[QueryEmbeddingCache]:
+    """the cache if it was already created, never creates one (for stats)"""
+    return _query_embedding_cache
@@ -0,0 +1,160 @@
+"""
+Rank fusion shared by all hybrid / ensemble retrievers.
+
+Every function takes ranked lists of chunk ids (best first), maps the ids to dense integer codes once
+and does the scoring with NumPy, so fusing dozens of lists with hundreds of candidates stays cheap.
+The result is a list of (chunk_id, fused_score) sorted by score in desc; `fuse_node_lists` does the
+same for llama_index node lists, `fuse_documents` for (content, source) lists keyed by content digest.
+"""
+from typing import TYPE_CHECKING, Hashable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from preprocess.chunk_id_index import content_digest
+
+if TYPE_CHECKING:
+    from llama_index.schema import NodeWithScore
+
+
+def top_k_indices(scores: np.ndarray, top_k: Optional[int] = None) -> np.ndarray:
+    """indices of the top_k largest scores in desc order, argpartition keeps it O(n) + O(k log k)"""
+    if top_k is None or top_k >= len(scores):
+        return np.argsort(-scores, kind="stable")
+    if top_k <= 0:
+        return np.empty(0, dtype=np.int64)
+    candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+def _encode(ranked_lists: Sequence[Sequence[Hashable]]):
+    # chunk id -> dense code, ids are hashed exactly once
+    id_to_code = {}
+    lengths = np.fromiter((len(ranked_list) for ranked_list in ranked_lists), dtype=np.int64,
+                          count=len(ranked_lists))
+    codes = np.fromiter((id_to_code.setdefault(chunk_id, len(id_to_code))
+                         for ranked_list in ranked_lists for chunk_id in ranked_list),
+                        dtype=np.int64, count=int(lengths.sum()))
+    list_index = np.repeat(np.arange(len(ranked_lists)), lengths)
+    # 1-based rank inside each list
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    ranks = np.arange(len(codes)) - np.repeat(offsets, lengths) + 1
+    return list(id_to_code), codes, list_index, ranks, lengths
+
+
+def _weights(weights: Optional[Sequence[float]], n_lists: int) -> np.ndarray:
+    if weights is None:
+        return np.ones(n_lists)
+    if len(weights) != n_lists:
+        raise ValueError(f"got {len(weights)} weights for {n_lists} ranked lists")
+    return np.asarray(weights, dtype=np.float64)
+
+
+def _ranked(chunk_ids: List[Hashable], fused: np.ndarray, top_k: Optional[int]) -> List[Tuple[Hashable, float]]:
+    return [(chunk_ids[i], float(fused[i])) for i in top_k_indices(fused, top_k)]
+
+
+def reciprocal_rank_fusion(ranked_lists: Sequence[Sequence[Hashable]],
+                           weights: Optional[Sequence[float]] = None,
+                           c: int = 60,
+                           top_k: Optional[int] = None) -> List[Tuple[Hashable, float]]:
+    """(weighted) RRF: score(d) = sum_i w_i / (c + rank_i(d))"""
+    if not ranked_lists:
+        return []
+    chunk_ids, codes, list_index, ranks, _ = _encode(ranked_lists)
+    contributions = _weights(weights, len(ranked_lists))[list_index] / (c + ranks)
+    fused = np.bincount(codes, weights=contributions, minlength=len(chunk_ids))
+    return _ranked(chunk_ids, fused, top_k)
+
+
+def fuse_node_lists(node_lists: Sequence[List["NodeWithScore"]],
+                    weights: Optional[Sequence[float]] = None,
+                    c: int = 60,
+                    top_k: Optional[int] = None) -> List["NodeWithScore"]:
+    """RRF over several retrieved node lists, keyed by node id"""
+    # imported here, the service path fuses (content, source) documents and does not need llama_index
+    from llama_index.schema import NodeWithScore
+
+    nodes_by_id = {}
+    for node_list in node_lists:
+        for node in node_list:
+            nodes_by_id.setdefault(node.node_id, node.node)
+    fused = reciprocal_rank_fusion([[node.node_id for node in node_list] for node_list in node_lists],
+                                   weights=weights, c=c, top_k=top_k)
+    return [NodeWithScore(node=nodes_by_id[node_id], score=score) for node_id, score in fused]
+
+
+def fuse_documents(document_lists: Sequence[Sequence[Tuple[str, str]]],
+                   weights: Optional[Sequence[float]] = None,
+                   c: int = 60,
+                   top_k: Optional[int] = None) -> List[List[str]]:
+    """RRF over several (content, source) lists keyed by the content digest, duplicates are merged"""
+    documents_by_id = {}
+    id_lists = []
+    for document_list in document_lists:
+        ids = []
+        for content, source in document_list:
+            chunk_id = content_digest(content)
+            documents_by_id.setdefault(chunk_id, (content, source))
+            ids.append(chunk_id)
+        id_lists.append(ids)
+    fused = reciprocal_rank_fusion(id_lists, weights=weights, c=c, top_k=top_k)
+    return [list(documents_by_id[chunk_id]) for chunk_id, _ in fused]
+
+
+def normalize_scores(scores: np.ndarray, lengths: np.ndarray, method: str = "min_max") -> np.ndarray:
+    """normalize the concatenated scores of several lists, each list (segment) independently"""
+    non_empty = lengths > 0
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))[non_empty]
+    seg_lengths = lengths[non_empty]
+    if method == "min_max":
+        low = np.repeat(np.minimum.reduceat(scores, starts), seg_lengths)
+        span = np.repeat(np.maximum.reduceat(scores, starts), seg_lengths) - low
+        return np.divide(scores - low, span, out=np.ones_like(scores), where=span > 0)
+    if method == "z_score":
+        mean = np.add.reduceat(scores, starts) / seg_lengths
+        centered = scores - np.repeat(mean, seg_lengths)
+        std = np.repeat(np.sqrt(np.add.reduceat(centered ** 2, starts) / seg_lengths), seg_lengths)
+        return np.divide(centered, std, out=np.zeros_like(scores), where=std > 0)
+    raise ValueError(f"unsupported normalization: {method}")
+
+
+def _comb_sum(ranked_lists, score_lists, weights, normalization):
+    chunk_ids, codes, list_index, _, lengths = _encode(ranked_lists)
+    if [len(scores) for scores in score_lists] != lengths.tolist():
+        raise ValueError("every ranked list needs exactly one score per chunk id")
+    scores = np.fromiter((score for scores in score_lists for score in scores), dtype=np.float64,
+                         count=len(codes))
+    normalized = normalize_scores(scores, lengths, normalization)
+    contributions = _weights(weights, len(ranked_lists))[list_index] * normalized
+    fused = np.bincount(codes, weights=contributions, minlength=len(chunk_ids))
+    hits = np.bincount(codes, minlength=len(chunk_ids))
+    return chunk_ids, fused, hits
+
+
+def comb_sum(ranked_lists: Sequence[Sequence[Hashable]],
+             score_lists: Sequence[Sequence[float]],
+             weights: Optional[Sequence[float]] = None,
+             normalization: str = "min_max",
+             top_k: Optional[int] = None) -> List[Tuple[Hashable, float]]:
+    """CombSUM: sum of the per-list normalized scores"""
+    if not ranked_lists:
+        return []
+    chunk_ids, fused, _ = _comb_sum(ranked_lists, score_lists, weights, normalization)
+    return _ranked(chunk_ids, fused, top_k)
+
+
+def comb_mnz(ranked_lists: Sequence[Sequence[Hashable]],
+             score_lists: Sequence[Sequence[float]],
+             weights: Optional[Sequence[float]] = None,
+             normalization: str = "min_max",
+             top_k: Optional[int] = None) -> List[Tuple[Hashable, float]]:
+    """CombMNZ: CombSUM multiplied by the number of lists a chunk appears in"""
+    if not ranked_lists:
+        return []
+    chunk_ids, fused, hits = _comb_sum(ranked_lists, score_lists, weights, normalization)
+    return _ranked(chunk_ids, fused * hits, top_k)
+
+
+if __name__ == '__main__':
+    print(reciprocal_rank_fusion([["a", "b", "c"], ["c", "a", "d"]], weights=[0.5, 0.5], top_k=3))
+    print(comb_mnz([["a", "b", "c"], ["c", "a", "d"]], [[3.2, 2.0, 1.1], [0.9, 0.8, 0.7]], normalization="z_score"))
@@ -0,0 +1,176 @@
+"""
+Client side rate limiting for the external model APIs (OpenAI embedding / chat completion, Cohere rerank).
+
+Each provider gets a requests/min and a tokens/min token bucket plus a cap on in-flight requests, sized
+from config `rate_limit.providers`. Only 429 and 5xx responses are retried: the Retry-After header is
+honoured when the server sends one (and pauses every caller of the provider), otherwise the delay is
+an exponential backoff with full jitter. `acall` is the variant for coroutines, it shares the buckets
+but caps in-flight requests per event loop. A caller with a request deadline gets `DeadlineExceeded`
+instead of waiting past it.
+"""
+import random
+import asyncio
+import threading
+import time
+import weakref
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from config.config_parser import (
+    RATE_LIMIT_PROVIDERS, RATE_LIMIT_MAX_RETRIES, RATE_LIMIT_BASE_DELAY, RATE_LIMIT_MAX_DELAY
+)
+from utils.deadline import Deadline, DeadlineExceeded
+from utils.logger import logger
+
+
+class TokenBucket:
+    """refills `rate_per_minute` tokens per minute up to `capacity`, a rate of 0 means unlimited"""
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None):
+        self.rate = rate_per_minute / 60
+        self.capacity = capacity or rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float = 1) -> float:
+        """take `amount` tokens and return how long the caller has to wait until they are covered"""
+        if not self.rate:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # a single request larger than the bucket would never fit, it waits for a full bucket instead
+            self.tokens -= min(amount, self.capacity)
+            return max(0.0, -self.tokens / self.rate)
+
+
+def parse_retry_after(headers) -> Optional[float]:
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms") or headers.get("Retry-After-Ms")
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after") or headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+def error_status(error: Exception) -> Tuple[Optional[int], Optional[float]]:
+    """HTTP status and Retry-After of an openai / cohere / requests error, (None, None) for anything else"""
+    response = getattr(error, "response", None)
+    status = getattr(error, "status_code", None) or getattr(error, "http_status", None) \
+        or getattr(response, "status_code", None)
+    headers = getattr(error, "headers", None) or getattr(response, "headers", None)
+    return status, parse_retry_after(headers)
+
+
+class RateLimiter:
+    def __init__(self, name: str, requests_per_minute: float = 0, tokens_per_minute: float = 0,
+                 max_in_flight: int = 8, max_retries: int = RATE_LIMIT_MAX_RETRIES,
+                 base_delay: float = RATE_LIMIT_BASE_DELAY, max_delay: float = RATE_LIMIT_MAX_DELAY):
+        self.name = name
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.max_in_flight = max_in_flight
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self._async_semaphores: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.blocked_until = 0.0
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _quota_delay(self, tokens: int) -> float:
+        return max(self.request_bucket.reserve(1), self.token_bucket.reserve(tokens),
+                   self.blocked_until - time.monotonic())
+
+    def _retry_delay(self, error: Exception, attempt: int) -> Optional[float]:
+        """delay before the next attempt, None if the error is not retried"""
+        status, retry_after = error_status(error)
+        if status is None or not (status == 429 or status >= 500) or attempt == self.max_retries:
+            return None
+        if retry_after is not None:
+            delay = min(retry_after, self.max_delay)
+            self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+        else:
+            delay = self.backoff(attempt)
+        logger.warning(f"{self.name} got HTTP {status}, retry {attempt + 1}/{self.max_retries} in {delay:.2f}s")
+        return delay
+
+    def _check_deadline(self, delay: float, deadline: Optional[Deadline]):
+        if deadline is not None and delay >= deadline.remaining():
+            raise DeadlineExceeded(f"{self.name} would wait {delay:.2f}s, "
+                                   f"only {deadline.remaining():.2f}s left before the request deadline")
+
+    def call(self, fn: Callable, *args, tokens: int = 1, deadline: Optional[Deadline] = None, **kwargs):
+        """run `fn(*args, **kwargs)` within the quota of the provider, retrying 429 / 5xx responses"""
+        for attempt in range(self.max_retries + 1):
+            delay = self._quota_delay(tokens)
+            self._check_deadline(delay, deadline)
+            if delay > 0:
+                time.sleep(delay)
+            with self.in_flight:
+                try:
+                    return fn(*args, **kwargs)
+                except Exception as e:
+                    delay = self._retry_delay(e, attempt)
+                    if delay is None:
+                        raise
+            self._check_deadline(delay, deadline)
+            time.sleep(delay)
+
+    def _async_in_flight(self) -> asyncio.Semaphore:
+        # asyncio semaphores are bound to one event loop
+        loop = asyncio.get_running_loop()
+        semaphore = self._async_semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._async_semaphores[loop] = asyncio.Semaphore(self.max_in_flight)
+        return semaphore
+
+    async def acall(self, fn: Callable[..., Awaitable], *args, tokens: int = 1, deadline: Optional[Deadline] = None,
+                    **kwargs):
+        """`call` for coroutine functions, waits without blocking the event loop"""
+        in_flight = self._async_in_flight()
+        for attempt in range(self.max_retries + 1):
+            delay = self._quota_delay(tokens)
+            self._check_deadline(delay, deadline)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            async with in_flight:
+                try:
+                    return await fn(*args, **kwargs)
+                except Exception as e:
+                    delay = self._retry_delay(e, attempt)
+                    if delay is None:
+                        raise
+            self._check_deadline(delay, deadline)
+            await asyncio.sleep(delay)
+
+
+_rate_limiters: Dict[str, RateLimiter] = {}
+_lock = threading.Lock()
+
+
+def get_rate_limiter(provider: str) -> RateLimiter:
+    """process wide limiter per provider, providers missing from the config are only retried, not throttled"""
+    rate_limiter = _rate_limiters.get(provider)
+    if rate_limiter is None:
+        with _lock:
+            rate_limiter = _rate_limiters.get(provider)
+            if rate_limiter is None:
+                rate_limiter = RateLimiter(provider, **RATE_LIMIT_PROVIDERS.get(provider, {}))
+                _rate_limiters[provider] = rate_limiter
+    return rate_limiter
@@ -2,15 +2,25 @@
 
 import os
 import time
+import threading
 from pydantic import BaseModel
-from operator import itemgetter
-from random import randint
-import cohere
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 # from retry import retry
 
+import numpy as np
+import torch
 from FlagEmbedding import FlagReranker
 
+from config.config_parser import (
+    RERANK_BACKEND, RERANK_MODEL, RERANK_USE_FP16, RERANK_BATCH_SIZE, RERANK_MAX_LENGTH, RERANK_MAX_QUEUE_PAIRS, RERANK_MAX_WAIT_MS
+)
+from utils.micro_batcher import MicroBatcher
+from utils.rank_fusion import top_k_indices
+from utils.rate_limiter import get_rate_limiter
+from utils.resources import resource_manager
+from utils.rerank_cache import acached_rerank, cached_rerank
+from utils.logger import logger
+
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -24,43 +34,133 @@ class QuerySuite(BaseModel):
     top_k: int = 3
 
 
-# Using Cohere Rerank service
-cohere_client = cohere.Client(api_key=COHERE_API_KEY)
-
+# Using Cohere Rerank service, the clients come from resource_manager and retries are left to the rate limiter
+COHERE_RERANK_MODEL = "rerank-multilingual-v2.0"
 
-def get_cohere_rerank_result(query: str, docs: List[str], top_n) -> List[Tuple]:
-    time.sleep(randint(1, 10))
 
-    results = cohere_client.rerank(
-        model="rerank-multilingual-v2.0",
+def get_cohere_scores(query: str, docs: List[str]) -> List[float]:
+    # every doc is scored (top_n=len(docs)) so the scores of all pairs can be cached
+    results = get_rate_limiter("cohere").call(
+        resource_manager.cohere.rerank,
+        model=COHERE_RERANK_MODEL,
         query=query,
         documents=docs,
-        top_n=top_n
+        top_n=len(docs)
     )
+    scores = [0.0] * len(docs)
+    for hit in results:
+        scores[hit.index] = hit.relevance_score
+    return scores
 
+
+def get_cohere_rerank_result(query: str, docs: List[str], top_n) -> List[Tuple]:
     # return top_n nodes text with relevence score
-    return [(hit.document['text'], hit.relevance_score) for hit in results]
+    return cached_rerank(COHERE_RERANK_MODEL, query, docs, top_n, get_cohere_scores)
 
 
-def get_bge_rerank_result(query: str, docs: List[str], top_n) -> List[Tuple]:
-    query_suite = QuerySuite(
+async def aget_cohere_scores(query: str, docs: List[str]) -> List[float]:
+    results = await get_rate_limiter("cohere").acall(
+        resource_manager.async_cohere.rerank,
+        model=COHERE_RERANK_MODEL,
         query=query,
-        passages=docs
+        documents=docs,
+        top_n=len(docs)
     )
+    scores = [0.0] * len(docs)
+    for hit in results:
+        scores[hit.index] = hit.relevance_score
+    return scores
+
+
+async def aget_cohere_rerank_result(query: str, docs: List[str], top_n) -> List[Tuple]:
+    return await acached_rerank(COHERE_RERANK_MODEL, query, docs, top_n, aget_cohere_scores)
+
+
+class CrossEncoderReranker:
+    """
+    Resident cross-encoder reranker, subclasses only implement `_score_batch` for their runtime.
+
+    (query, passage) pairs from concurrent callers go through a MicroBatcher, each flushed group is
+    sorted by length and scored in padded batches of `batch_size`, so short pairs are not padded up
+    to the longest passage of the group.
+    """
+    def __init__(self, model_name: str, batch_size: int = RERANK_BATCH_SIZE, max_length: int = RERANK_MAX_LENGTH,
+                 max_queue_pairs: int = RERANK_MAX_QUEUE_PAIRS, max_wait_ms: float = RERANK_MAX_WAIT_MS):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.batcher = MicroBatcher(self.score_pairs, max_batch_size=max_queue_pairs,
+                                    max_wait_ms=max_wait_ms, name="rerank_batcher")
+
+    def _score_batch(self, pairs: List[List[str]]) -> np.ndarray:
+        raise NotImplementedError
+
+    def score_pairs(self, pairs: List[Tuple[str, str]]) -> List[float]:
+        order = np.argsort([len(query) + len(passage) for query, passage in pairs], kind="stable")
+        scores = np.empty(len(pairs), dtype=np.float32)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            scores[batch] = self._score_batch([list(pairs[i]) for i in batch])
+        return scores.tolist()
+
+    def compute_scores(self, query: str, passages: List[str]) -> np.ndarray:
+        futures = self.batcher.submit_many([(query, passage) for passage in passages])
+        return np.array([future.result() for future in futures], dtype=np.float32)
+
+    def rerank(self, query: str, docs: List[str], top_n: int) -> List[Tuple[str, float]]:
+        scores = self.compute_scores(query, docs)
+        return [(docs[i], float(scores[i])) for i in top_k_indices(scores, top_n)]
+
+    async def arerank(self, query: str, docs: List[str], top_n: int) -> List[Tuple[str, float]]:
+        scores = np.array(await self.batcher.asubmit_many([(query, passage) for passage in docs]), dtype=np.float32)
+        return [(docs[i], float(scores[i])) for i in top_k_indices(scores, top_n)]
+
+
+class BgeReranker(CrossEncoderReranker):
+    """PyTorch backend through FlagEmbedding"""
+    def __init__(self, model_name: str = RERANK_MODEL, use_fp16: bool = RERANK_USE_FP16, **kwargs):
+        # Setting use_fp16 to True speeds up computation with a slight performance degradation (GPU only)
+        flag_reranker = FlagReranker(model_name, use_fp16=use_fp16)
+        self.tokenizer = flag_reranker.tokenizer
+        self.model = flag_reranker.model
+        self.device = flag_reranker.device
+        self.model.eval()
+        super().__init__(model_name, **kwargs)
+
+    @torch.no_grad()
+    def _score_batch(self, pairs: List[List[str]]) -> np.ndarray:
+        inputs = self.tokenizer(pairs, padding=True, truncation=True, max_length=self.max_length,
+                                return_tensors='pt').to(self.device)
+        return self.model(**inputs, return_dict=True).logits.view(-1).float().cpu().numpy()
+
+
+_bge_reranker: Optional[CrossEncoderReranker] = None
+_bge_reranker_lock = threading.Lock()
+
+
+def get_bge_reranker() -> CrossEncoderReranker:
+    """process wide reranker of the configured backend, loaded on first use"""
+    global _bge_reranker
+    if _bge_reranker is None:
+        with _bge_reranker_lock:
+            if _bge_reranker is None:
+                t1 = time.time()
+                if RERANK_BACKEND in ('onnx', 'onnx_int8'):
+                    from utils.onnx_reranker import OnnxReranker
+                    _bge_reranker = OnnxReranker(quantized=RERANK_BACKEND == 'onnx_int8')
+                else:
+                    _bge_reranker = BgeReranker()
+                logger.info(f"{RERANK_BACKEND} reranker {_bge_reranker.model_name} loaded in {time.time() - t1:.1f}s")
+    return _bge_reranker
+
+
+def close_bge_reranker():
+    """stop the batcher of the reranker if it was loaded, never loads one"""
+    if _bge_reranker is not None:
+        _bge_reranker.batcher.close()
 
-    bge_reranker = FlagReranker('BAAI/bge-reranker-large', use_fp16=True) # Setting use_fp16 to True speeds up computation with a slight performance degradation
 
-    scores = bge_reranker.compute_score([[query_suite.query, passage] for passage in query_suite.passages])
-
-    if isinstance(scores, List):
-        similiarity_dict = {passage: scores[i] for i, passage in enumerate(query_suite.passages)}
-    else:
-        similarity_dict = {passage: scores for i, passage in enumerate(query_suite.passages)}
-    
-    sorted_similarity_dict = sorted(similarity_dict.items(), key=itemgetter(1), reverse=True) # sorted by score
-    result = {}
-    for j in range(query_suite.top_k):
-        result[sorted_similarity_dict[j][0]] = sorted_similarity_dict[j][1]
-    
+def get_bge_rerank_result(query: str, docs: List[str], top_n) -> List[Tuple]:
+    reranker = get_bge_reranker()
     # return top_n nodes text with relevence score
-    return [(passage, score) for passage, score in result.items()]
\ No newline at end of file
+    return cached_rerank(reranker.model_name, query, docs, top_n, reranker.compute_scores)
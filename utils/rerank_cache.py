@@ -0,0 +1,102 @@
+import time
+import threading
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from config.config_parser import RERANK_CACHE_ENABLED, RERANK_CACHE_MAX_ENTRIES, RERANK_CACHE_TTL_SECONDS
+from preprocess.chunk_id_index import content_digest
+from utils.query_embedding_cache import normalize_text
+from utils.rank_fusion import top_k_indices
+
+CacheKey = Tuple[str, str, int]
+
+
+class RerankScoreCache:
+    """
+    Cross-encoder score cache keyed by (reranker model, normalized query, chunk id).
+
+    A chunk id is the content digest of the chunk text, a pair score only depends on the query and
+    that text, so overlapping candidate sets of later requests reuse the scored pairs. Bounded LRU
+    with a TTL. No invalidation is needed on ingestion: a re-ingested chunk with changed text gets a
+    new digest (and key), the score of an unchanged text stays valid.
+    """
+    def __init__(self, max_entries: int = RERANK_CACHE_MAX_ENTRIES, ttl_seconds: float = RERANK_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._scores: "OrderedDict[CacheKey, Tuple[float, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: CacheKey) -> Optional[float]:
+        with self._lock:
+            entry = self._scores.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._scores[key]
+                self.misses += 1
+                return None
+            self._scores.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: CacheKey, score: float):
+        with self._lock:
+            self._scores[key] = (score, time.monotonic() + self.ttl_seconds)
+            self._scores.move_to_end(key)
+            while len(self._scores) > self.max_entries:
+                self._scores.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses,
+                    "hit_ratio": self.hits / lookups if lookups else 0.0, "entries": len(self._scores)}
+
+
+rerank_score_cache = RerankScoreCache() if RERANK_CACHE_ENABLED else None
+
+
+def _lookup(model: str, query: str, docs: List[str]):
+    # scores of the cached pairs, cache key -> positions of the missing ones (duplicated candidates are scored once)
+    scores = np.empty(len(docs), dtype=np.float32)
+    missing: Dict[CacheKey, List[int]] = {}
+    normalized_query = normalize_text(query)
+    for i, doc in enumerate(docs):
+        key = (model, normalized_query, content_digest(doc))
+        score = rerank_score_cache.get(key) if rerank_score_cache is not None else None
+        if score is None:
+            missing.setdefault(key, []).append(i)
+        else:
+            scores[i] = score
+    return scores, missing
+
+
+def _fill(scores: np.ndarray, missing: Dict[CacheKey, List[int]], new_scores: Iterable[float]):
+    for key, score in zip(missing, new_scores):
+        scores[missing[key]] = score
+        if rerank_score_cache is not None:
+            rerank_score_cache.put(key, float(score))
+
+
+def cached_rerank(model: str, query: str, docs: List[str], top_n: int,
+                  score_docs: Callable[[str, List[str]], Iterable[float]]) -> List[Tuple[str, float]]:
+    """
+    top_n (doc, score) of `docs`, only the pairs missing from the cache are sent to `score_docs`,
+    which returns one score per doc in input order
+    """
+    scores, missing = _lookup(model, query, docs)
+    if missing:
+        _fill(scores, missing, score_docs(query, [docs[rows[0]] for rows in missing.values()]))
+    return [(docs[i], float(scores[i])) for i in top_k_indices(scores, top_n)]
+
+
+async def acached_rerank(model: str, query: str, docs: List[str], top_n: int,
+                         ascore_docs: Callable[[str, List[str]], Awaitable[Iterable[float]]]) -> List[Tuple[str, float]]:
+    """`cached_rerank` with a coroutine scoring function"""
+    scores, missing = _lookup(model, query, docs)
+    if missing:
+        _fill(scores, missing, await ascore_docs(query, [docs[rows[0]] for rows in missing.values()]))
+    return [(docs[i], float(scores[i])) for i in top_k_indices(scores, top_n)]
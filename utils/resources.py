@@ -0,0 +1,181 @@
+"""
+Process wide owner of every long lived backend client.
+
+Elasticsearch (sync / async), the Milvus connection and its collections, OpenAI (sync / async), Cohere
+(sync / async) and the plain HTTP sessions (requests / httpx) are created once, lazily on first use or
+eagerly by `start()` at service startup, and reused by every request with pooled keep-alive connections.
+`health()` checks the self-hosted backends, `close()` / `aclose()` release everything on shutdown.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+import httpx
+import requests
+from cohere import AsyncClient as CohereAsyncClient, Client as CohereClient
+from elasticsearch import AsyncElasticsearch, Elasticsearch
+from openai import AsyncOpenAI, OpenAI
+from pymilvus import Collection, connections, utility
+from requests.adapters import HTTPAdapter
+
+from config.config_parser import (
+    ES_URL, ES_CONNECTIONS_PER_NODE, BM25_BACKEND, MILVUS_HOST_LOCAL, MILVUS_PORT, MILVUS_EXECUTOR_WORKERS,
+    OPENAI_API_KEY, COHERE_API_KEY,
+    RESOURCE_HTTP_POOL_SIZE, RESOURCE_HTTP_KEEPALIVE, RESOURCE_HTTP_TIMEOUT, RESOURCE_OPENAI_POOL_SIZE
+)
+from utils.logger import logger
+
+MILVUS_ALIAS = "default"
+
+
+class ResourceManager:
+    def __init__(self):
+        self._clients: Dict[str, Any] = {}
+        self._collections: Dict[str, Collection] = {}
+        self._milvus_connected = False
+        self._lock = threading.RLock()
+
+    def _get(self, name: str, factory: Callable[[], Any]):
+        client = self._clients.get(name)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(name)
+                if client is None:
+                    client = self._clients[name] = factory()
+        return client
+
+    def _httpx_limits(self, pool_size: int = RESOURCE_HTTP_POOL_SIZE) -> httpx.Limits:
+        return httpx.Limits(max_connections=pool_size, max_keepalive_connections=min(pool_size, RESOURCE_HTTP_KEEPALIVE))
+
+    @property
+    def es(self) -> Elasticsearch:
+        return self._get("es", lambda: Elasticsearch(ES_URL, connections_per_node=ES_CONNECTIONS_PER_NODE))
+
+    @property
+    def async_es(self) -> AsyncElasticsearch:
+        # aiohttp based, first used inside the event loop of the service
+        return self._get("async_es", lambda: AsyncElasticsearch(ES_URL, connections_per_node=ES_CONNECTIONS_PER_NODE))
+
+    def connect_milvus(self):
+        if not self._milvus_connected:
+            with self._lock:
+                if not self._milvus_connected:
+                    connections.connect(MILVUS_ALIAS, host=MILVUS_HOST_LOCAL, port=MILVUS_PORT)
+                    self._milvus_connected = True
+
+    def milvus_collection(self, collection_name: str) -> Collection:
+        collection = self._collections.get(collection_name)
+        if collection is None:
+            self.connect_milvus()
+            with self._lock:
+                collection = self._collections.get(collection_name)
+                if collection is None:
+                    collection = self._collections[collection_name] = Collection(collection_name, using=MILVUS_ALIAS)
+        return collection
+
+    @property
+    def milvus_executor(self) -> ThreadPoolExecutor:
+        # pymilvus is sync only, async callers run it on this bounded pool
+        return self._get("milvus_executor", lambda: ThreadPoolExecutor(max_workers=MILVUS_EXECUTOR_WORKERS,
+                                                                       thread_name_prefix="milvus"))
+
+    @property
+    def http_session(self) -> requests.Session:
+        def factory():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=RESOURCE_HTTP_POOL_SIZE, pool_maxsize=RESOURCE_HTTP_POOL_SIZE)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            return session
+        return self._get("http_session", factory)
+
+    @property
+    def async_http(self) -> httpx.AsyncClient:
+        return self._get("async_http", lambda: httpx.AsyncClient(
+            limits=self._httpx_limits(), timeout=httpx.Timeout(RESOURCE_HTTP_TIMEOUT, connect=5)))
+
+    @property
+    def openai(self) -> OpenAI:
+        # retries are left to utils.rate_limiter
+        return self._get("openai", lambda: OpenAI(
+            api_key=OPENAI_API_KEY, max_retries=0,
+            http_client=httpx.Client(limits=self._httpx_limits(RESOURCE_OPENAI_POOL_SIZE), timeout=RESOURCE_HTTP_TIMEOUT)))
+
+    @property
+    def async_openai(self) -> AsyncOpenAI:
+        return self._get("async_openai", lambda: AsyncOpenAI(
+            api_key=OPENAI_API_KEY, max_retries=0,
+            http_client=httpx.AsyncClient(limits=self._httpx_limits(RESOURCE_OPENAI_POOL_SIZE),
+                                          timeout=RESOURCE_HTTP_TIMEOUT)))
+
+    @property
+    def cohere(self) -> CohereClient:
+        return self._get("cohere", lambda: CohereClient(
+            api_key=COHERE_API_KEY, max_retries=0, check_api_key=False, timeout=RESOURCE_HTTP_TIMEOUT))
+
+    @property
+    def async_cohere(self) -> CohereAsyncClient:
+        return self._get("async_cohere", lambda: CohereAsyncClient(
+            api_key=COHERE_API_KEY, max_retries=0, timeout=RESOURCE_HTTP_TIMEOUT))
+
+    def health(self) -> Dict[str, bool]:
+        """reachability of the self-hosted backends, the hosted APIs are checked by their first call"""
+        status = {}
+        # a local bm25 deployment does not run Elasticsearch
+        if BM25_BACKEND != 'local':
+            try:
+                status["elasticsearch"] = bool(self.es.ping())
+            except Exception as e:
+                logger.warning(f"elasticsearch health check failed: {e!r}")
+                status["elasticsearch"] = False
+        try:
+            self.connect_milvus()
+            utility.get_server_version(using=MILVUS_ALIAS)
+            status["milvus"] = True
+        except Exception as e:
+            logger.warning(f"milvus health check failed: {e!r}")
+            status["milvus"] = False
+        return status
+
+    def start(self, health_check: bool = True):
+        """create the sync clients up front, so the first request does not pay for connection setup"""
+        for name in ("es", "http_session", "openai", "cohere", "milvus_executor"):
+            getattr(self, name)
+        if health_check:
+            logger.info(f"backend health: {self.health()}")
+
+    def close(self):
+        with self._lock:
+            for name in ("es", "http_session", "openai"):
+                client = self._clients.pop(name, None)
+                if client is not None:
+                    client.close()
+            executor = self._clients.pop("milvus_executor", None)
+            if executor is not None:
+                executor.shutdown(wait=False)
+            cohere_client = self._clients.pop("cohere", None)
+            if cohere_client is not None:
+                # the cohere 4.x sync client has no close(), its only resource is the embed batching pool
+                if hasattr(cohere_client, "close"):
+                    cohere_client.close()
+                else:
+                    cohere_client._executor.shutdown(wait=False)
+            if self._milvus_connected:
+                connections.disconnect(MILVUS_ALIAS)
+                self._milvus_connected = False
+                self._collections.clear()
+        logger.info("backend clients closed")
+
+    async def aclose(self):
+        """close the async clients inside the event loop they belong to, then the sync ones"""
+        for name in ("async_es", "async_openai", "async_cohere"):
+            client = self._clients.pop(name, None)
+            if client is not None:
+                await client.close()
+        async_http = self._clients.pop("async_http", None)
+        if async_http is not None:
+            await async_http.aclose()
+        self.close()
+
+
+resource_manager = ResourceManager()